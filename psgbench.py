@@ -0,0 +1,211 @@
+#
+# (c) 2018-25 by Jouni 'Mr.Spiv' Korhonen
+# version 0.8
+#
+# Benchmark harness for psgpacker.py. Packs a set of PSG files with every
+# combination of --lz/--multi/--oneput/--cache/--bankswitch, records the
+# wall time and the peak traced memory of each pass and the output size,
+# and compares the results against a stored baseline.
+#
+# This is free and unencumbered software released into the public domain.
+# For more information, please refer to <http://unlicense.org/>
+#
+
+import sys
+import json
+import argparse
+import tracemalloc
+from itertools import product
+
+from psgpacker import PSGio
+from psgpacker import PSGCompressor
+
+#
+# Option combinations. --multi is only meaningful together with --lz.
+#
+
+def option_sets():
+    sets = []
+
+    for lz,multi,oneput,cache,bankswitch in product((False,True),repeat=5):
+        if (multi and not lz):
+            continue
+
+        sets.append({"lz": lz, "multi": multi, "oneput": oneput, "cache": cache, "bankswitch": bankswitch})
+
+    return sets
+
+FLAGS = {"lz": "z", "multi": "m", "oneput": "o", "cache": "c", "bankswitch": "b", "optimal": "O"}
+
+def option_name(options):
+    name = "".join(FLAGS[k] for k,v in options.items() if (v))
+    return name if (name) else "-"
+
+#
+# Inputs are PSG files or several PSG files joined with '+', which are
+# concatenated into one longer song. A trailing '*n' repeats the song.
+#
+
+def load_input(name):
+    repeat = 1
+
+    if ("*" in name):
+        name,repeat = name.rsplit("*",1)
+        repeat = int(repeat)
+
+    header = None
+    body = bytearray()
+
+    for part in name.split("+"):
+        with open(part,"rb") as f:
+            data = f.read()
+
+        if (header is None):
+            header = data[0:16]
+
+        data = data[16:]
+
+        if (data.endswith(b"\xfd")):
+            data = data[:-1]
+
+        body += data
+
+    return header + bytes(body) * repeat + b"\xfd"
+
+#
+# Pack data once and return per pass times or peaks and the output size.
+#
+
+def run_once(data,options):
+    with PSGio(data,None) as io:
+        psg = PSGCompressor(io,**options)
+        banks = psg.pack()
+
+    if (banks is None):
+        raise psg.error
+
+    return psg.pass_stats,sum(bank.__len__() for bank in banks)
+
+def run(data,options,repeat):
+    result = {"passes": {}}
+
+    # Timing without tracemalloc overhead, best of repeat runs
+    for n in range(repeat):
+        stats,size = run_once(data,options)
+
+        for name,stat in stats.items():
+            best = result["passes"].setdefault(name,{"time": stat["time"]})
+            best["time"] = min(best["time"],stat["time"])
+
+    result["time"] = sum(stat["time"] for stat in result["passes"].values())
+    result["bytes"] = size
+
+    # Memory in a separate run
+    tracemalloc.start()
+
+    try:
+        stats,size = run_once(data,options)
+    finally:
+        tracemalloc.stop()
+
+    for name,stat in stats.items():
+        result["passes"][name]["peak"] = stat["peak"]
+
+    result["peak"] = max(stat["peak"] for stat in stats.values())
+    result["input"] = data.__len__()
+    return result
+
+#
+# Compare results against the baseline. Returns a list of regressions
+# and a list of slower passes. A time is slower only if it is both
+# relatively and absolutely slower than the baseline. Only the output
+# size and the total time are regressions, a single pass is too short
+# to time reliably.
+#
+
+def slower(time,base,tolerance,slack):
+    return time > base * (1 + tolerance) and time - base > slack
+
+def compare(results,baseline,tolerance,slack):
+    regressions = []
+    passes = []
+
+    for key,result in results.items():
+        if (key not in baseline):
+            continue
+
+        base = baseline[key]
+
+        if (result["bytes"] > base["bytes"]):
+            regressions.append(f"{key}: output {base['bytes']} -> {result['bytes']} bytes")
+
+        if (slower(result["time"],base["time"],tolerance,slack)):
+            regressions.append(f"{key}: time {base['time']:.3f} -> {result['time']:.3f} s")
+
+        for name,stat in result["passes"].items():
+            if (name in base["passes"] and slower(stat["time"],base["passes"][name]["time"],tolerance,slack)):
+                passes.append(f"{key}: {name} time {base['passes'][name]['time']:.3f} -> "
+                    f"{stat['time']:.3f} s")
+
+    return regressions,passes
+
+def main(argv=None):
+    prs = argparse.ArgumentParser()
+    prs.add_argument("inputs",metavar="input",type=str,nargs="*",
+        default=["bbt2.psg","uranus.psg","bbt2.psg+uranus.psg*4"],
+        help="PSG files, 'a.psg+b.psg' to concatenate and '*n' to repeat, default bbt2, uranus and both x4")
+    prs.add_argument("--output","-o",dest="output",metavar="file",type=str,default=None,
+        help="Save the results as JSON")
+    prs.add_argument("--baseline","-b",dest="baseline",metavar="file",type=str,default=None,
+        help="Compare the results against an earlier --output")
+    prs.add_argument("--repeat","-r",dest="repeat",metavar="n",type=int,default=3,
+        help="Timing runs per combination, default 3")
+    prs.add_argument("--tolerance","-t",dest="tolerance",metavar="f",type=float,default=0.10,
+        help="Allowed relative slowdown against the baseline, default 0.10")
+    prs.add_argument("--slack","-s",dest="slack",metavar="seconds",type=float,default=0.02,
+        help="Allowed absolute slowdown against the baseline, default 0.02")
+    prs.add_argument("--optimal","-O",dest="optimal",action="store_true",default=False,
+        help="Benchmark --optimal parsing of history references")
+    prs.add_argument("--only",dest="only",metavar="flags",type=str,default=None,
+        help="Only the comma separated combinations, e.g. 'zmb,zmcb' (without O)")
+    args = prs.parse_args(argv)
+
+    results = {}
+
+    for name in args.inputs:
+        data = load_input(name)
+
+        for options in option_sets():
+            if (args.only and option_name(options) not in args.only.split(",")):
+                continue
+
+            if (args.optimal):
+                options["optimal"] = True
+
+            key = f"{name}:{option_name(options)}"
+            result = run(data,options,args.repeat)
+            results[key] = result
+            sys.stderr.write(f"{key:40s} {result['time']:7.3f} s {result['peak']/1024:8.0f} KB "
+                f"{result['bytes']:7d} bytes\n")
+
+    if (args.output):
+        with open(args.output,"w") as f:
+            json.dump(results,f,indent=1)
+
+    if (args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions,passes = compare(results,baseline,args.tolerance,args.slack)
+
+        for slow in passes:
+            sys.stderr.write(f"SLOWER {slow}\n")
+
+        for regression in regressions:
+            sys.stderr.write(f"REGRESSION {regression}\n")
+
+        if (regressions.__len__() > 0):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#
+# (c) 2018-25 by Jouni 'Mr.Spiv' Korhonen
+# version 0.8
+#
+# Thin client for the psgpacker.py --serve packing daemon. Takes the same
+# arguments as psgpacker.py, sends them with the input file over the Unix
+# domain socket and saves the returned banks. The socket is given with
+# --socket or in the PSGPACKER_SOCKET environment variable.
+#
+# This is free and unencumbered software released into the public domain.
+# For more information, please refer to <http://unlicense.org/>
+#
+
+import os
+import sys
+import json
+import socket
+import stat
+
+def send_message(sock,payload):
+    sock.sendall(payload.__len__().to_bytes(4,byteorder="big") + payload)
+
+def recv_exactly(sock,length):
+    buf = bytearray()
+
+    while (buf.__len__() < length):
+        data = sock.recv(min(length - buf.__len__(),65536))
+
+        if (not data):
+            raise ConnectionError("Server closed the connection")
+
+        buf += data
+
+    return bytes(buf)
+
+def recv_message(sock):
+    return recv_exactly(sock,int.from_bytes(recv_exactly(sock,4),byteorder="big"))
+
+#
+# Save a returned bank. A regular file with other hard links, e.g. an
+# output file linked to an --output-cache entry, is removed first so that
+# the other links keep their content.
+#
+
+def save_file(name,bank):
+    try:
+        st = os.stat(name)
+
+        if (stat.S_ISREG(st.st_mode) and st.st_nlink > 1):
+            os.remove(name)
+    except OSError:
+        pass
+
+    with open(name,"wb") as f:
+        f.write(bank)
+
+def read_input(name):
+    if (name == ""):
+        return sys.stdin.buffer.read()
+
+    with open(name,"rb") as f:
+        return f.read()
+
+#
+# Returns the exit code of the request.
+#
+
+def request(path,argv):
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        send_message(sock,json.dumps({"argv": argv, "cwd": os.getcwd()}).encode())
+        reply = json.loads(recv_message(sock))
+
+        if ("input" in reply):
+            send_message(sock,read_input(reply["input"]))
+            reply = json.loads(recv_message(sock))
+
+        sys.stdout.write(reply["stdout"])
+        sys.stderr.write(reply["stderr"])
+
+        for name in reply["files"]:
+            bank = recv_message(sock)
+
+            if (name is None):
+                sys.stdout.buffer.write(bank)
+            else:
+                save_file(name,bank)
+
+    return reply["exit"]
+
+def main(argv=None):
+    if (argv is None):
+        argv = sys.argv[1:]
+
+    path = os.environ.get("PSGPACKER_SOCKET")
+
+    if (argv.__len__() >= 2 and argv[0] == "--socket"):
+        path = argv[1]
+        argv = argv[2:]
+
+    if (path is None):
+        sys.stderr.write("usage: psgclient.py [--socket socket] [psgpacker.py arguments]\n"
+            "The socket must be given with --socket or PSGPACKER_SOCKET\n")
+        sys.exit(2)
+
+    try:
+        sys.exit(request(path,argv))
+    except (OSError,ValueError) as e:
+        sys.stderr.write(f"psgclient.py: {e}\n")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -29,11 +29,80 @@
 # For more information, please refer to <http://unlicense.org/>
 #
 
+import os
 import sys
+import csv
+import json
+import time
+import tracemalloc
+import mmap
 import argparse
+import asyncio
+import heapq
+import hashlib
+import struct
+import tempfile
+import shutil
+import signal
+import socket
+import stat
+import zlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from io import BufferedWriter
 from io import BufferedReader
 from io import BytesIO
+from io import UnsupportedOperation
+from io import StringIO
+from contextlib import redirect_stdout
+from contextlib import redirect_stderr
+from array import array
+from itertools import islice
+from itertools import repeat
+from itertools import product
+from itertools import groupby
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Packer version, part of the --output-cache keys
+VERSION = "0.8"
+
+#
+# SHA-256 of this file, also part of the --output-cache keys, so that a
+# change of the packed output never needs a VERSION bump to invalidate
+# the cached banks.
+#
+
+def source_digest():
+    with open(os.path.abspath(__file__),"rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+#
+# Errors of PSGCompressor.pack(), which keeps the error in self.error
+# and returns None, and of compress(), which raises it. All are
+# ValueErrors so that the callers of older versions still catch them.
+#
+
+class PSGError(ValueError):
+    pass
+
+class PSGFormatError(PSGError):
+    """The input is not a PSG file."""
+
+class PSGBankError(PSGError):
+    """The song needs more banks than --banks allows."""
+
+class PSGLoopError(PSGError):
+    """The --loop-frame is not before the end of the song or the loop
+    offset does not fit in 16 bits without --bankswitch."""
+
+class PSGCycleError(PSGError):
+    """Some frames take more than --max-cycles cycles."""
 
 #
 #
@@ -73,7 +142,14 @@ class PSGio(object):
     opened file objects.
 
     If a bytearray object is used then the PSGio object assumes the input
-    and ouput earrays are appropriately set up.
+    and ouput earrays are appropriately set up. For input also bytes and
+    memoryview objects are accepted.
+
+    In the bulk input mode the whole input is made available as a
+    memoryview in 'ibuf' with 'iptr' as the read cursor. Regular files are
+    mapped with mmap and other file objects (e.g. sys.stdin) are read
+    once. Parsers can then walk the buffer directly without a method call
+    per byte. The getb() method works in both modes.
 
     Methods generated runtime:
 
@@ -111,6 +187,23 @@ class PSGio(object):
             the bytearray bounds.
 
             ValueError exception if the value is not in range(0,255).
+
+    putbuf(...)
+        x.putbuf(buf) -> None.
+
+        Write a bytes like object into an output destination with a
+        single write. The method is overloaded accordingly during the
+        initialization.
+
+        Args:
+            buf (bytes): Data to write.
+
+        Returns:
+            None.
+
+        Raises:
+            IOError exception when a write fails or goes beyond
+            the bytearray bounds.
     """
 
     def __enter__(self):
@@ -139,13 +232,17 @@ class PSGio(object):
         
         """
 
+        if (self.imap):
+            self.ibuf.release()
+            self.imap.close()
+            self.imap = None
         if (self.ifile):
             self.ihndl.close()
         if (self.ofile):
             self.ohndl.close()
 
-    def __init__(self, inp, oup):
-        """x.__init__(input,output) -> None.
+    def __init__(self, inp, oup, bulk=False):
+        """x.__init__(input,output,bulk) -> None.
         
         Initialized x; input and/or output is a file object, a file
         name or a bytearray.
@@ -157,6 +254,7 @@ class PSGio(object):
             output (sys.stdout.buffer, str or bytearray): A reference to a mode 'wb' opened
                 file object, a filename to create or a bytearray object with
                 enough space to hold the output file.
+            bulk (bool): Map or read the entire input into 'ibuf' memoryview.
 
         Returns:
             None.
@@ -170,10 +268,13 @@ class PSGio(object):
         self.optr = 0
         self.ifile = False
         self.ofile = False
+        self.ibuf = None
+        self.imap = None
 
         if (isinstance(inp,BufferedReader)):
             self.getb = self._file_getb
-        elif (type(inp) == bytearray):
+        elif (type(inp) in (bytes,bytearray,memoryview)):
+            self.ibuf = memoryview(inp)
             self.getb = self._mem_getb
         elif (type(inp) == str):
             self.ihndl = open(inp,"rb")
@@ -184,19 +285,40 @@ class PSGio(object):
         else:
             raise NotImplementedError("Input method")
 
+        if (bulk and self.ibuf is None and inp is not None):
+            self._bulk_input()
+
         if (isinstance(oup,BufferedWriter)):
             self.putb = self._file_putb
+            self.putbuf = self._file_putbuf
         elif (type(oup) == bytearray):
             self.putb = self._mem_putb
+            self.putbuf = self._mem_putbuf
         elif (type(oup) == str):
             self.ohndl = open(oup,"wb")
             self.ofile = True
             self.putb = self._file_putb
+            self.putbuf = self._file_putbuf
         elif (oup is None):
             pass
         else:
             raise NotImplementedError("Output method")
     
+    #
+    # Map a regular file into memory or read other file objects
+    # (like pipes) in one go.
+    #
+    def _bulk_input(self):
+        try:
+            self.imap = mmap.mmap(self.ihndl.fileno(),0,access=mmap.ACCESS_READ)
+            self.ibuf = memoryview(self.imap)
+        except (OSError,ValueError,UnsupportedOperation):
+            # Not mappable e.g. a pipe, a terminal or an empty file
+            self.imap = None
+            self.ibuf = memoryview(self.ihndl.read())
+
+        self.getb = self._mem_getb
+
     #
     #
     #
@@ -231,12 +353,16 @@ class PSGio(object):
         self.ohndl.write(bytes([b,]))
         self.optr += 1
 
+    def _file_putbuf(self,buf):
+        self.ohndl.write(buf)
+        self.optr += buf.__len__()
+
     def _mem_getb(self):
-        if (self.iptr >= self.ihndl.__len__()):
+        if (self.iptr >= self.ibuf.__len__()):
             return -1
         
-        b = self.ihndl[self.iptr]
-        self.iprt += 1
+        b = self.ibuf[self.iptr]
+        self.iptr += 1
         return b 
         
     def _mem_putb(self,b):
@@ -246,6 +372,13 @@ class PSGio(object):
         self.ohndl[self.optr] = b
         self.optr += 1
 
+    def _mem_putbuf(self,buf):
+        if (self.optr + buf.__len__() > self.ohndl.__len__()):
+            raise IOError("Write past bytearray end")
+
+        self.ohndl[self.optr:self.optr+buf.__len__()] = buf
+        self.optr += buf.__len__()
+
 
     # return outputted bytes
     def len(self):
@@ -267,6 +400,11 @@ class PSGToken(object):
     TAG_MULTILZ    = 5
     TAG_SINGLELZ   = 6
     TAG_MULTIPUT   = 7
+    TAG_SKIPPED    = 8
+    TAG_LOOP       = 9
+
+    # The frame tokens, which a multi LZ run can replay from history
+    TAG_FRAMES = (TAG_SYNC,TAG_ONEPUT,TAG_CACHED,TAG_MULTIPUT)
 
     def __init__(self,tag,encoding,r15=-1):
         self.tag = tag
@@ -287,25 +425,606 @@ class PSGToken(object):
 #
 #
 
+class PSGTokenStore(object):
+    """PSGTokenStore() -> PSGTokenStore object
+
+    Compact storage for the token stream. Each distinct encoding is
+    interned once and the tokens are kept as parallel array columns of
+    tags, encoding IDs, sizes and R13 values. The output size of all
+    tokens is kept up to date as tokens are added and replaced.
+
+    Tokens covered by a multi-frame history reference are marked with
+    PSGToken.TAG_SKIPPED and have size 0.
+    """
+
+    def __init__(self):
+        self.encodings = []
+        self.ids = {}
+        self.tags = array("B")
+        self.token_ids = array("I")
+        self.sizes = array("B")
+        self.r15 = array("h")
+        self.output_size = 0
+
+    def __len__(self):
+        return self.tags.__len__()
+
+    def intern(self,encoding):
+        token_id = self.ids.get(encoding)
+
+        if (token_id is None):
+            token_id = self.encodings.__len__()
+            self.ids[encoding] = token_id
+            self.encodings.append(encoding)
+
+        return token_id
+
+    def append(self,tag,encoding,r15=-1):
+        self.tags.append(tag)
+        self.token_ids.append(self.intern(encoding))
+        self.sizes.append(encoding.__len__())
+        self.r15.append(r15)
+        self.output_size += encoding.__len__()
+
+    def replace(self,head,tag,encoding):
+        self.output_size += encoding.__len__() - self.sizes[head]
+        self.tags[head] = tag
+        self.token_ids[head] = self.intern(encoding)
+        self.sizes[head] = encoding.__len__()
+
+    def skip(self,head):
+        self.output_size -= self.sizes[head]
+        self.tags[head] = PSGToken.TAG_SKIPPED
+        self.sizes[head] = 0
+
+    def encoding(self,head):
+        return self.encodings[self.token_ids[head]]
+
+    # Restore the tokens from first to last, excluding, from an earlier copy()
+    def restore(self,tokens,first,last):
+        self.output_size += sum(tokens.sizes[first:last]) - sum(self.sizes[first:last])
+        self.tags[first:last] = tokens.tags[first:last]
+        self.token_ids[first:last] = tokens.token_ids[first:last]
+        self.sizes[first:last] = tokens.sizes[first:last]
+
+    def extend(self,tokens):
+        for head in range(tokens.__len__()):
+            self.append(tokens.tags[head],tokens.encoding(head),tokens.r15[head])
+
+    def copy(self):
+        tokens = PSGTokenStore()
+        tokens.encodings = self.encodings[:]
+        tokens.ids = dict(self.ids)
+        tokens.tags = array("B",self.tags)
+        tokens.token_ids = array("I",self.token_ids)
+        tokens.sizes = array("B",self.sizes)
+        tokens.r15 = array("h",self.r15)
+        tokens.output_size = self.output_size
+        return tokens
+
+#
+#
+#
+#
+
+class PSGTokenQueue(object):
+    """PSGTokenQueue() -> PSGTokenQueue object
+
+    Token sink with the PSGTokenStore append() interface for the
+    streaming mode. Tokens are kept only until drained.
+    """
+
+    def __init__(self):
+        self.queue = []
+        self.output_size = 0
+
+    def append(self,tag,encoding,r15=-1):
+        self.queue.append((tag,encoding))
+        self.output_size += encoding.__len__()
+
+    def drain(self):
+        queue = self.queue
+        self.queue = []
+        return queue
+
+#
+#
+#
+#
+
+class PSGTokenCache(object):
+    """PSGTokenCache(path,max_size) -> PSGTokenCache object
+
+    On-disk cache of PASS #1 token streams in the directory 'path'. The
+    key is the SHA-256 of the PSG file, the token format VERSION and
+    --oneput. Bump VERSION whenever PASS #1 output changes.
+
+    Files are written to a temporary file and renamed into place, so
+    parallel jobs only ever see complete files. Unreadable files are
+    misses. A hit touches the file, and the least recently used files
+    are evicted after a store once the files take more than 'max_size'
+    bytes.
+    """
+
+    VERSION = 1
+    MAGIC = b"PSGT"
+    HEADER = "<4sHIII"
+
+    def __init__(self,path,max_size=64<<20):
+        self.path = path
+        self.max_size = max_size
+
+    def key(self,data,oneput):
+        return f"{hashlib.sha256(data).hexdigest()}-v{self.VERSION}-o{int(oneput)}"
+
+    def filename(self,key):
+        return os.path.join(self.path,key + ".tok")
+
+    #
+    # Returns a tuple of the tokens and the input length read by PASS #1
+    # or None.
+    #
+
+    def load(self,key):
+        name = self.filename(key)
+
+        try:
+            with open(name,"rb") as f:
+                buf = f.read()
+
+            os.utime(name)
+            return self.decode(buf)
+        except (OSError,ValueError,IndexError,struct.error,zlib.error):
+            return None
+
+    def decode(self,buf):
+        magic,version,length,num_encodings,num_tokens = struct.unpack_from(self.HEADER,buf)
+
+        if (magic != self.MAGIC or version != self.VERSION):
+            raise ValueError("Not a token cache file")
+
+        body = zlib.decompress(buf[struct.calcsize(self.HEADER):])
+        tokens = PSGTokenStore()
+        pos = 0
+
+        for n in range(num_encodings):
+            tokens.intern(bytes(body[pos+1:pos+1+body[pos]]))
+            pos += body[pos] + 1
+
+        tokens.tags.frombytes(body[pos:pos+num_tokens])
+        pos += num_tokens
+        tokens.token_ids.frombytes(body[pos:pos+num_tokens*tokens.token_ids.itemsize])
+        pos += num_tokens * tokens.token_ids.itemsize
+        tokens.r15.frombytes(body[pos:pos+num_tokens*tokens.r15.itemsize])
+        pos += num_tokens * tokens.r15.itemsize
+
+        if (pos != body.__len__() or tokens.r15.__len__() != num_tokens):
+            raise ValueError("Truncated token cache file")
+
+        if (sys.byteorder == "big"):
+            tokens.token_ids.byteswap()
+            tokens.r15.byteswap()
+
+        sizes = [encoding.__len__() for encoding in tokens.encodings]
+        tokens.sizes = array("B",(sizes[token_id] for token_id in tokens.token_ids))
+        tokens.output_size = sum(tokens.sizes)
+        return tokens,length
+
+    def store(self,key,tokens,length):
+        body = bytearray()
+
+        for encoding in tokens.encodings:
+            body.append(encoding.__len__())
+            body += encoding
+
+        token_ids = array("I",tokens.token_ids)
+        r15 = array("h",tokens.r15)
+
+        if (sys.byteorder == "big"):
+            token_ids.byteswap()
+            r15.byteswap()
+
+        body += tokens.tags
+        body += token_ids.tobytes()
+        body += r15.tobytes()
+
+        buf = struct.pack(self.HEADER,self.MAGIC,self.VERSION,length,tokens.encodings.__len__(),
+            tokens.__len__()) + zlib.compress(body)
+        temp = None
+
+        try:
+            os.makedirs(self.path,exist_ok=True)
+            fd,temp = tempfile.mkstemp(suffix=".tmp",dir=self.path)
+
+            with os.fdopen(fd,"wb") as f:
+                f.write(buf)
+
+            os.chmod(temp,0o644)
+            os.replace(temp,self.filename(key))
+            self.evict()
+        except OSError as e:
+            # The cache is only an optimization..
+            sys.stderr.write(f"Token cache store failed: {e}\n")
+
+            if (temp is not None and os.path.exists(temp)):
+                os.remove(temp)
+
+    #
+    # Remove the least recently used files until the rest fit into
+    # max_size and temporary files left behind by crashed jobs. Other
+    # jobs may be removing the same files at the same time.
+    #
+
+    def evict(self):
+        files = []
+        total = 0
+        now = time.time()
+
+        for entry in os.scandir(self.path):
+            try:
+                stat = entry.stat()
+
+                if (entry.name.endswith(".tmp") and now - stat.st_mtime > 3600):
+                    os.remove(entry.path)
+                elif (entry.name.endswith(".tok")):
+                    files.append((stat.st_mtime,entry.path,stat.st_size))
+                    total += stat.st_size
+            except FileNotFoundError:
+                pass
+
+        for mtime,path,size in sorted(files):
+            if (total <= self.max_size):
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            total -= size
+
+#
+#
+#
+#
+
+class PSGOutputCache(object):
+    """PSGOutputCache(path,max_size,link) -> PSGOutputCache object
+
+    Content addressed cache of packed outputs in the directory 'path'.
+    The key is the SHA-256 of the PSG file, the options that change the
+    output, the packer VERSION, the SHA-256 of the packer source and the
+    entry format VERSION. Each entry
+    is a directory with the bank files and a meta.json holding the
+    SHA-256 of each bank. The banks are checked on every hit.
+
+    Entries are built in a temporary directory and renamed into place.
+    Evicted entries are renamed away before they are removed, so
+    parallel jobs see either a complete entry or a miss. A hit copies
+    the banks to the output files, or hard links them if 'link' is True.
+    The least recently used entries are evicted after a store once the
+    entries take more than 'max_size' bytes. 'hits' and 'misses' count
+    the lookups.
+    """
+
+    VERSION = 1
+
+    def __init__(self,path,max_size=256<<20,link=False):
+        self.path = path
+        self.max_size = max_size
+        self.link = link
+        self.source = source_digest()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self,data,options):
+        digest = hashlib.sha256(data).hexdigest()
+        key = json.dumps([digest,VERSION,self.source,self.VERSION,options],sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def entry(self,key):
+        return os.path.join(self.path,key + ".out")
+
+    #
+    # Returns the meta.json content and the bank file names or None.
+    # Entries with changed banks are removed so that they can be stored
+    # again.
+    #
+
+    def load(self,key):
+        entry = self.entry(key)
+
+        try:
+            with open(os.path.join(entry,"meta.json")) as f:
+                meta = json.load(f)
+
+            names = [os.path.join(entry,f"bank{n}") for n in range(meta["banks"].__len__())]
+
+            for name,digest in zip(names,meta["banks"]):
+                with open(name,"rb") as f:
+                    if (hashlib.sha256(f.read()).hexdigest() != digest):
+                        raise ValueError(f"{name} has changed")
+
+            os.utime(os.path.join(entry,"meta.json"))
+        except (ValueError,KeyError,TypeError):
+            self.misses += 1
+            self.remove(entry)
+            return None
+        except OSError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return meta,names
+
+    #
+    # Copy or link a cached bank to an output file name or write it to
+    # an output file object.
+    #
+
+    def place(self,name,output_name):
+        if (not isinstance(output_name,str)):
+            with open(name,"rb") as f:
+                save_bank(output_name,f.read())
+            return
+
+        if (self.link):
+            try:
+                if (os.path.lexists(output_name)):
+                    os.remove(output_name)
+
+                os.link(name,output_name)
+                return
+            except OSError:
+                # E.g. a different file system..
+                pass
+
+        unlink_shared(output_name)
+        shutil.copyfile(name,output_name)
+
+    def store(self,key,banks,meta):
+        meta = dict(meta,banks=[hashlib.sha256(bank).hexdigest() for bank in banks])
+        temp = None
+
+        try:
+            os.makedirs(self.path,exist_ok=True)
+            temp = tempfile.mkdtemp(suffix=".tmp",dir=self.path)
+
+            for n in range(banks.__len__()):
+                save_bank(os.path.join(temp,f"bank{n}"),banks[n])
+
+            with open(os.path.join(temp,"meta.json"),"w") as f:
+                json.dump(meta,f)
+
+            os.chmod(temp,0o755)
+            os.rename(temp,self.entry(key))
+            temp = None
+            self.evict()
+        except OSError as e:
+            # Fine if a parallel job stored the same entry first
+            if (not os.path.isdir(self.entry(key))):
+                sys.stderr.write(f"Output cache store failed: {e}\n")
+        finally:
+            if (temp is not None):
+                shutil.rmtree(temp,ignore_errors=True)
+
+    #
+    # Remove the least recently used entries until the rest fit into
+    # max_size and temporary directories left behind by crashed jobs.
+    #
+
+    def evict(self):
+        entries = []
+        total = 0
+        now = time.time()
+
+        for entry in os.scandir(self.path):
+            try:
+                if (entry.name.endswith(".tmp") and now - entry.stat().st_mtime > 3600):
+                    shutil.rmtree(entry.path,ignore_errors=True)
+                elif (entry.name.endswith(".out")):
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    mtime = os.stat(os.path.join(entry.path,"meta.json")).st_mtime
+                    entries.append((mtime,entry.path,size))
+                    total += size
+            except FileNotFoundError:
+                pass
+
+        for mtime,path,size in sorted(entries):
+            if (total <= self.max_size):
+                break
+
+            self.remove(path)
+            total -= size
+
+    #
+    # Rename the entry away before removing it so that no job sees a
+    # partly removed entry.
+    #
+
+    def remove(self,entry):
+        doomed = f"{entry[:-4]}-{os.getpid()}.tmp"
+
+        try:
+            os.rename(entry,doomed)
+            shutil.rmtree(doomed,ignore_errors=True)
+        except OSError:
+            pass
+
+#
+#
+#
+#
+
+class PSGMatchFinder(object):
+    """PSGMatchFinder(depth,max_length) -> PSGMatchFinder object
+
+    Hash chains of earlier token positions keyed by interned token IDs.
+    The finder returns the longest run of tokens that repeats an earlier
+    run within the offset reach. At most 'depth' latest positions of the
+    token are tried, which bounds a search to O(depth * max_length).
+
+    The caller inserts the positions that may start a history reference
+    and passes a list of flags telling which tokens may be part of one.
+    Token IDs can be any hashable values, e.g. the encodings themselves.
+    If the token lists only hold a window of the tokens, 'base' is the
+    position of the first token in the lists.
+    """
+
+    def __init__(self,depth=16,max_length=32):
+        self.depth = depth
+        self.max_length = max_length
+        self.chains = {}
+
+    def reset(self):
+        self.chains = {}
+
+    def insert(self,token_id,head,pos):
+        chain = self.chains.get(token_id)
+
+        if (chain is None):
+            self.chains[token_id] = [(head,pos)]
+        else:
+            chain.append((head,pos))
+
+    def latest(self,token_id):
+        chain = self.chains.get(token_id)
+
+        if (chain is None):
+            return None
+
+        return chain[-1]
+
+    #
+    # Forget positions before min_pos.
+    #
+
+    def prune(self,min_pos):
+        for token_id in list(self.chains.keys()):
+            chain = self.chains[token_id]
+            n = 0
+
+            while (n < chain.__len__() and chain[n][1] < min_pos):
+                n += 1
+
+            if (n == chain.__len__()):
+                del self.chains[token_id]
+            elif (n > 0):
+                del chain[:n]
+
+    #
+    # Returns a tuple of match count, match length in bytes, history head
+    # and history position. The count is 0 if nothing was found. Tokens
+    # in the history run must have history_ok set and tokens in the
+    # current run must have current_ok set (if given).
+    #
+
+    def find(self,token_ids,sizes,current_head,encoded_pos,max_offset,history_ok,current_ok=None,base=0):
+        best = (0,0,-1,-1)
+        chain = self.chains.get(token_ids[current_head-base])
+
+        if (chain is None):
+            return best
+
+        max_head = token_ids.__len__() + base
+
+        for history_head,history_pos in reversed(chain[-self.depth:]):
+            if (encoded_pos - history_pos + 2 > max_offset):
+                break
+
+            match_count = 0
+            match_length = 0
+
+            while (match_count < self.max_length and current_head + match_count < max_head):
+                temp_history_head = history_head + match_count - base
+                temp_current_head = current_head + match_count - base
+
+                if (temp_history_head >= current_head - base or not history_ok[temp_history_head] or
+                    (current_ok is not None and not current_ok[temp_current_head]) or
+                    token_ids[temp_history_head] != token_ids[temp_current_head]):
+                    break
+
+                match_length += sizes[temp_history_head]
+                match_count += 1
+
+            if (match_length > best[1]):
+                best = (match_count,match_length,history_head,history_pos)
+
+        return best
+
+#
+#
+#
+#
+
 class PSGCompressor(object):
     NUMREGS = 14
 
-    def __init__(self,io,verbose=False,debug=False):
+    def __init__(self,io,verbose=False,debug=False,lz=False,multi=False,oneput=False,cache=False,
+            bankswitch=False,optimal=False,numpy=False,depth=16,sample=65536,max_cycles=None,
+            token_cache=None,token_cache_size=64,bank_capacity=16384,max_banks=255,seek=None,loop_frame=None):
         self.io = io
         self.regList = []
         self.history = {}
         self.numSync = 0
         self.numPrevSync = 0
         self.regBuffer = bytearray(self.NUMREGS)
-        self.tokens = []
+        self.tokens = PSGTokenStore()
         self.global_used = 0
         self.cached_tags = {}
         self.debug = debug
         self.verbose = verbose
+        self.lz = lz
+        self.multi = multi
+        self.oneput = oneput
+        self.cache = cache
+        self.bankswitch = bankswitch
+        self.optimal = optimal
+        self.numpy = numpy
+        self.depth = depth
+        self.sample = sample
+        self.max_cycles = max_cycles
+        self.token_cache = PSGTokenCache(token_cache,token_cache_size << 20) if (token_cache) else None
+        self.cycles = PSGCycles(oneput,loop=loop_frame is not None)
+        self.cached_cycles = {}
+        self.pass_stats = {}
+        self.pass_clock = 0
         self.number_of_banks = 1
+        self.bank_splits = []
         self.bank_size = 0
         self.header_size = 0
 
+        # Bank geometry and the cost-aware boundaries of PASS3_lz_banks()
+        self.bank_capacity = bank_capacity
+        self.bank_limit = bank_capacity - 2
+        self.max_banks = max_banks
+        self.bank_plan = None
+        self.matches = None
+
+        # --seek resync points, see PASS1_add_resync()
+        self.seek = seek
+        self.resync_heads = []
+        self.resync_r13 = []
+        self.resync_entries = []
+
+        # --loop-frame, -1 detects the loop. The loop point is the resync
+        # point loop_index and the song is cut at the frame loop_end.
+        self.loop_frame = loop_frame
+        self.loop_end = 0
+        self.loop_index = 0
+        self.loop_offset = 0
+        self.loop_r13 = 0xff
+
+        # Multi-song packing, see pack_songs()
+        self.dictionary_heads = 0
+        self.dictionary_size = 0
+        self.song_heads = []
+        self.run_barriers = []
+
+        # The PSGError of the last pack()
+        self.error = None
+        self.song_entries = []
+
         for n in range(self.NUMREGS):
             self.regBuffer[n] = 0
 
@@ -330,100 +1049,433 @@ class PSGCompressor(object):
             return None
             
             
-    # 
-    def get_output_size(self):
-        len = 0
+    #
+    # _next cost of a token that is output as is and a check if a frame
+    # with the given _gettags entry cost fits into --max-cycles. The
+    # entry cost defaults to REP_NONE, the normal entry outside a multi
+    # LZ run. Pass REP_RESTORE for the worst case after a multi LZ run.
+    #
+
+    def token_cycles(self,encoding):
+        c = self.cycles
+        tag = encoding[0]
+
+        if (tag >= 0b11000000):
+            return c.REGPUT + c.PER_REG * (encoding.__len__() - 2)
+        if (tag == 0):
+            return c.eof
+        if (tag < 0b01000000):
+            return c.WAIT
+        if ((tag & 0x3f) >= 16):
+            return self.cached_cycles[tag & 0x0f]
+        if (tag == 0b01001110):
+            # The bank of the loop target is known only in PASS #4
+            return c.loop_bank
+
+        return c.ONEPUT
+
+    def within_budget(self,cycles,pre=None):
+        if (self.max_cycles is None):
+            return True
 
-        for current_token in self.tokens:
-            if (current_token is not None):
-                len += current_token.encoding.__len__()
+        if (pre is None):
+            pre = self.cycles.REP_NONE
 
-        return len+self.header_size
+        return self.cycles.GETTAGS + pre + cycles <= self.max_cycles
 
     #
-    # Parse a PSG frame..
+    # _next cost of each token or None without --max-cycles.
     #
 
-    def PASS1_parseFrames(self):
-        self.regList = []
-        self.numSync += self.numPrevSync
-        self.numPrevSync = 0
+    def PASS3_token_cycles(self):
+        if (self.max_cycles is None):
+            return None
 
-        if (self.debug):
-            sys.stderr.write("Parsing at {:5x}, numSync: {:d}\n".\
-                format(self.io.read(),self.numSync))
+        return [0 if (self.tokens.tags[head] == PSGToken.TAG_SKIPPED) else self.token_cycles(self.tokens.encoding(head))
+            for head in range(self.tokens.__len__())]
 
-        while (True):
-            t = self.io.getb()
+    #
+    # Longest multi LZ run of up to match_count tokens from current_head
+    # where every frame fits into --max-cycles including the frame after
+    # the run that restores the position. 'pre' is REP_RESTORE if the
+    # run would start right after another run.
+    #
 
-            if (t == -1):
-                return False
+    def PASS3_run_length(self,cycles,current_head,match_count,pre=None):
+        if (cycles is None):
+            return match_count
 
-            if (t == 0xff):
-                # found empty frame..
-                self.numSync += 1
-                continue
+        if (not self.within_budget(self.cycles.MULTILZ + cycles[current_head],pre)):
+            return 0
 
-            if (t == 0xfe):
-                # found several empty frames..
-                v = self.io.getb()
-                
-                if (v == -1):
-                    raise RuntimeError("Premature end of file #1")
-               
-                self.numSync = self.numSync +  4 * v
-                continue
-            
-            if (t == 0xfd):
-                # end of file..
-                return False
-            
-            # it was a register write..
+        length = 1
+        best = 0
 
-            while (True):
-                if (t >= 16 and t < 252):
-                    raise NotImplementedError("Outing to MSX devices")
-                
-                # Read register index + value or possible end mark
-                
-                v = self.io.getb()
-            
-                if (v == -1):
-                    raise RuntimeError("Premature end of file #2 at {:5x}, t: {:2x}".format(self.io.read(),t))
-                
-                self.regList.append( (t,v) )
-                t = self.io.getb()
-                 
-                if (t == -1 or t == 0xfd):
-                    return False
+        while (length <= match_count and current_head + length < cycles.__len__()):
+            if (self.within_budget(cycles[current_head+length],self.cycles.REP_RESTORE)):
+                best = length
 
-                if (t == 0xff):
-                    self.numPrevSync = 1
-                    return True
+            if (not self.within_budget(cycles[current_head+length],self.cycles.REP_NEXT)):
+                break
 
-                if (t == 0xfe):
-                    t = self.io.getb()
+            length += 1
 
-                    if (t == -1):
-                        raise RuntimeError("Premature end of file #3")
-                    
-                    if (t == 0):
-                        raise RuntimeError("Multiple end of frames is zero")
-                    
-                    self.numPrevSync = t * 4
-                    return True
+        return best
 
     #
-    # Calculate "used registers" bitmap and also update the
-    # internal PSG register buffer only with values that
-    # change the buffer state.
-    # Also store the last change register index for "oneput" use.
+    # Bankswitch after current_head if the token does not fit into the
+    # bank. The token at current_head ends the bank without being counted
+    # in bank_size, so MAX_TOKEN bytes, the longest token, are kept free
+    # for it. With --max-cycles the bankswitch is done up to
+    # BANKSWITCH_EARLY bytes early once the first token of the next bank
+    # can pay for the callback.
     #
 
-    def PASS1_update(self):
-        self.used = 0
-        self.only = -1
-        cnt = 0
+    MAX_TOKEN = 16
+    BANKSWITCH_EARLY = 512
+
+    def PASS3_bankswitch_due(self,current_head,current_token_size):
+        if (current_token_size + self.bank_size + self.MAX_TOKEN > self.bank_limit):
+            return True
+
+        if (self.max_cycles is None or
+            current_token_size + self.bank_size + self.MAX_TOKEN + self.BANKSWITCH_EARLY <= self.bank_limit):
+            return False
+
+        if (current_head + 1 >= self.tokens.__len__()):
+            return False
+
+        # The bank may start right after a multi LZ run
+        return self.within_budget(self.cycles.bankswitch + self.token_cycles(self.tokens.encoding(current_head+1)),
+            self.cycles.REP_RESTORE)
+
+    #
+    # Cost-aware bank boundaries for the greedy passes. The tokens are
+    # parsed once without banks and every history reference is logged.
+    # A boundary loses the bytes saved by the references that cross it,
+    # as they are output as is in the next bank. When a bank is full the
+    # boundary is moved back to the token within the last 1/BANK_WINDOW
+    # of the bank that loses the fewest bytes, and the tokens after it
+    # are parsed again in the next bank. The moved boundaries may cost a
+    # bank, so the greedy boundaries are also tried and the layout with
+    # fewer banks, then fewer bytes, is kept.
+    #
+
+    BANK_WINDOW = 8
+
+    def PASS3_lz_banks(self):
+        start = (self.tokens.copy(),self.bank_size)
+        greedy = None
+
+        try:
+            self.PASS3_lz_greedy(True)
+
+            if (self.number_of_banks == 1):
+                return
+
+            greedy = (self.number_of_banks,self.tokens.output_size,self.tokens,self.bank_splits,self.bank_size)
+        except PSGBankError:
+            # The planned boundaries may still fit into the banks
+            pass
+
+        self.tokens,self.bank_size = start
+        self.number_of_banks = 1
+        self.bank_splits = []
+        self.history = {}
+
+        try:
+            self.PASS3_plan_banks()
+            self.PASS3_lz_greedy(True)
+        except PSGBankError:
+            if (greedy is None):
+                raise
+
+            self.number_of_banks = self.max_banks + 1
+        finally:
+            self.bank_plan = None
+
+        if (greedy is not None and greedy[0:2] <= (self.number_of_banks,self.tokens.output_size)):
+            self.number_of_banks,_,self.tokens,self.bank_splits,self.bank_size = greedy
+
+    def PASS3_lz_greedy(self,bankswitch):
+        if (self.multi):
+            self.PASS3_lz_multi(bankswitch,self.depth)
+        else:
+            self.PASS3_lz_single(bankswitch)
+
+    def PASS3_plan_banks(self):
+        plan = PSGCompressor(None,lz=True,multi=self.multi,oneput=self.oneput,depth=self.depth,
+            max_cycles=self.max_cycles)
+        plan.tokens = self.tokens.copy()
+        plan.dictionary_heads = self.dictionary_heads
+        plan.dictionary_size = self.dictionary_size
+        plan.cached_cycles = self.cached_cycles
+        plan.matches = []
+        plan.PASS3_lz_greedy(False)
+
+        max_head = plan.tokens.__len__()
+        crossing = [0] * max_head
+
+        for head,history_head,saved in plan.matches:
+            crossing[history_head] += saved
+            crossing[head] -= saved
+
+        # Bytes lost by a boundary after each token
+        for head in range(1,max_head):
+            crossing[head] += crossing[head-1]
+
+        self.bank_plan = (self.tokens.copy(),crossing)
+
+    #
+    # The head that ends the bank when the bank is full at current_head.
+    # The boundary is never placed inside a multi LZ run. The tokens
+    # from the new boundary on are restored to the unparsed tokens.
+    #
+
+    def PASS3_bank_boundary(self,current_head):
+        if (self.bank_plan is None or self.bank_size + self.MAX_TOKEN + self.tokens.sizes[current_head] <= self.bank_limit):
+            return current_head
+
+        original,crossing = self.bank_plan
+        tags = self.tokens.tags
+        sizes = self.tokens.sizes
+        start = self.bank_splits[-1] + 1 if (self.bank_splits) else self.dictionary_heads
+        window = self.bank_capacity // self.BANK_WINDOW
+        best = current_head
+        moved = 0
+        n = current_head - 1
+
+        while (n > start and moved + sizes[n] <= window):
+            moved += sizes[n]
+
+            if (tags[n] != PSGToken.TAG_SKIPPED and tags[n+1] != PSGToken.TAG_SKIPPED and crossing[n] < crossing[best]):
+                best = n
+
+            n -= 1
+
+        if (best < current_head):
+            self.tokens.restore(original,best,current_head)
+
+        return best
+
+    #
+    # Add the time and the peak traced memory, if tracemalloc is tracing,
+    # since the previous call to self.pass_stats[name].
+    #
+
+    def pass_done(self,name):
+        stats = self.pass_stats.setdefault(name,{"time": 0.0})
+        stats["time"] += time.perf_counter() - self.pass_clock
+
+        if (tracemalloc.is_tracing()):
+            stats["peak"] = max(stats.get("peak",0),tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        self.pass_clock = time.perf_counter()
+
+    #
+    # The cache lines for the start of the bank 0. The player always
+    # copies 15 lines, so unused lines are padded with one byte lines
+    # (a zero length would copy 64K). Empty without cached lines.
+    #
+
+    CACHE_LINES = 15
+
+    def get_cache_lines(self):
+        buf = bytearray()
+
+        if (self.cached_tags.__len__() == 0):
+            return bytes(buf)
+
+        for cached_tag,cached_token in sorted(self.cached_tags.items(),key=lambda x:x[1].cache_line):
+            buf.append(cached_tag.__len__())
+            buf += cached_tag
+
+        buf += b"\x01\x00" * (self.CACHE_LINES - self.cached_tags.__len__())
+        return bytes(buf)
+
+    # 
+    def get_output_size(self):
+        return self.tokens.output_size-self.dictionary_size+self.header_size+2*self.bank_splits.__len__()
+
+    #
+    # Mark a bank boundary after the token at current_head. The bankswitch
+    # tokens are not stored with the other tokens but added in PASS #4.
+    # Raises PSGBankError if all self.max_banks banks are in use.
+    #
+
+    def add_bank_split(self,current_head):
+        if (self.number_of_banks >= self.max_banks):
+            raise PSGBankError(f"The song needs more than the {self.max_banks} banks of {self.bank_capacity} "
+                f"bytes available")
+
+        self.bank_splits.append(current_head)
+        self.number_of_banks += 1
+        self.bank_size = 0
+
+    #
+    # Parse a PSG frame..
+    #
+
+    def PASS1_parseFrames(self):
+        self.regList = []
+        self.numSync += self.numPrevSync
+        self.numPrevSync = 0
+
+        if (self.debug):
+            sys.stderr.write("Parsing at {:5x}, numSync: {:d}\n".\
+                format(self.io.read(),self.numSync))
+
+        if (self.io.ibuf is not None):
+            return self.PASS1_parseBuffer()
+
+        while (True):
+            t = self.io.getb()
+
+            if (t == -1):
+                return False
+
+            if (t == 0xff):
+                # found empty frame..
+                self.numSync += 1
+                continue
+
+            if (t == 0xfe):
+                # found several empty frames..
+                v = self.io.getb()
+                
+                if (v == -1):
+                    raise RuntimeError("Premature end of file #1")
+               
+                self.numSync = self.numSync +  4 * v
+                continue
+            
+            if (t == 0xfd):
+                # end of file..
+                return False
+            
+            # it was a register write..
+
+            while (True):
+                if (t >= 16 and t < 252):
+                    raise NotImplementedError("Outing to MSX devices")
+                
+                # Read register index + value or possible end mark
+                
+                v = self.io.getb()
+            
+                if (v == -1):
+                    raise RuntimeError("Premature end of file #2 at {:5x}, t: {:2x}".format(self.io.read(),t))
+                
+                self.regList.append( (t,v) )
+                t = self.io.getb()
+                 
+                if (t == -1 or t == 0xfd):
+                    return False
+
+                if (t == 0xff):
+                    self.numPrevSync = 1
+                    return True
+
+                if (t == 0xfe):
+                    t = self.io.getb()
+
+                    if (t == -1):
+                        raise RuntimeError("Premature end of file #3")
+                    
+                    if (t == 0):
+                        raise RuntimeError("Multiple end of frames is zero")
+                    
+                    self.numPrevSync = t * 4
+                    return True
+
+    #
+    # Same as above but walks the PSGio bulk input buffer directly
+    # without a getb() call per byte.
+    #
+
+    def PASS1_parseBuffer(self):
+        buf = self.io.ibuf
+        end = buf.__len__()
+        pos = self.io.iptr
+        regList = self.regList
+
+        try:
+            while (pos < end):
+                t = buf[pos]
+                pos += 1
+
+                if (t == 0xff):
+                    # found empty frame..
+                    self.numSync += 1
+                    continue
+
+                if (t == 0xfe):
+                    # found several empty frames..
+                    if (pos >= end):
+                        raise RuntimeError("Premature end of file #1")
+
+                    self.numSync = self.numSync + 4 * buf[pos]
+                    pos += 1
+                    continue
+
+                if (t == 0xfd):
+                    # end of file..
+                    return False
+
+                # it was a register write..
+
+                while (True):
+                    if (t >= 16 and t < 252):
+                        raise NotImplementedError("Outing to MSX devices")
+
+                    if (pos >= end):
+                        raise RuntimeError("Premature end of file #2 at {:5x}, t: {:2x}".format(pos,t))
+
+                    regList.append( (t,buf[pos]) )
+                    pos += 1
+
+                    if (pos >= end):
+                        return False
+
+                    t = buf[pos]
+                    pos += 1
+
+                    if (t == 0xfd):
+                        return False
+
+                    if (t == 0xff):
+                        self.numPrevSync = 1
+                        return True
+
+                    if (t == 0xfe):
+                        if (pos >= end):
+                            raise RuntimeError("Premature end of file #3")
+
+                        t = buf[pos]
+                        pos += 1
+
+                        if (t == 0):
+                            raise RuntimeError("Multiple end of frames is zero")
+
+                        self.numPrevSync = t * 4
+                        return True
+
+            return False
+        finally:
+            self.io.iptr = pos
+
+    #
+    # Calculate "used registers" bitmap and also update the
+    # internal PSG register buffer only with values that
+    # change the buffer state.
+    # Also store the last change register index for "oneput" use.
+    #
+
+    def PASS1_update(self):
+        self.used = 0
+        self.only = -1
+        cnt = 0
 
         for reg,val in self.regList:
             if (self.regBuffer[reg] != val):
@@ -437,6 +1489,142 @@ class PSGCompressor(object):
 
         return cnt
 
+    #
+    # NumPy version of PASS1_parseFrames() and PASS1_update() that decodes
+    # the entire PSG body from the bulk input buffer at once. Returns
+    # a (frames,14) uint8 matrix of the register state after each frame,
+    # per frame "used registers" bitmap and per frame wait count. Frames
+    # without register changes are already folded into the waits. The
+    # waits array has one extra entry for the waits after the last frame.
+    #
+
+    def PASS1_decodeFrames(self):
+        if (np is None):
+            raise NotImplementedError("NumPy is not available")
+
+        buf = np.frombuffer(self.io.ibuf[self.io.iptr:],dtype=np.uint8).copy()
+        size = buf.__len__()
+        self.io.iptr += size
+
+        if (size == 0):
+            return np.zeros((0,self.NUMREGS),dtype=np.uint8),np.zeros(0,dtype=np.int64),\
+                np.zeros(1,dtype=np.int64)
+
+        # Find command bytes. 0xff and 0xfd are one byte commands and
+        # everything else is two bytes long. After a one byte command the
+        # next byte always starts a command and within a run of two byte
+        # commands every other byte starts a command.
+        two = (buf != 0xff) & (buf != 0xfd)
+        base = np.zeros(size,dtype=np.int64)
+        resets = np.flatnonzero(~two[:-1]) + 1
+        base[resets] = resets
+        base = np.maximum.accumulate(base)
+        pos = np.flatnonzero(((np.arange(size) - base) & 1) == 0)
+        cmd = buf[pos]
+
+        # end of file..
+        eof = np.flatnonzero(cmd == 0xfd)
+
+        if (eof.__len__() > 0):
+            self.io.iptr -= size - (pos[eof[0]] + 1)
+            pos = pos[:eof[0]]
+            cmd = cmd[:eof[0]]
+        elif (cmd[-1] != 0xff and pos[-1] + 1 >= size):
+            raise RuntimeError("Premature end of file at {:5x}".format(self.io.iptr))
+
+        if (((cmd >= 16) & (cmd < 252)).any()):
+            raise NotImplementedError("Outing to MSX devices")
+
+        val = buf[np.minimum(pos + 1,size - 1)].astype(np.int64)
+        is_reg = cmd < 0xfe
+        is_fe = cmd == 0xfe
+
+        if ((cmd[is_reg] >= self.NUMREGS).any()):
+            raise IndexError("AY register index out of range")
+
+        prev_is_reg = np.concatenate(([False],is_reg[:-1]))
+
+        if ((is_fe & (val == 0) & prev_is_reg).any()):
+            raise RuntimeError("Multiple end of frames is zero")
+
+        # Cumulative waits and the number of frame marks seen so far
+        syncs = np.where(cmd == 0xff,1,np.where(is_fe,4 * val,0))
+        cumsync = np.cumsum(syncs)
+        slot = np.cumsum(~is_reg)
+        total_sync = int(cumsync[-1]) if (cumsync.__len__() > 0) else 0
+
+        writes = np.flatnonzero(is_reg)
+
+        if (writes.__len__() == 0):
+            return np.zeros((0,self.NUMREGS),dtype=np.uint8),np.zeros(0,dtype=np.int64),\
+                np.array([total_sync],dtype=np.int64)
+
+        regs = cmd[writes].astype(np.int64)
+        vals = val[writes]
+
+        # A write is a change if it differs from the previous write into
+        # the same register (all registers start from zero)
+        order = np.argsort(regs,kind="stable")
+        sorted_regs = regs[order]
+        sorted_vals = vals[order]
+        prev = np.zeros_like(sorted_vals)
+        prev[1:] = sorted_vals[:-1]
+        prev[np.concatenate(([True],sorted_regs[1:] != sorted_regs[:-1]))] = 0
+        changed = np.empty(writes.__len__(),dtype=bool)
+        changed[order] = sorted_vals != prev
+
+        # Group writes between frame marks into frames
+        wslot = slot[writes]
+        first = np.concatenate(([True],wslot[1:] != wslot[:-1]))
+        gstart = np.flatnonzero(first)
+        gid = np.cumsum(first) - 1
+        used = np.bitwise_or.reduceat(np.where(changed,np.left_shift(1,regs),0),gstart)
+
+        # Register state after each frame; the last write per register
+        # in a frame wins and unchanged registers are carried forward
+        num_frames = gstart.__len__()
+        key = gid * self.NUMREGS + regs
+        _,last = np.unique(key[::-1],return_index=True)
+        last = writes.__len__() - 1 - last
+        state = np.full(num_frames * self.NUMREGS,-1,dtype=np.int16)
+        state[key[last]] = vals[last]
+        state = state.reshape(num_frames,self.NUMREGS)
+        rows = np.where(state >= 0,np.arange(num_frames)[:,None],-1)
+        rows = np.maximum.accumulate(rows,axis=0)
+        state = np.where(rows >= 0,state[np.maximum(rows,0),np.arange(self.NUMREGS)],0)
+
+        # Drop frames without register changes, which become waits
+        keep = used != 0
+        gsync = cumsync[writes[gstart]][keep]
+        waits = np.diff(np.concatenate(([0],gsync,[total_sync])))
+
+        return state[keep].astype(np.uint8),used[keep],waits
+
+    #
+    # Output tokens from the PASS1_decodeFrames() arrays using the same
+    # methods the frame by frame parser uses.
+    #
+
+    def PASS1_outputArrays(self,frames,used,waits):
+        frames = frames.tolist()
+        used = used.tolist()
+        waits = waits.tolist()
+
+        for n in range(used.__len__()):
+            self.numSync = waits[n]
+            self.numPrevSync = 0
+            self.used = used[n]
+            self.only = used[n].bit_length() - 1
+            self.regBuffer = bytearray(frames[n])
+            self.global_used |= used[n]
+
+            self.PASS1_outputSyncTokens(False)
+            self.PASS1_outputFrames()
+
+        self.numSync = waits[-1]
+        self.numPrevSync = 0
+        self.PASS1_outputSyncTokens(True)
+
     #
     # Output "end of interrupt" marks i.e. frame waits.
     # In a case of "last frame" possible tailing waits
@@ -455,7 +1643,7 @@ class PSGCompressor(object):
             numSync -= 1
 
             while (numSync > 63):
-                self.tokens.append(PSGToken(PSGToken.TAG_SYNC,bytes([0b00111111,])))
+                self.tokens.append(PSGToken.TAG_SYNC,bytes([0b00111111,]))
                 
                 if (self.debug):
                     sys.stderr.write("TOKEN  wait: 00 111111\n")
@@ -463,7 +1651,7 @@ class PSGCompressor(object):
                 numSync -= 63
             
             if (numSync > 0):
-                self.tokens.append(PSGToken(PSGToken.TAG_SYNC,bytes([0b00000000|numSync,])))
+                self.tokens.append(PSGToken.TAG_SYNC,bytes([0b00000000|numSync,]))
 
                 if (self.debug):
                     sys.stderr.write("TOKEN  wait: 00 {:06b}\n".format(numSync))
@@ -481,11 +1669,11 @@ class PSGCompressor(object):
             return False
 
         # Check if there is only a single changed register and '--oneput' is enabled
-        if (args.oneput and (used & (used - 1) == 0)):
+        if (self.oneput and (used & (used - 1) == 0)):
             n = self.only
             m = self.regBuffer[n]
 
-            self.tokens.append(PSGToken(PSGToken.TAG_ONEPUT,bytes([0b01000000|n,m]),self.regBuffer[13]))
+            self.tokens.append(PSGToken.TAG_ONEPUT,bytes([0b01000000|n,m]),self.regBuffer[13])
             s = "oneput: 01 00{:04b} {:02x}".format(n,m)
         
             if (self.debug):
@@ -507,7 +1695,7 @@ class PSGCompressor(object):
 
             used >>= 1
 
-        self.tokens.append(PSGToken(PSGToken.TAG_MULTIPUT,regs,self.regBuffer[13]))
+        self.tokens.append(PSGToken.TAG_MULTIPUT,regs,self.regBuffer[13])
     
         #
         if (self.debug):
@@ -521,25 +1709,141 @@ class PSGCompressor(object):
     #
     #
    
-    def PASS2_build_cache(self):
+    #
+    # Estimate how PASS #3 would output each token without the cache:
+    # as is (0), as a single LZ (1) or within a multi LZ run (2). This is
+    # PASS3_lz_multi() or PASS3_lz_single() without the bankswitches and
+    # the cycle budget and it does not modify the tokens.
+    #
+
+    def PASS2_lz_coverage(self,tokens):
+        token_ids = tokens.token_ids
+        sizes = tokens.sizes
+        max_head = tokens.__len__()
+        coverage = bytearray(max_head)
+
+        if (not self.lz):
+            return coverage
+
+        encoded_pos = 0
+        current_head = 0
+
+        if (not self.multi):
+            history = {}
+
+            while (current_head < max_head):
+                token_id = token_ids[current_head]
+                current_token_size = sizes[current_head]
+
+                if (token_id not in history):
+                    history[token_id] = encoded_pos
+                elif (current_token_size > 2):
+                    if (encoded_pos - history[token_id] + 2 < 16384):
+                        coverage[current_head] = 1
+                        current_token_size = 2
+                    else:
+                        history[token_id] = encoded_pos
+
+                encoded_pos += current_token_size
+                current_head += 1
+
+            return coverage
+
+        finder = PSGMatchFinder(self.depth)
+        raw = [tag in PSGToken.TAG_FRAMES for tag in tokens.tags]
+
+        while (current_head < max_head):
+            current_token_size = sizes[current_head]
+            skip_count = 1
+            match_offset = 65536
+
+            match_count,temp_match_length,history_head,history_pos = \
+                finder.find(token_ids,sizes,current_head,encoded_pos,65535,raw)
+
+            if (match_count > 0):
+                match_offset = encoded_pos - history_pos + 2
+            elif (raw[current_head]):
+                finder.insert(token_ids[current_head],current_head,encoded_pos)
+
+            if (match_count == 1 and temp_match_length > 2 and match_offset < 16384):
+                coverage[current_head] = 1
+                raw[current_head] = False
+                current_token_size = 2
+            elif (temp_match_length > 3):
+                skip_count = match_count
+
+                for to_skip in range(current_head,current_head+skip_count):
+                    coverage[to_skip] = 2
+                    raw[to_skip] = False
+
+                current_token_size = 3
+            elif (match_count > 0 and raw[current_head]):
+                finder.insert(token_ids[current_head],current_head,encoded_pos)
+
+            encoded_pos += current_token_size
+            current_head += skip_count
+
+        return coverage
+
+    #
+    # Select up to 15 cache lines by the bytes they save after PASS #3.
+    # A cached line costs one byte per instance where PASS #3 would output
+    # the register write as is or as a single LZ and saves nothing within
+    # multi LZ runs. A line costs its length plus one bytes in the bank 0
+    # but an unused line still needs a two byte padding line. The lines
+    # with the most instances times length are kept instead if a trial
+    # PASS #3 packs them smaller.
+    #
+
+    def PASS2_build_cache(self,tokens=None):
         cache = {}
+        savings = {}
 
-        for current_token in self.tokens:
+        if (tokens is None):
+            tokens = self.tokens
+
+        tags = tokens.tags
+        token_ids = tokens.token_ids
+        coverage = self.PASS2_lz_coverage(tokens)
+
+        for current_head in range(self.dictionary_heads,tokens.__len__()):
             # We only cache multiple register writes i.e. TAG 11 llllll hhhhhhhh
-            if (current_token.tag == PSGToken.TAG_MULTIPUT):
-                if (current_token.encoding in cache):
-                    cache[current_token.encoding].instances += 1
+            if (tags[current_head] == PSGToken.TAG_MULTIPUT):
+                token_id = token_ids[current_head]
+
+                if (token_id in cache):
+                    cache[token_id].instances += 1
                 else:
-                    cache[current_token.encoding] = current_token
+                    cache[token_id] = PSGToken(PSGToken.TAG_MULTIPUT,tokens.encodings[token_id])
+                    savings[token_id] = 1 - tokens.sizes[current_head]
+
+                if (coverage[current_head] == 0):
+                    savings[token_id] += tokens.sizes[current_head] - 1
+                elif (coverage[current_head] == 1):
+                    savings[token_id] += 1
+
+        if (self.max_cycles is not None):
+            # Only lines that can be played within the cycle budget
+            cache = {token_id:token for token_id,token in cache.items()
+                if (self.within_budget(self.cycles.CACHED + self.cycles.PER_REG * (token.encoding.__len__() - 2)))}
 
         # Get 15 best gaining reg write lines
-        best_lines = sorted(cache.items(),key=lambda x:x[1].instances*x[0].__len__(),reverse=True)[:15]
+        best_lines = heapq.nlargest(self.CACHE_LINES,[token_id for token_id in cache if (savings[token_id] > 0)],
+            key=savings.__getitem__)
 
-        # There must be at least 15 cache lines before PASS #2 can proceed..
-        if (best_lines.__len__() < 15):
-            sys.stderr.write(f"Less than 15 cacheable tokens found.. skipping PASS #2\n")
+        # The padding lines must be paid for too..
+        if (sum(savings[token_id] for token_id in best_lines) <= 2 * (self.CACHE_LINES - best_lines.__len__())):
+            sys.stderr.write(f"No cache lines would save space.. skipping PASS #2\n")
             return False
 
+        if (self.lz):
+            most_lines = heapq.nlargest(self.CACHE_LINES,cache,
+                key=lambda token_id:cache[token_id].instances * cache[token_id].encoding.__len__())
+
+            if (set(most_lines) != set(best_lines) and
+                    self.PASS2_trial(tokens,cache,most_lines) < self.PASS2_trial(tokens,cache,best_lines)):
+                best_lines = most_lines
+
         orig=pack=0
         unused_cache_line = 1
 
@@ -547,42 +1851,82 @@ class PSGCompressor(object):
             sys.stderr.write("PASS #2 found the following cached tags:\n")
 
         for n in range(best_lines.__len__()):
-            cached_token_key,cached_token = best_lines[n]
+            cached_token = cache[best_lines[n]]
+            cached_token_key = cached_token.encoding
             
             # Assign cache line from 1 to 15
             cached_token.cache_line = unused_cache_line
+            self.cached_cycles[unused_cache_line] = self.cycles.CACHED + self.cycles.PER_REG * (cached_token_key.__len__() - 2)
             unused_cache_line += 1
 
             if (self.debug):
                 sys.stderr.write(f" Tag '{cached_token_key}' has length {cached_token.encoding.__len__()} "
-                    f"and seen {cached_token.instances} times\n")
+                    f"and seen {cached_token.instances} times saving {savings[best_lines[n]]} bytes\n")
             
             orig += cached_token_key.__len__() * cached_token.instances
             pack += cached_token.instances
             self.cached_tags[cached_token_key] = cached_token
-            self.bank_size += (cached_token_key.__len__() +1 )
-            self.header_size += (cached_token_key.__len__() +1 )
+
+        # The cache lines are at the start of the bank 0
+        self.bank_size += self.get_cache_lines().__len__()
+        self.header_size += self.get_cache_lines().__len__()
 
         if (self.debug):
             sys.stderr.write(f" PASS #2 original {orig} and packed {pack}\n")
 
         return True
 
+    #
+    # Output size of the greedy PASS #3 with the cache lines of token IDs
+    # 'lines'. With --bankswitch the size includes the bankswitch tokens
+    # and is infinite if the banks run out.
+    #
+
+    def PASS2_trial(self,tokens,cache,lines):
+        trial = PSGCompressor(None,lz=True,multi=self.multi,oneput=self.oneput,depth=self.depth,
+            max_cycles=self.max_cycles,bank_capacity=self.bank_capacity,max_banks=self.max_banks,
+            loop_frame=self.loop_frame)
+        trial.tokens = tokens.copy()
+        trial.dictionary_heads = self.dictionary_heads
+        trial.dictionary_size = self.dictionary_size
+        trial.resync_heads = self.resync_heads
+
+        for n in range(lines.__len__()):
+            token = PSGToken(PSGToken.TAG_MULTIPUT,cache[lines[n]].encoding)
+            token.cache_line = n + 1
+            trial.cached_tags[token.encoding] = token
+            trial.cached_cycles[n+1] = self.cycles.CACHED + self.cycles.PER_REG * (token.encoding.__len__() - 2)
+
+        trial.bank_size = trial.get_cache_lines().__len__()
+        trial.header_size = trial.bank_size
+        trial.PASS2_replace_with_cached()
+
+        try:
+            if (self.bankswitch):
+                trial.PASS3_lz_banks()
+            else:
+                trial.PASS3_lz_greedy(False)
+        except PSGBankError:
+            return float("inf")
+
+        return trial.tokens.output_size + 2 * trial.bank_splits.__len__()
+
     #
     def PASS2_replace_with_cached(self):
         max_head = self.tokens.__len__()
-        current_head = 0
+        current_head = self.dictionary_heads
+        cached_ids = {self.tokens.intern(encoding):token.cache_line for encoding,token in self.cached_tags.items()}
+        token_ids = self.tokens.token_ids
 
         while (current_head < max_head):
-            current_token = self.tokens[current_head]
-
-            if (current_token.encoding in self.cached_tags):
+            if (token_ids[current_head] in cached_ids):
                 # TAG 01 010001 to 01 011111
-                cache_line = self.cached_tags[current_token.encoding].cache_line 
-                self.tokens[current_head] = PSGToken(PSGToken.TAG_CACHED,bytes([0b01010000|cache_line,]))
+                cache_line = cached_ids[token_ids[current_head]]
 
                 if (self.debug):
-                    sys.stderr.write(f"cache_line {cache_line:2d} replaces '{current_token.encoding}'\n")
+                    sys.stderr.write(f"cache_line {cache_line:2d} replaces '{self.tokens.encoding(current_head)}'\n")
+
+                self.tokens.replace(current_head,PSGToken.TAG_CACHED,bytes([0b01010000|cache_line,]))
 
             current_head += 1
 
@@ -594,77 +1938,89 @@ class PSGCompressor(object):
         current_head = 0
 
         while (current_head < max_head):
-            current_token_size = self.tokens[current_head].encoding.__len__()
-
-            if (current_token_size + self.bank_size + 16 > 16382):
-                self.tokens.insert(current_head+1,PSGToken(PSGToken.TAG_BANKSWITCH,bytes([0b01001111,self.number_of_banks])))
-                self.number_of_banks += 1
+            current_token_size = self.tokens.sizes[current_head]
 
+            if (self.PASS3_bankswitch_due(current_head,current_token_size)):
                 if (self.debug):
                     sys.stderr.write(f"BANKSITCH PASS3_lz_null at {current_head} with size {self.bank_size}\n")
 
-                self.bank_size = 0
-                current_head += 1
-                max_head += 1
+                self.add_bank_split(current_head)
                 current_token_size = 0
 
             current_head += 1
             self.bank_size += current_token_size
 
 
-    def PASS3_lz_multi(self,bankswitch):
+    def PASS3_lz_multi(self,bankswitch,depth=16):
+        finder = PSGMatchFinder(depth)
+        token_ids = self.tokens.token_ids
+        sizes = self.tokens.sizes
+
+        # Tokens output as is can be replayed from history
+        frames = [tag in PSGToken.TAG_FRAMES for tag in self.tokens.tags]
+        raw = frames[:]
+
         max_head = self.tokens.__len__()
+        cycles = self.PASS3_token_cycles()
         encoded_pos = 0
-        current_head = 0
+        current_head = self.dictionary_heads
+        self.PASS3_insert_dictionary(finder,self.header_size)
+        after_run = False
 
         while (current_head < max_head):
-            current_token = self.tokens[current_head]
-            current_token_size = current_token.encoding.__len__()
+            current_token_size = sizes[current_head]
             match_count = 0
             match_offset = 65536
             skip_count = 1
             temp_match_length = 0
 
-            if (bankswitch and current_token_size + self.bank_size + 16 > 16382):
-                self.tokens.insert(current_head+1,PSGToken(PSGToken.TAG_BANKSWITCH,bytes([0b01001111,self.number_of_banks])))
-                self.number_of_banks += 1
+            # The frame right after a multi LZ run restores the position
+            pre = self.cycles.REP_RESTORE if (after_run) else self.cycles.REP_NONE
+            after_run = False
+
+            if (bankswitch and self.PASS3_bankswitch_due(current_head,current_token_size)):
+                split = self.PASS3_bank_boundary(current_head)
+
+                for head in range(split,current_head):
+                    raw[head] = frames[head]
+
+                current_head = split
 
                 if (self.debug):
                     sys.stderr.write(f"BANKSITCH PASS3_lz_multi at {current_head} with size {self.bank_size}\n")
 
-                self.bank_size = 0
-                current_head += 1
-                max_head += 1
+                self.add_bank_split(current_head)
                 current_token_size = 0
-                self.history = {}
+                finder.reset()
+                self.PASS3_insert_dictionary(finder)
                 encoded_pos = 0
+                after_run = True
 
-            elif (current_token.encoding not in self.history):
-                # add this new frame position if not ever seen before..
-                self.history[current_token.encoding] = (encoded_pos,current_head)
             else:
-                history_pos,history_head  = self.history[current_token.encoding]
-                match_offset = encoded_pos - history_pos + 2
-                
-                if (match_offset > 65535):
-                    # Past maximum offset.. initialize to this frame and advance to the next token
-                    self.history[current_token.encoding] = (encoded_pos,current_head)
-                else:
-                    temp_current_head = current_head
-                    temp_history_head = history_head
+                match_count,temp_match_length,history_head,history_pos = \
+                    finder.find(token_ids,sizes,current_head,encoded_pos,65535,raw)
+
+                if (self.resync_heads and match_count > 1):
+                    match_count = self.PASS3_resync_limit(current_head,match_count)
+                    temp_match_length = sum(sizes[current_head:current_head+match_count])
+
+                if (match_count > 0):
+                    match_offset = encoded_pos - history_pos + 2
+                elif (raw[current_head]):
+                    # add this new frame position for the later matches..
+                    finder.insert(token_ids[current_head],current_head,encoded_pos)
 
-                    while (temp_history_head < current_head and temp_current_head < max_head and match_count < 32):
-                        if (self.tokens[temp_history_head].encoding.__len__() < 4):
-                            break
+                if (cycles is not None and match_count > 0):
+                    # Shorten or drop matches that do not fit into the cycle budget
+                    single = match_count == 1 and match_offset < 16384 and \
+                        self.within_budget(self.cycles.SINGLELZ + cycles[current_head] - self.cycles.REGPUT,pre)
 
-                        # Do PSG frames match? 
-                        if (self.tokens[temp_current_head].encoding != self.tokens[temp_history_head].encoding):
-                            break
+                    if (not single):
+                        match_count = self.PASS3_run_length(cycles,current_head,match_count,pre)
+                        temp_match_length = sum(sizes[current_head:current_head+match_count])
 
-                        temp_match_length += self.tokens[temp_history_head].encoding.__len__()
-                        temp_current_head += 1
-                        temp_history_head += 1
-                        match_count += 1
+                        if (match_count == 0 and raw[current_head]):
+                            finder.insert(token_ids[current_head],current_head,encoded_pos)
 
             # Did we find any matching frames?
             if (match_count == 1 and temp_match_length > 2 and match_offset < 16384):
@@ -672,9 +2028,12 @@ class PSGCompressor(object):
                     sys.stderr.write(f"single LZ match ({match_offset})\n")
                 # Encode single short LZ
                 match_offset |= 0b1000000000000000
-                self.tokens[current_head].encoding = match_offset.to_bytes(2,byteorder='big')
-                self.tokens[current_head].tag = PSGToken.TAG_SINGLELZ
+                self.tokens.replace(current_head,PSGToken.TAG_SINGLELZ,match_offset.to_bytes(2,byteorder='big'))
+                raw[current_head] = False
                 current_token_size = 2
+
+                if (self.matches is not None):
+                    self.matches.append((current_head,history_head,temp_match_length-2))
             elif (temp_match_length > 3):
                 if (self.debug):
                     sys.stderr.write(f"multipass LZ match ({match_offset},{match_count})\n")
@@ -686,21 +2045,46 @@ class PSGCompressor(object):
                 match_count = (match_count << 8) | (match_offset >> 8)
                 match_count = (match_count << 8) | (match_offset & 0xff)
                 # This breaks if match_count becomes "negative"..
-                self.tokens[current_head].encoding = match_count.to_bytes(3,byteorder='big')
-                self.tokens[current_head].tag = PSGToken.TAG_MULTILZ
+                self.tokens.replace(current_head,PSGToken.TAG_MULTILZ,match_count.to_bytes(3,byteorder='big'))
+                after_run = True
 
+                if (self.matches is not None):
+                    self.matches.append((current_head,history_head,temp_match_length-3))
 
-                # And "None" skipped tokens..
-                for to_none in range(current_head+1,temp_current_head):
-                    self.tokens[to_none] = None
+                # And mark skipped tokens..
+                for to_skip in range(current_head,current_head+skip_count):
+                    if (to_skip > current_head):
+                        self.tokens.skip(to_skip)
+                    raw[to_skip] = False
 
                 current_token_size = 3
+            elif (match_count > 0 and raw[current_head]):
+                # Too short match.. this frame can be matched later on
+                finder.insert(token_ids[current_head],current_head,encoded_pos)
 
             # Advance to the next token..
             encoded_pos   += current_token_size
             current_head  += skip_count
             self.bank_size += current_token_size
 
+    #
+    # The dictionary of pack_songs() is located right before the bank
+    # window, i.e. it is reachable from every bank at negative positions.
+    # In the bank 0 the cache lines of 'header' bytes are in between. The
+    # dictionary ends with a skipped token so that no history run
+    # continues past it.
+    #
+
+    def PASS3_insert_dictionary(self,finder,header=0):
+        sizes = self.tokens.sizes
+        token_ids = self.tokens.token_ids
+        encoded_pos = -self.dictionary_size - header
+
+        for head in range(self.dictionary_heads):
+            if (sizes[head] > 0):
+                finder.insert(token_ids[head],head,encoded_pos)
+                encoded_pos += sizes[head]
+
     #
     # Greedy parsing of history data..
     #
@@ -710,50 +2094,488 @@ class PSGCompressor(object):
         current_head = 0
 
         while (current_head < max_head):
-            current_token = self.tokens[current_head]
-            current_token_size = current_token.encoding.__len__()
+            token_id = self.tokens.token_ids[current_head]
+            current_token_size = self.tokens.sizes[current_head]
 
-            if (bankswitch and current_token_size + self.bank_size + 16 > 16382):
-                self.tokens.insert(current_head+1,PSGToken(PSGToken.TAG_BANKSWITCH,bytes([0b01001111,self.number_of_banks])))
-                self.number_of_banks += 1
+            if (bankswitch and self.PASS3_bankswitch_due(current_head,current_token_size)):
+                current_head = self.PASS3_bank_boundary(current_head)
 
                 if (self.debug):
                     sys.stderr.write(f"BANKSITCH PASS3_lz_single at {current_head} with size {self.bank_size}\n")
 
-                self.bank_size = 0
-                current_head += 1
-                max_head += 1
+                self.add_bank_split(current_head)
                 current_token_size = 0
                 self.history = {}
                 encoded_pos = 0
 
-            elif (current_token.encoding not in self.history):
-                self.history[current_token.encoding] = (encoded_pos,current_head)
+            elif (token_id not in self.history):
+                self.history[token_id] = (encoded_pos,current_head)
             else:
                 # There should not b more than 1 match anyway..
-                history_pos,history_head = self.history[current_token.encoding]
+                history_pos,history_head = self.history[token_id]
                 match_offset = encoded_pos - history_pos + 2
         
                 # Make sure we only match against a regput tag..
                 if (current_token_size > 2):
-                    if (match_offset < 16384):
+                    if (match_offset < 16384 and self.within_budget(self.cycles.SINGLELZ +
+                            self.cycles.PER_REG * (current_token_size - 2))):
                         if (self.debug):
                             sys.stderr.write(f"LZ match ({match_offset},{current_token_size})\n")
                         
                         match_offset |= 0b1000000000000000
-                        self.tokens[current_head].encoding = match_offset.to_bytes(2,byteorder='big')
-                        self.tokens[current_head].tag = PSGToken.TAG_MULTILZ
+                        self.tokens.replace(current_head,PSGToken.TAG_SINGLELZ,match_offset.to_bytes(2,byteorder='big'))
+
+                        if (self.matches is not None):
+                            self.matches.append((current_head,history_head,current_token_size-2))
 
                         # LZ tag is 2 bytes total..
                         current_token_size = 2
                     else:
                         # If we are outside offset reach discard the match and update new macth position..
-                        self.history[current_token.encoding] = (encoded_pos,current_head)
+                        self.history[token_id] = (encoded_pos,current_head)
 
             encoded_pos += current_token_size
             self.bank_size += current_token_size
             current_head += 1
 
+    #
+    # Optimal parsing of history data. Each bank is parsed with a shortest
+    # path search over the tokens where every token can be output as is,
+    # as a single LZ (2 bytes) or as a multi LZ (3 bytes) covering up to
+    # 32 tokens. History references may only point at tokens that are
+    # output as is, which is guaranteed by parsing against a set of
+    # "anchor" tokens that are forced to be output as is. The first rounds
+    # use the first occurrence of each token as anchors, renewed when the
+    # previous round places them out of the offset reach. The last rounds
+    # use all tokens output as is by the best round so far as anchors,
+    # which can only make the result smaller. With bankswitch the rounds
+    # only look at a window of tokens from the start of the bank, which
+    # is doubled until the bank ends inside it.
+    #
+
+    OPTIMAL_ROUNDS = 4
+
+    def PASS3_lz_optimal(self,bankswitch,multi=True,depth=16):
+        tokens = self.tokens
+        max_head = tokens.__len__()
+        token_ids = tokens.token_ids
+        sizes = tokens.sizes
+        frames = [tag in PSGToken.TAG_FRAMES for tag in tokens.tags]
+        regputs = [tag == PSGToken.TAG_MULTIPUT for tag in tokens.tags]
+        cycles = self.PASS3_token_cycles()
+        parsed = PSGTokenStore()
+        resync = set(self.resync_heads)
+        songs = set(self.song_heads)
+        resync_heads = []
+        song_heads = []
+        current_head = 0
+
+        # No multi LZ run covers a resync point or the start of a song
+        self.run_barriers = sorted(resync | songs)
+
+        while (current_head < max_head):
+            limit = self.bank_limit - self.bank_size if bankswitch else None
+            window = self.bank_limit
+
+            while (True):
+                window_head = max_head if (limit is None) else min(max_head,current_head + window)
+                best = self._optimal_rounds(token_ids,sizes,frames,regputs,current_head,window_head,
+                    limit,multi,depth,cycles)
+
+                if (best is not None):
+                    break
+
+                window *= 2
+
+            end_head,bank_size,steps = best
+
+            if (self.debug):
+                sys.stderr.write(f"PASS3_lz_optimal bank {self.number_of_banks-1} tokens {current_head}-{end_head} "
+                    f"with size {bank_size}\n")
+
+            encoded_pos = {}
+            pos = 0
+
+            for head,length,source in steps:
+                encoded_pos[head] = pos
+                r15 = tokens.r15[head]
+
+                if (head in resync):
+                    resync_heads.append(parsed.__len__())
+
+                if (head in songs):
+                    song_heads.append(parsed.__len__())
+
+                if (length == 0):
+                    parsed.append(tokens.tags[head],tokens.encoding(head),r15)
+                    pos += sizes[head]
+                    continue
+
+                match_offset = pos - encoded_pos[source] + 2
+
+                if (length < 0):
+                    if (self.debug):
+                        sys.stderr.write(f"single LZ match ({match_offset})\n")
+
+                    match_offset |= 0b1000000000000000
+                    parsed.append(PSGToken.TAG_SINGLELZ,match_offset.to_bytes(2,byteorder='big'),r15)
+                    pos += 2
+                else:
+                    if (self.debug):
+                        sys.stderr.write(f"multipass LZ match ({match_offset},{length})\n")
+
+                    match_count = (((length + 31) | 0b01000000) << 16) | match_offset
+                    parsed.append(PSGToken.TAG_MULTILZ,match_count.to_bytes(3,byteorder='big'),r15)
+                    pos += 3
+
+            current_head = end_head
+            self.bank_size = bank_size
+
+            if (current_head < max_head):
+                self.add_bank_split(parsed.__len__()-1)
+
+        self.tokens = parsed
+        self.resync_heads = resync_heads
+        self.song_heads = song_heads
+
+    #
+    # Streaming mode. The passes are generators of (tag,encoding) tokens
+    # and PASS3_stream() yields the final encodings so that the memory
+    # use does not depend on the length of the song. PASS #2 selects the
+    # cache lines from the first 'sample' tokens only.
+    #
+
+    def PASS1_stream(self):
+        queue = PSGTokenQueue()
+        self.tokens = queue
+        cont = True
+
+        while (cont):
+            cont = self.PASS1_parseFrames()
+            used = self.PASS1_update()
+
+            if (cont and used == 0):
+                continue
+
+            self.PASS1_outputSyncTokens(False)
+            self.PASS1_outputFrames()
+            yield from queue.drain()
+
+        self.PASS1_outputSyncTokens(True)
+        self.PASS1_outputEOF()
+        yield from queue.drain()
+
+    def PASS2_stream(self,tokens,sample):
+        sampled = PSGTokenStore()
+
+        for tag,encoding in islice(tokens,sample):
+            sampled.append(tag,encoding)
+
+        cached = {}
+
+        if (self.PASS2_build_cache(sampled)):
+            for encoding,token in self.cached_tags.items():
+                cached[encoding] = bytes([0b01010000|token.cache_line,])
+
+        def replace(tag,encoding):
+            if (encoding in cached):
+                return PSGToken.TAG_CACHED,cached[encoding]
+            return tag,encoding
+
+        for current_head in range(sampled.__len__()):
+            yield replace(sampled.tags[current_head],sampled.encoding(current_head))
+
+        del sampled
+
+        for tag,encoding in tokens:
+            yield replace(tag,encoding)
+
+    #
+    # Greedy LZ like PASS3_lz_multi() (or PASS3_lz_single() if multi is
+    # False) over a sliding window of tokens. Only the tokens within the
+    # 64K offset reach plus 32 tokens of lookahead are kept. Yields the
+    # encodings to output and None after each bankswitch token.
+    #
+
+    def PASS3_stream(self,tokens,bankswitch,lz=True,multi=True,depth=16):
+        finder = PSGMatchFinder(depth,32 if multi else 1)
+        tokens = iter(tokens)
+        encodings = []
+        sizes = []
+        raw = []
+        positions = []
+        base = 0
+        dead = 0
+        current_head = 0
+        encoded_pos = 0
+        next_prune = 65536
+        more = True
+
+        while (True):
+            # Keep the lookahead filled
+            while (more and base + encodings.__len__() - current_head <= 32):
+                try:
+                    tag,encoding = next(tokens)
+                except StopIteration:
+                    more = False
+                    break
+
+                encodings.append(encoding)
+                sizes.append(encoding.__len__())
+                raw.append(tag in PSGToken.TAG_FRAMES if (multi) else encoding.__len__() >= 3)
+                positions.append(0)
+
+            if (current_head >= base + encodings.__len__()):
+                break
+
+            n = current_head - base
+            current_token_size = sizes[n]
+            output = encodings[n]
+            match_count = 0
+            match_offset = 65536
+            skip_count = 1
+            temp_match_length = 0
+            positions[n] = encoded_pos
+
+            if (bankswitch and current_token_size + self.bank_size + self.MAX_TOKEN > self.bank_limit):
+                if (self.debug):
+                    sys.stderr.write(f"BANKSITCH PASS3_stream at {current_head} with size {self.bank_size}\n")
+
+                self.add_bank_split(current_head)
+                yield output
+                yield bytes([0b01001111,self.number_of_banks-1])
+                output = None
+                current_token_size = 0
+                finder.reset()
+                encoded_pos = 0
+                next_prune = 65536
+                dead = n + 1
+
+            elif (lz):
+                match_count,temp_match_length,history_head,history_pos = \
+                    finder.find(encodings,sizes,current_head,encoded_pos,65535,raw,base=base)
+
+                if (match_count > 0):
+                    match_offset = encoded_pos - history_pos + 2
+                elif (raw[n]):
+                    finder.insert(encodings[n],current_head,encoded_pos)
+
+            if (match_count == 1 and temp_match_length > 2 and match_offset < 16384):
+                if (self.debug):
+                    sys.stderr.write(f"single LZ match ({match_offset})\n")
+
+                output = (match_offset | 0b1000000000000000).to_bytes(2,byteorder='big')
+                raw[n] = False
+                current_token_size = 2
+            elif (multi and temp_match_length > 3):
+                if (self.debug):
+                    sys.stderr.write(f"multipass LZ match ({match_offset},{match_count})\n")
+
+                skip_count = match_count
+                match_count = (((match_count + 31) | 0b01000000) << 16) | match_offset
+                output = match_count.to_bytes(3,byteorder='big')
+
+                for to_skip in range(n,n+skip_count):
+                    raw[to_skip] = False
+                    positions[to_skip] = encoded_pos
+
+                current_token_size = 3
+            elif (match_count > 0 and raw[n]):
+                finder.insert(encodings[n],current_head,encoded_pos)
+
+            yield output
+
+            encoded_pos   += current_token_size
+            current_head  += skip_count
+            self.bank_size += current_token_size
+
+            # Forget tokens and history positions out of the offset reach
+            while (dead < current_head - base and positions[dead] + 65538 < encoded_pos):
+                dead += 1
+
+            if (dead > 1024 and dead > encodings.__len__() // 2):
+                del encodings[:dead]
+                del sizes[:dead]
+                del raw[:dead]
+                del positions[:dead]
+                base += dead
+                dead = 0
+
+            if (encoded_pos >= next_prune):
+                finder.prune(encoded_pos - 65538)
+                next_prune = encoded_pos + 65536
+
+    #
+    # The rounds of PASS3_lz_optimal() for one bank over the tokens from
+    # start_head to window_head. Returns the best _optimal_parse() result
+    # or None if the bank may end past the window.
+    #
+
+    def _optimal_rounds(self,token_ids,sizes,frames,regputs,start_head,window_head,limit,multi,depth,cycles):
+        positions = None
+        best = None
+
+        for rounds in range(self.OPTIMAL_ROUNDS):
+            if (rounds < self.OPTIMAL_ROUNDS // 2):
+                anchors = self._optimal_anchors(token_ids,sizes,positions,start_head,window_head,
+                    65536 if multi else 16384)
+            else:
+                for head,length,source in best[2]:
+                    for n in range(head,head+max(1,length)):
+                        anchors[n-start_head] = (length == 0)
+
+            result = self._optimal_parse(token_ids,sizes,frames,regputs,anchors,start_head,window_head,
+                limit,multi,depth,cycles)
+
+            if (result is None):
+                return None
+
+            if (best is None or result[0] > best[0] or (result[0] == best[0] and result[1] < best[1])):
+                best = result
+
+            # Output positions of this round for the anchor renewal
+            positions = [0] * (window_head - start_head)
+            end_head,bank_size,steps = result
+            pos = 0
+
+            for head,length,source in steps:
+                for n in range(head,head+max(1,length)):
+                    positions[n-start_head] = pos
+
+                pos += 3 if length > 0 else 2 if length < 0 else sizes[head]
+
+            for n in range(end_head,window_head):
+                positions[n-start_head] = pos
+                pos += sizes[n]
+
+        return best
+
+    #
+    # First occurrence of each token from start_head to window_head. If
+    # positions of a previous round are given, a token that is out of the
+    # offset reach from the previous anchor becomes a new anchor. The
+    # anchors and the positions start from start_head.
+    #
+
+    def _optimal_anchors(self,token_ids,sizes,positions,start_head,window_head,reach):
+        anchors = [False] * (window_head - start_head)
+        seen = {}
+        pos = 0
+
+        for n in range(start_head,window_head):
+            if (positions is not None):
+                pos = positions[n-start_head]
+
+            if (token_ids[n] not in seen or pos - seen[token_ids[n]] + 2 >= reach):
+                seen[token_ids[n]] = pos
+                anchors[n-start_head] = True
+
+            if (positions is None):
+                pos += sizes[n]
+
+        return anchors
+
+    #
+    # Shortest path search for one bank starting from start_head over the
+    # tokens before window_head. Returns the end of the bank, the size of
+    # the bank and a list of (head,length,source) steps where length 0
+    # means the token is output as is, -1 a single LZ and a positive
+    # length a multi LZ. Returns None if the bank may end past the window.
+    # The anchors and the work lists start from start_head.
+    #
+
+    def _optimal_parse(self,token_ids,sizes,frames,regputs,anchors,start_head,window_head,limit,multi,depth,
+            cycles=None):
+        max_head = token_ids.__len__()
+        size = window_head - start_head
+        inf = float("inf")
+        cost = [inf] * (size + 1)
+        parent = [0] * (size + 1)
+        step_length = [0] * (size + 1)
+        step_source = [0] * (size + 1)
+        finder = PSGMatchFinder(depth)
+        window_ids = token_ids[start_head:window_head]
+        window_sizes = sizes[start_head:window_head]
+        replaceable = [frames[start_head+n] and not anchors[n] for n in range(size)]
+        reach = start_head
+        cost[0] = 0
+
+        def relax(head,c,prev,length,source):
+            if (c < cost[head-start_head]):
+                cost[head-start_head] = c
+                parent[head-start_head] = prev
+                step_length[head-start_head] = length
+                step_source[head-start_head] = source
+
+        for current_head in range(start_head,window_head):
+            c = cost[current_head-start_head]
+
+            if (limit is not None):
+                if (current_head > reach):
+                    break
+                if (c > limit):
+                    continue
+
+            token_id = token_ids[current_head]
+
+            # The frame right after a multi LZ run restores the position
+            pre = self.cycles.REP_RESTORE if (step_length[current_head-start_head] > 0) else self.cycles.REP_NONE
+
+            if (anchors[current_head-start_head]):
+                finder.insert(token_id,current_head,c)
+
+            relax(current_head+1,c+sizes[current_head],current_head,0,0)
+            best_length = 0
+            latest = finder.latest(token_id)
+
+            if (replaceable[current_head-start_head] and latest is not None):
+                source,source_pos = latest
+
+                if (regputs[current_head] and c - source_pos + 2 < 16384 and (cycles is None or
+                        self.within_budget(self.cycles.SINGLELZ + cycles[current_head] - self.cycles.REGPUT,pre))):
+                    relax(current_head+1,c+2,current_head,-1,source)
+
+                if (multi):
+                    best_length,_,source,_ = finder.find(window_ids,window_sizes,current_head,c,65535,
+                        anchors,replaceable,base=start_head)
+                    best_length = self.PASS3_run_length(cycles,current_head,best_length,pre)
+
+                    if (self.run_barriers):
+                        best_length = self.PASS3_resync_limit(current_head,best_length,self.run_barriers)
+
+                for length in range(1,best_length+1):
+                    if (cycles is None or self.within_budget(cycles[current_head+length],self.cycles.REP_RESTORE)):
+                        relax(current_head+length,c+3,current_head,length,source)
+
+            reach = max(reach,current_head + max(1,best_length))
+
+            # A longer window could give a longer match or a later end
+            if (reach >= window_head and window_head < max_head):
+                return None
+
+        # Pick the furthest end that fits into the bank
+        end_head = window_head
+
+        if (limit is not None):
+            if (window_head < max_head or cost[size] > limit):
+                end_head = start_head + 1
+
+                for head in range(start_head+1,min(reach+1,window_head)):
+                    if (cost[head-start_head] + 2 <= limit and (cycles is None or
+                            self.within_budget(self.cycles.bankswitch + cycles[head],self.cycles.REP_RESTORE))):
+                        end_head = head
+
+        steps = []
+        head = end_head
+
+        while (head > start_head):
+            prev = parent[head-start_head]
+            steps.append((prev,step_length[head-start_head],step_source[head-start_head]))
+            head = prev
+
+        steps.reverse()
+        return end_head,cost[end_head-start_head],steps
+
     #
     #
     #
@@ -762,72 +2584,128 @@ class PSGCompressor(object):
         if (self.debug):
             sys.stderr.write("TOKEN  end: 00 000000\n")
         
-        self.tokens.append(PSGToken(PSGToken.TAG_EOF,bytes([0b00000000,])))
-
-#
-#
-#
-#
-
-prs = argparse.ArgumentParser()
-prs.add_argument("input_file",metavar="input_file",type=str,help="PSG file or '' if stdin")
-prs.add_argument("output_file",metavar="output_file",type=str,nargs="?",help="Output file or stdout "
-                 "if missing", default="")
-prs.add_argument("--verbose","-v",dest="verbose",action="store_true",default=False,help="Show some process output")
-prs.add_argument("--debug",dest="debug",action="store_true",default=False,help="Show debug output")
-prs.add_argument("--lz","-z",dest="lz",action="store_true",default=False,help="Enable history references")
-prs.add_argument("--multi","-m",dest="multi",action="store_true",default=False,help="Enable multi-frame matches of history references")
-prs.add_argument("--oneput","-o",dest="oneput",action="store_true",default=False,
-    help="Enable single changed register output")
-prs.add_argument("--bankswitch","-b",dest="bankswitch",action="store_true",default=False,
-    help="Add 16K bank boundary marks")
-prs.add_argument("--cache","-c",dest="cache",action="store_true",default=False,
-    help="Cache most used AY register writes")
+        self.tokens.append(PSGToken.TAG_EOF,bytes([0b00000000,]))
 
-args = prs.parse_args()
+    #
+    # Assemble the output banks. Bank 0 starts with the cached lines if
+    # any. Each bank is sliced from the tokens using the bank splits and
+    # all but the last bank end with a bankswitch token, which means there
+    # are always self.number_of_banks banks returned. The resync points
+    # and the pack_songs() song entries are located relative to the song
+    # start in the bank, i.e. after the cached lines in the bank 0. The
+    # loop token gets its target here.
+    #
 
-if __name__ == "__main__":
-    if (args.input_file == ""):
-        input_file = sys.stdin.buffer
-    else:
-        input_file = args.input_file
+    def PASS4_build_banks(self):
+        banks = []
+        bank = [self.get_cache_lines()]
+        bank_size = bank[0].__len__()
+        bank_start = bank_size
+        song_heads = set(self.song_heads)
+        resync_heads = set(self.resync_heads)
+        self.song_entries = []
+        self.resync_entries = []
+        loop_head = self.resync_heads[self.loop_index] if (self.loop_frame is not None) else -1
+        loop_target = None
+
+        tags = self.tokens.tags
+        token_ids = self.tokens.token_ids
+        encodings = self.tokens.encodings
+        start_head = self.dictionary_heads
+
+        for end_head in self.bank_splits + [self.tokens.__len__()-1]:
+            for current_head in range(start_head,end_head+1):
+                if (current_head in song_heads):
+                    self.song_entries.append((banks.__len__(),bank_size-bank_start))
+
+                if (current_head in resync_heads):
+                    self.resync_entries.append((banks.__len__(),bank_size-bank_start,
+                        self.resync_r13[self.resync_entries.__len__()]))
+
+                if (current_head == loop_head):
+                    loop_target = (banks.__len__(),bank_size,bank_size-bank_start)
+
+                if (tags[current_head] == PSGToken.TAG_LOOP):
+                    self.tokens.replace(current_head,PSGToken.TAG_LOOP,
+                        self.PASS4_loop_token(banks.__len__(),bank_size,*loop_target))
+
+                if (tags[current_head] != PSGToken.TAG_SKIPPED):
+                    bank.append(encodings[token_ids[current_head]])
+                    bank_size += self.tokens.sizes[current_head]
+
+            if (banks.__len__() < self.bank_splits.__len__()):
+                bank.append(bytes([0b01001111,banks.__len__()+1]))
+
+            banks.append(b"".join(bank))
+            bank = []
+            bank_size = 0
+            bank_start = 0
+            start_head = end_head + 1
+
+        # The loop point is not a resync point of the seek index
+        if (self.loop_frame is not None and self.seek and self.loop_frame % self.seek != 0):
+            del self.resync_entries[self.loop_index]
+
+        return banks
 
-    if (args.output_file == ""):
-        if (args.bankswitch):
-            sys.stderr.write("--bankswitch work only with output files\n")
-            exit(0)
+    #
+    # TAG 01 001110 rrrrrrrr bbbbbbbb hhhhhhhh llllllll -> loop. rrrrrrrr
+    # is the R13 to write on the loop or $ff. In the same bank bbbbbbbb is
+    # $ff and the offset is back from the llllllll octet, otherwise the
+    # offset is from the song start in the bank bbbbbbbb like in the seek
+    # index. self.loop_offset tells if it fits in 16 bits.
+    #
 
-        output_file = sys.stdout.buffer
-    else:
-        output_file = args.output_file
+    def PASS4_loop_token(self,bank,pos,target_bank,target_pos,target_offset):
+        if (target_bank == bank):
+            target_bank = 0xff
+            target_offset = pos + 4 - target_pos
 
-    if (args.debug):
-        args.verbose = True
+        self.loop_offset = target_offset
+        return bytes([0b01001110,self.loop_r13,target_bank,(target_offset >> 8) & 0xff,target_offset & 0xff])
 
-    original = 0
+    #
+    # PASS #1 from the header to the EOF token. Returns False if the
+    # input is not a PSG file.
+    #
 
-    with PSGio(input_file,None) as io:
-        psg = PSGCompressor(io,args.verbose,args.debug)
-        hdr = psg.parseHeader()
+    def PASS1_tokenize(self):
+        hdr = self.parseHeader()
 
         if (hdr is not None):
-            if (args.debug):
+            if (self.debug):
                 sys.stderr.write(f"{hdr.tag}\n")
         else:
-            sys.stderr.write("not a PSG file\n")
-            exit()
+            return False
+
+        if (self.token_cache is not None and self.io.ibuf is not None):
+            key = self.token_cache.key(self.io.ibuf,self.oneput)
+            cached = self.token_cache.load(key)
+
+            if (cached is not None):
+                self.tokens,self.io.iptr = cached
+                self.pass_done("PASS1")
+
+                if (self.verbose):
+                    sys.stderr.write(f"PASS #1 - {self.tokens.__len__()} tokens from the token cache\n")
+
+                return True
 
         cont = True
 
         # PASS #1
 
-        if (args.verbose):
-            o = "enabled" if args.oneput else "disabled"
+        if (self.verbose):
+            o = "enabled" if self.oneput else "disabled"
             sys.stderr.write(f"PASS #1 - tokenizing with oneput {o}\n")
 
+        if (self.numpy):
+            cont = False
+            frames,used,waits = self.PASS1_decodeFrames()
+
         while (cont):
-            cont = psg.PASS1_parseFrames()
-            used = psg.PASS1_update()
+            cont = self.PASS1_parseFrames()
+            used = self.PASS1_update()
 
             #
             if (cont and used == 0):
@@ -835,106 +2713,2455 @@ if __name__ == "__main__":
                 # For some reason PSG file was constructed so that it has outputs
                 # without register changes -> empty frame after delta coding.
                 # Substitute such frame as a frame wait. The wait frame is passed
-                # to frame parser in the psg.numPrevSync
+                # to frame parser in the self.numPrevSync
 
                 continue
 
-            psg.PASS1_outputSyncTokens(False)
-            psg.PASS1_outputFrames()
+            self.PASS1_outputSyncTokens(False)
+            self.PASS1_outputFrames()
 
         #
-        if (args.verbose):
-            sys.stderr.write(f"  Input PSG file length is {io.read()} bytes\n")
+        if (self.verbose):
+            sys.stderr.write(f"  Input PSG file length is {self.io.read()} bytes\n")
         
-        psg.PASS1_outputSyncTokens(True)
-        psg.PASS1_outputEOF()
+        if (self.numpy):
+            self.PASS1_outputArrays(frames,used,waits)
+        else:
+            self.PASS1_outputSyncTokens(True)
 
-        if (args.verbose):
-            sys.stderr.write(f"  PSG file length after PASS1 is {psg.get_output_size()} bytes\n")
+        self.PASS1_outputEOF()
+
+        if (self.token_cache is not None and self.io.ibuf is not None):
+            self.token_cache.store(key,self.tokens,self.io.read())
+
+        self.pass_done("PASS1")
+
+        if (self.verbose):
+            sys.stderr.write(f"  PSG file length after PASS1 is {self.get_output_size()} bytes\n")
+
+        return True
+
+    #
+    # The PASS #1 tokens with --oneput from the PASS #1 tokens without it,
+    # i.e. register writes of a single register become oneputs.
+    #
+
+    def PASS1_with_oneput(self,tokens):
+        oneput = PSGTokenStore()
+
+        for current_head in range(tokens.__len__()):
+            tag = tokens.tags[current_head]
+            encoding = tokens.encoding(current_head)
+
+            if (tag == PSGToken.TAG_MULTIPUT and encoding.__len__() == 3):
+                used = (encoding[1] << 6) | (encoding[0] & 0x3f)
+                tag = PSGToken.TAG_ONEPUT
+                encoding = bytes([0b01000000|(used.bit_length()-1),encoding[2]])
+
+            oneput.append(tag,encoding,tokens.r15[current_head])
+
+        return oneput
+
+    #
+    # Apply a PASS #1 token to the register state regs and return the
+    # number of frames it outputs.
+    #
+
+    def PASS1_apply(self,tag,encoding,regs):
+        if (tag == PSGToken.TAG_SYNC):
+            return encoding[0]
+        if (tag == PSGToken.TAG_EOF):
+            return 0
+
+        if (tag == PSGToken.TAG_ONEPUT):
+            regs[encoding[0] & 0x0f] = encoding[1]
+        else:
+            used = (encoding[0] & 0x3f) | (encoding[1] << 6)
+            values = iter(encoding[2:])
+
+            for n in range(self.NUMREGS):
+                if (used & (1 << n)):
+                    regs[n] = next(values)
+
+        return 1
+
+    # The registers a PASS #1 token writes
+    def PASS1_used(self,tag,encoding):
+        if (tag == PSGToken.TAG_SYNC or tag == PSGToken.TAG_EOF):
+            return 0
+        if (tag == PSGToken.TAG_ONEPUT):
+            return 1 << (encoding[0] & 0x0f)
+
+        return (encoding[0] & 0x3f) | (encoding[1] << 6)
+
+    #
+    # --seek resync points and the --loop-frame loop point. Every self.seek
+    # frames the token of the frame is replaced by a regput of the registers
+    # 0 to 12, and a wait over the frame is split around one, so that the
+    # player can start there with a cleared state. R13 restarts the envelope
+    # when written, so the regput has it only if the frame writes it and the
+    # seek index has the last R13 for _seek instead. The song start is the
+    # resync point of frame 0. The loop point only needs the registers
+    # that change in the frame or differ at the end of the song, and the
+    # EOF is replaced by a loop token, which is completed by PASS #4. A
+    # song with its loop saved more than once is cut after the first loop.
+    # PASS #3 never lets a multi LZ run cover a resync or loop point.
+    #
+
+    def PASS1_add_resync(self):
+        regs = bytearray(self.NUMREGS)
+        states = []
+        end_state = None
+
+        if (self.loop_frame is not None):
+            for head in range(self.tokens.__len__()):
+                frames = self.PASS1_apply(self.tokens.tags[head],self.tokens.encoding(head),regs)
+                states.extend(repeat(bytes(regs),frames))
+
+            self.loop_end = states.__len__()
+
+            if (self.loop_frame < 0):
+                self.loop_frame,self.loop_end = self.PASS1_find_loop(states)
+
+            if (self.loop_frame >= self.loop_end):
+                raise PSGLoopError(f"The loop frame {self.loop_frame} is not before the end of the song "
+                    f"at frame {self.loop_end}")
+
+            end_state = states[self.loop_end-1]
+            regs = bytearray(self.NUMREGS)
+            end = self.loop_end
+        else:
+            end = sum(self.tokens.encoding(head)[0] if (self.tokens.tags[head] == PSGToken.TAG_SYNC) else
+                int(self.tokens.tags[head] != PSGToken.TAG_EOF) for head in range(self.tokens.__len__()))
+
+        seeks = set(range(self.seek,end,self.seek)) if (self.seek) else set()
+        points = sorted(seeks | ({self.loop_frame} if (self.loop_frame is not None) else set()))
+        points.append(-1)
+        point = 0
+        tokens = PSGTokenStore()
+        frame = 0
+        r13 = None
+        self.resync_heads = [0] if (self.seek) else []
+        self.resync_r13 = [0xff] if (self.seek) else []
+
+        for head in range(self.tokens.__len__()):
+            tag = self.tokens.tags[head]
+            encoding = self.tokens.encoding(head)
+            before = bytes(regs)
+            frames = self.PASS1_apply(tag,encoding,regs)
+            written = self.PASS1_used(tag,encoding) & 0x2000
+
+            if (written):
+                r13 = regs[13]
+
+            if (tag == PSGToken.TAG_EOF or frame >= end):
+                break
+
+            frames = min(frames,end - frame)
+
+            while (frame <= points[point] < frame + frames):
+                if (points[point] > frame):
+                    tokens.append(PSGToken.TAG_SYNC,bytes([points[point]-frame,]))
+                    frames -= points[point] - frame
+                    frame = points[point]
+
+                put13 = written
+
+                # The loop point shares the entry of a resync point at the same frame
+                if (frame == self.loop_frame):
+                    if (self.seek and frame % self.seek == 0):
+                        self.loop_index = frame // self.seek
+                    else:
+                        self.loop_index = self.resync_heads.__len__()
+
+                    # If R13 differs at the end of the song the loop token writes
+                    # it, unless it is $ff, which would mean no write
+                    if (not written and regs[13] != end_state[13]):
+                        if (regs[13] == 0xff):
+                            put13 = 0x2000
+                        else:
+                            self.loop_r13 = regs[13]
+
+                if (frame in seeks):
+                    self.resync_heads.append(tokens.__len__())
+                    self.resync_r13.append(0xff if (r13 is None) else r13)
+
+                    # $ff cannot be put into _regbuf by _seek
+                    if (r13 == 0xff):
+                        put13 = 0x2000
+
+                    self.PASS1_append_frame(tokens,0x1fff | put13,regs)
+                    frames -= 1
+                    frame += 1
+                else:
+                    if (frame > 0 or not self.seek):
+                        self.resync_heads.append(tokens.__len__())
+                        self.resync_r13.append(0xff if (r13 is None) else r13)
+
+                    # A wait does not change the registers
+                    if (tag == PSGToken.TAG_SYNC):
+                        before = regs
+
+                    used = sum(1 << n for n in range(self.NUMREGS - 1)
+                        if (regs[n] != before[n] or regs[n] != end_state[n])) | put13
+
+                    if (used):
+                        self.PASS1_append_frame(tokens,used,regs)
+                        frames -= 1
+                        frame += 1
+
+                point += 1
+
+            # The rest of a wait and the frame if it was not replaced
+            if (tag == PSGToken.TAG_SYNC and frames > 0):
+                tokens.append(tag,bytes([frames,]))
+            elif (tag != PSGToken.TAG_SYNC and frames > 0):
+                tokens.append(tag,encoding,self.tokens.r15[head])
+
+            frame += frames
+
+        if (self.loop_frame is not None):
+            tokens.append(PSGToken.TAG_LOOP,bytes([0b01001110,0xff,0xff,0,0]))
+        else:
+            tokens.append(PSGToken.TAG_EOF,bytes([0b00000000,]))
+
+        self.tokens = tokens
+
+    #
+    # Append a regput or oneput of the registers in used like
+    # PASS1_outputFrames().
+    #
+
+    def PASS1_append_frame(self,tokens,used,regs):
+        if (self.oneput and (used & (used - 1) == 0)):
+            n = used.bit_length() - 1
+            tokens.append(PSGToken.TAG_ONEPUT,bytes([0b01000000|n,regs[n]]),regs[13])
+        else:
+            regput = bytes([0b11000000 | (used & 0x3f), used >> 6])
+            regput += bytes(regs[n] for n in range(self.NUMREGS) if (used & (1 << n)))
+            tokens.append(PSGToken.TAG_MULTIPUT,regput,regs[13])
+
+    #
+    # Loop detection for --loop. If the song ends
+    # with at least one full loop of LOOP_MIN or more frames repeated, the
+    # loop is the period whose repetition starts earliest and the song is
+    # cut after its first loop. Otherwise the whole song loops. The repeat
+    # of each period is the Z-function of the reversed frames. Returns the
+    # loop frame and the end of the song.
+    #
+
+    LOOP_MIN = 256
+
+    def PASS1_find_loop(self,states):
+        ids = {}
+        frames = [ids.setdefault(state,ids.__len__()) for state in reversed(states)]
+        size = frames.__len__()
+        repeat_length = [0] * size
+        left = right = 0
+
+        for n in range(1,size):
+            length = min(right - n,repeat_length[n-left]) if (n < right) else 0
+
+            while (n + length < size and frames[length] == frames[n+length]):
+                length += 1
+
+            if (n + length > right):
+                left,right = n,n + length
+
+            repeat_length[n] = length
+
+        best = (0,size)
+
+        for period in range(self.LOOP_MIN,size):
+            length = repeat_length[period]
+
+            # A loop of one register state is silence, not a loop
+            if (length >= period and size - length < best[1] and
+                    frames[length:length+period].count(frames[length]) < period):
+                best = (size - length - period,size - length)
+
+        return best
+
+    # A multi LZ run from current_head may start at but not cover a resync point
+    def PASS3_resync_limit(self,current_head,match_count,heads=None):
+        if (heads is None):
+            heads = self.resync_heads
+
+        n = bisect_right(heads,current_head)
+
+        if (n < heads.__len__() and heads[n] < current_head + match_count):
+            return heads[n] - current_head
+
+        return match_count
+
+    #
+    # Run PASS #1 to PASS #4 with the options given to the constructor.
+    # PASS #1 is skipped if the tokens are given. Returns the list of
+    # banks or None if the song cannot be packed, in which case the
+    # PSGError is in self.error for the caller to report.
+    #
+
+    def pack(self,tokens=None):
+        self.error = None
+
+        try:
+            return self.pack_passes(tokens)
+        except PSGError as error:
+            self.error = error
+            return None
+
+    def pack_passes(self,tokens):
+        self.pass_clock = time.perf_counter()
+
+        if (tokens is not None):
+            self.tokens = tokens
+        elif (not self.PASS1_tokenize()):
+            raise PSGFormatError("not a PSG file")
+
+        if (self.seek or self.loop_frame is not None):
+            self.PASS1_add_resync()
+            self.pass_done("PASS1")
+
+            if (self.verbose and self.seek):
+                sys.stderr.write(f"  {self.resync_heads.__len__()} resync points every {self.seek} frames, "
+                    f"PSG file length is {self.get_output_size()} bytes\n")
+
+            if (self.verbose and self.loop_frame is not None):
+                sys.stderr.write(f"  Loop from frame {self.loop_end} to frame {self.loop_frame}, "
+                    f"PSG file length is {self.get_output_size()} bytes\n")
 
         # PASS #2 - not implemented yet
 
-        if (args.cache):
-            if (args.verbose):
+        if (self.cache):
+            if (self.verbose):
                 sys.stderr.write("PASS #2 - cache lines\n")
 
-            if (psg.PASS2_build_cache()):
-                psg.PASS2_replace_with_cached()
+            if (self.PASS2_build_cache()):
+                self.PASS2_replace_with_cached()
 
-                if (args.verbose):
-                    sys.stderr.write(f"  PSG file length after PASS2 is {psg.get_output_size()} bytes\n")
+                if (self.verbose):
+                    sys.stderr.write(f"  PSG file length after PASS2 is {self.get_output_size()} bytes\n")
+
+            self.pass_done("PASS2")
         
         # PASS #3
 
-        if (args.lz):
-            if (args.verbose):
-                m = "enabled" if args.multi else "disabled"
+        if (self.lz):
+            if (self.verbose):
+                m = "enabled" if self.multi else "disabled"
                 sys.stderr.write(f"PASS #3 - LZ crunching with multiple matches {m}\n")
             
-            if (args.multi):
+            if (self.optimal):
+                # Shortest path parsing with or without multistep LZ
+                self.PASS3_lz_optimal(self.bankswitch,self.multi,self.depth)
+            elif (self.bankswitch):
+                # Greedy or cost-aware bank boundaries
+                self.PASS3_lz_banks()
+            elif (self.multi):
                 # Refined multistep LZ
-                psg.PASS3_lz_multi(args.bankswitch)
+                self.PASS3_lz_multi(self.bankswitch,self.depth)
             else:
                 # Legacy single shot LZ
-                psg.PASS3_lz_single(args.bankswitch)
+                self.PASS3_lz_single(self.bankswitch)
 
-            if (args.verbose):
-                sys.stderr.write(f"  PSG file length after PASS3 is {psg.get_output_size()} bytes\n")
+            if (self.verbose):
+                sys.stderr.write(f"  PSG file length after PASS3 is {self.get_output_size()} bytes\n")
 
         else:
             # Fake PASS #3 to add bank switching and alignment support
-            psg.PASS3_lz_null(args.bankswitch)
-        
-        # All passes for packing OK
-        original = io.read()
+            self.PASS3_lz_null(self.bankswitch)
 
-    # Did we manage to pack the PSG input file?
-    if (original == 0):
-        if (args.verbose):
-            sys.stderr.write("PASS #1-3 failure - unable to save output\n")
-        sys.exit(0)
+        self.pass_done("PASS3")
 
-    # PASS #4 - saving
+        # PASS #4
+        banks = self.PASS4_build_banks()
+        self.pass_done("PASS4")
 
-    output_temp = output_file
-    token_head = 0
+        if (banks.__len__() > self.max_banks):
+            raise PSGBankError(f"{banks.__len__()} banks of {self.bank_capacity} bytes are more than "
+                f"the {self.max_banks} available")
 
-    for files in range(psg.number_of_banks):
-        if (psg.number_of_banks > 1):
-            output_temp = output_file + chr(files+ord('0'))
-            sys.stderr.write(f"file {output_temp}\n")
+        # The loop token has only 16 bits for the offset
+        if (self.loop_offset > 0xffff):
+            raise PSGLoopError("The song does not fit in 64K, use --bankswitch with --loop-frame or --loop")
 
-        with PSGio(None,output_temp) as io:
-            if (args.verbose):
-                sys.stderr.write(f"PASS #4 - saving PSGPacker output #{files}\n")
+        if (self.max_cycles is not None and not self.song_heads):
+            profile = cycle_profile(banks,self.cached_tags.__len__() > 0,self.oneput,loop=self.loop_frame is not None)
+            over = [frame for frame in range(profile.__len__()) if (profile[frame] > self.max_cycles)]
 
-            # Write cached lines if any but only for bank 0..
-            if (args.cache and files == 0):
-                cached_lines = sorted(psg.cached_tags.items(),key=lambda x:x[1].cache_line)
-                for cached_tag,cached_token in cached_lines:
-                    io.putb(cached_tag.__len__())
-                        
-                    for n in range(cached_tag.__len__()):
-                        io.putb(cached_tag[n])
+            if (over.__len__() > 0):
+                worst = max(over,key=profile.__getitem__)
+                raise PSGCycleError(f"{over.__len__()} frames exceed {self.max_cycles} cycles, the worst "
+                    f"is {profile[worst]} cycles at frame {worst}")
 
-            # write packed tokens
-            while (token_head < psg.tokens.__len__()):
-                b = psg.tokens[token_head]
-                token_head += 1
-                
-                if (b is not None):
-                    for n in range(b.encoding.__len__()):
-                        io.putb(b.encoding[n])
-                    
-                    if (b.tag == PSGToken.TAG_BANKSWITCH):
+        return banks
+
+    #
+    # Statistics of the packed song for --stats. History offsets are
+    # counted in power of two buckets keyed by the bucket upper limit.
+    #
+
+    def get_stats(self,banks):
+        names = {v:k[4:].lower() for k,v in vars(PSGToken).items() if (k.startswith("TAG_"))}
+        tags = {}
+        single = {"count": 0, "offsets": {}}
+        multi = {"count": 0, "lengths": {}, "offsets": {}}
+        hits = {}
+        output = sum(bank.__len__() for bank in banks)
+
+        def add(histogram,key):
+            histogram[key] = histogram.get(key,0) + 1
+
+        for head in range(self.tokens.__len__()):
+            tag = self.tokens.tags[head]
+
+            if (tag == PSGToken.TAG_SKIPPED):
+                continue
+
+            encoding = self.tokens.encoding(head)
+            stats = tags.setdefault(names[tag],{"count": 0, "bytes": 0})
+            stats["count"] += 1
+            stats["bytes"] += encoding.__len__()
+
+            if (tag == PSGToken.TAG_SINGLELZ):
+                single["count"] += 1
+                add(single["offsets"],1 << (((encoding[0] & 0x3f) << 8) | encoding[1]).bit_length())
+            elif (tag == PSGToken.TAG_MULTILZ):
+                multi["count"] += 1
+                add(multi["lengths"],(encoding[0] & 0x3f) - 31)
+                add(multi["offsets"],1 << ((encoding[1] << 8) | encoding[2]).bit_length())
+            elif (tag == PSGToken.TAG_CACHED):
+                add(hits,encoding[0] & 0x0f)
+
+        if (self.bank_splits.__len__() > 0):
+            tags[names[PSGToken.TAG_BANKSWITCH]] = {"count": self.bank_splits.__len__(),
+                "bytes": 2 * self.bank_splits.__len__()}
+
+        for stats in tags.values():
+            stats["share"] = stats["bytes"] / output
+
+        for histogram in (single["offsets"],multi["lengths"],multi["offsets"]):
+            items = sorted(histogram.items())
+            histogram.clear()
+            histogram.update(items)
+
+        cache = []
+
+        for encoding,token in sorted(self.cached_tags.items(),key=lambda x:x[1].cache_line):
+            cache.append({"line": token.cache_line, "bytes": encoding.__len__(),
+                "instances": token.instances + 1, "hits": hits.get(token.cache_line,0)})
+
+        return {
+            "input": self.io.read(),
+            "output": output,
+            "header": self.header_size,
+            "passes": self.pass_stats,
+            "tags": tags,
+            "single_lz": single,
+            "multi_lz": multi,
+            "cache": cache,
+            "banks": [{"bank": n, "bytes": banks[n].__len__(), "fill": banks[n].__len__() / self.bank_capacity}
+                for n in range(banks.__len__())]
+        }
+
+#
+#
+#
+#
+
+class PSGCycles(object):
+    """PSGCycles(oneput=True,callback=124,loop=False) -> PSGCycles object
+
+    Z80 T-state cost model of the psgplayer.asm _next routine including
+    the CALL psgplayer+4. The tag costs are counted from _norestore up
+    to the final RET of _gettags. 'oneput' tells if the player was
+    assembled with USE_ONEPUT and 'callback' is the cost of the bank
+    switching callback, which defaults to the example callback. 'loop'
+    tells if the player was assembled with USE_LOOP, which adds to the
+    bankswitch cost.
+    """
+
+    IDLE = 99           # _next without a call to _gettags
+    GETTAGS = 106       # _next calling _gettags
+    REP_NONE = 26       # _smc_rep is zero
+    REP_NEXT = 46       # _smc_rep counts down
+    REP_RESTORE = 51    # _smc_rep reaches zero and _smc_resume is used
+    WAIT = 72
+    ONEPUT = 146
+    REGPUT = 385        # plus PER_REG for each register
+    SINGLELZ = 480      # plus PER_REG for each register
+    CACHED = 560        # plus PER_REG for each register
+    PER_REG = 14
+    MULTILZ = 178       # followed by the tag in the history
+    EOF = 454           # _stop2 followed by the callback
+
+    # _cnext of the --columns format counted the same way from the design
+    # of a column player, which is not in psgplayer.asm until it has been
+    # run on a Z80
+    COL_FRAME = 135         # _cnext without the streams
+    COL_STREAM = 63         # count low byte does not reach zero
+    COL_HIGH = 91           # count high byte steps
+    COL_TOKEN = 98          # count reaches zero and _ctoken is called
+    COL_LITERAL_NEXT = 260  # next value of a literal
+    COL_FETCH = 133         # next token without a replay
+    COL_FETCH_REP = 159     # next token of a replay
+    COL_FETCH_RESUME = 192  # replay ends and the stream resumes
+    COL_HOLD = 178          # 00 nnnnnn
+    COL_LONG = 199          # 00 000000 lo hi
+    COL_LITERAL = 207       # 01 nnnnnn
+    COL_REPLAY = 166        # 1 nnnnnnn followed by the replayed token
+    COL_VALUES = 54         # _cvalue plus COL_VALUE for each register
+    COL_VALUE = 101
+    COL_R13 = 144           # R13 changes
+    COL_R13_SAME = 82       # R13 unchanged is not written
+    COL_EOF = 589           # _stop2, the callback and _cinit
+    COL_INIT = 289          # _cinit for each stream
+
+    def __init__(self,oneput=True,callback=124,loop=False):
+        self.bankswitch = (155 if (oneput) else 136) + callback + (11 if (loop) else 0)
+        self.loop = 225 if (oneput) else 206
+        self.loop_bank = (292 if (oneput) else 273) + callback
+        self.eof = self.EOF + callback
+        self.column_eof = self.COL_EOF + callback
+
+#
+#
+#
+#
+
+class PSGDepacker(object):
+    """PSGDepacker(banks,cache=False) -> PSGDepacker object
+
+    Reference depacker for the PSGPacker output. The banks are replayed
+    the same way psgplayer.asm does and depack() returns the AY register
+    state after each frame, 14 bytes per frame. 'cache' must be True if
+    the bank 0 starts with the cached lines i.e. the player would be
+    assembled with USE_CACHE set to 1. If a PSGCycles model is given
+    the _next cost of each frame is collected into self.profile. The
+    last entry of the profile is the frame that restarts the song.
+
+    For a pack_songs() soundtrack 'dictionary' is located right before
+    the bank window and 'entry' is the (bank,offset) of the song from the
+    song directory. 'entry' may also be a --seek resync point
+    (bank,offset,r13). Both offsets are after the cached lines in the
+    bank 0 and r13 seeds R13 unless it is $ff.
+    depack(max_frames) stops after max_frames frames and follows the
+    loop token of a --loop-frame song, depack() stops at the loop token
+    like at the EOF.
+    """
+
+    NUMREGS = 14
+
+    def __init__(self,banks,cache=False,cycles=None,dictionary=b"",entry=(0,0)):
+        self.base = dictionary.__len__()
+        self.banks = [dictionary + bank for bank in banks]
+        self.cached_lines = [None]
+        self.bank,self.offset = entry[:2]
+        self.r13 = entry[2] if (entry.__len__() > 2) else 0xff
+        self.start = 0
+        self.cycles = cycles
+        self.profile = array("I")
+
+        if (cache):
+            table = banks[0]
+            pos = 0
+
+            for n in range(15):
+                length = table[pos]
+                self.cached_lines.append(table[pos+1:pos+1+length])
+                pos += (length + 1)
+
+            self.start = pos
+
+    #
+    # TAG 11 llllll hhhhhhhh -> regs 0 to 13
+    #
+
+    def regput(self,mem,pos,regs):
+        used = (mem[pos] & 0x3f) | (mem[pos+1] << 6)
+        pos += 2
+
+        for n in range(self.NUMREGS):
+            if (used & 0x0001):
+                regs[n] = mem[pos]
+                pos += 1
+
+            used >>= 1
+
+        return pos
+
+    def depack(self,max_frames=None):
+        regs = bytearray(self.NUMREGS)
+        states = bytearray()
+        limit = max_frames * self.NUMREGS if (max_frames is not None) else None
+        bank = self.bank
+        mem = self.banks[bank]
+        pos = self.base + self.offset + (self.start if (bank == 0) else 0)
+        rep = 0
+        resume = 0
+        looped = False
+        c = self.cycles
+
+        if (c is None):
+            c = PSGCycles()
+
+        # _seek puts R13 into _regbuf
+        if (self.r13 != 0xff):
+            regs[13] = self.r13
+
+        try:
+            while (True):
+                # One call to _gettags
+                cost = c.GETTAGS + c.REP_NONE
+
+                if (rep > 0):
+                    rep -= 1
+                    cost = c.GETTAGS + c.REP_NEXT
+
+                    if (rep == 0):
+                        pos = resume
+                        cost = c.GETTAGS + c.REP_RESTORE
+
+                while (True):
+                    tag = mem[pos]
+
+                    if (tag == 0):
+                        # TAG 00 000000
+                        if (self.cycles is not None):
+                            self.profile.append(cost + c.eof)
+
+                        return states
+
+                    if (tag >= 0b11000000):
+                        # TAG 11 llllll hhhhhhhh
+                        end = self.regput(mem,pos,regs)
+                        cost += c.REGPUT + c.PER_REG * (end - pos - 2)
+                        pos = end
+                        frames = 1
+                        break
+
+                    pos += 1
+
+                    if (tag < 0b01000000):
+                        # TAG 00 nnnnnn
+                        cost += c.WAIT
+                        frames = tag
                         break
 
+                    if (tag >= 0b10000000):
+                        # TAG 10 nnnnnn nnnnnnnn
+                        source = pos + 1 - (((tag & 0x3f) << 8) | mem[pos])
+                        pos += 1
+
+                        if (rep > 0 or source < 0 or mem[source] < 0b11000000):
+                            raise ValueError(f"Invalid single LZ at bank {bank} offset {pos-2}")
+
+                        end = self.regput(mem,source,regs)
+                        cost += c.SINGLELZ + c.PER_REG * (end - source - 2)
+                        frames = 1
+                        break
+
+                    tag &= 0x3f
+
+                    if (tag >= 32):
+                        # TAG 01 rrrrrr nnnnnnnn nnnnnnnn
+                        if (rep > 0):
+                            raise ValueError(f"Recursive multi LZ at bank {bank} offset {pos-1}")
+
+                        rep = tag - 31
+                        resume = pos + 2
+                        pos = resume - ((mem[pos] << 8) | mem[pos+1]) - 1
+
+                        if (pos < 0):
+                            raise ValueError(f"Invalid multi LZ at bank {bank} offset {resume-3}")
+
+                        cost += c.MULTILZ
+                        continue
+
+                    if (tag >= 16):
+                        # TAG 01 01llll
+                        if (self.cached_lines.__len__() < 16 or tag == 16):
+                            raise ValueError(f"Invalid cached line at bank {bank} offset {pos-1}")
+
+                        line = self.cached_lines[tag-16]
+                        end = self.regput(line,0,regs)
+                        cost += c.CACHED + c.PER_REG * (end - 2)
+                        frames = 1
+                        break
+
+                    if (tag == 14):
+                        # TAG 01 001110 rrrrrrrr bbbbbbbb hhhhhhhh llllllll
+                        if (rep > 0):
+                            raise ValueError(f"Loop inside multi LZ at bank {bank} offset {pos-1}")
+
+                        if (mem[pos] != 0xff):
+                            regs[13] = mem[pos]
+
+                        offset = (mem[pos+2] << 8) | mem[pos+3]
+
+                        if (mem[pos+1] == 0xff):
+                            pos += 3 - offset
+                            cost += c.loop
+                        else:
+                            bank = mem[pos+1]
+                            mem = self.banks[bank]
+                            pos = self.base + offset + (self.start if (bank == 0) else 0)
+                            cost += c.loop_bank
+
+                        if (pos < 0):
+                            raise ValueError(f"Invalid loop at bank {bank}")
+
+                        # Without max_frames only the frame that restarts the song
+                        looped = limit is None
+                        continue
+
+                    if (tag == 15):
+                        # TAG 01 001111 bbbbbbbb
+                        if (rep > 0):
+                            raise ValueError(f"Bankswitch inside multi LZ at bank {bank} offset {pos-1}")
+
+                        bank = mem[pos]
+                        mem = self.banks[bank]
+                        pos = self.base + (self.start if (bank == 0) else 0)
+                        cost += c.bankswitch
+                        continue
+
+                    # TAG 01 00nnnn [8]
+                    regs[tag] = mem[pos]
+                    pos += 1
+                    cost += c.ONEPUT
+                    frames = 1
+                    break
+
+                if (looped):
+                    if (self.cycles is not None):
+                        self.profile.append(cost)
+
+                    return states
+
+                states += regs * frames
+
+                if (self.cycles is not None):
+                    self.profile.append(cost)
+                    self.profile.extend(repeat(c.IDLE,frames-1))
+
+                if (limit is not None and states.__len__() >= limit):
+                    return states[:limit]
+
+        except IndexError:
+            raise ValueError(f"Premature end of bank {bank}")
+
+#
+#
+#
+#
+
+class PSGColumns(object):
+    """PSGColumns(states,layout="reg",depth=16) -> PSGColumns object
+
+    Experimental column format of --columns. The AY register states of
+    psg_frames() are split into one stream per register ('reg') or per
+    channel ('channel') and each stream is packed on its own with its
+    own PSGMatchFinder. A stream is a run of tokens that each give the
+    value v of the stream, one byte per register, for one or more frames:
+
+      00 nnnnnn v           v for n frames, n = 1 to 63
+      00 000000 lo hi v     v for n frames, lo = n & 255 and
+                            hi = (n - 1) // 256 + 1 i.e. in djnz loop form
+      01 nnnnnn v ... v     n+1 frames with a value each
+      1 nnnnnnn hi lo       replay n+1 earlier tokens, which start at
+                            hi*256+lo-2 bytes before this token
+
+    pack() returns the module: the number of streams, the little endian
+    number of frames and for each stream the number of registers, the
+    registers and the little endian offset of the stream from the module
+    start, followed by the streams. Registers that stay zero over the
+    entire song have no stream. psgplayer.asm cannot play the module
+    yet.
+    """
+
+    LAYOUTS = {
+        "reg": [[reg] for reg in range(14)],
+        "channel": [[0,1,8],[2,3,9],[4,5,10],[6],[7],[11,12],[13]]
+    }
+
+    MAX_HOLD = 255 * 256
+    MAX_LITERAL = 64
+    MAX_REPLAY = 128
+    ROUNDS = (64,16,4)
+
+    def __init__(self,states,layout="reg",depth=16):
+        self.states = states
+        self.frames = states.__len__() // PSGCompressor.NUMREGS
+        self.groups = self.LAYOUTS[layout]
+        self.depth = depth
+        self.streams = []
+        self.replays = 0
+        self.literals = 0
+
+    def values(self,regs):
+        columns = [self.states[reg::PSGCompressor.NUMREGS] for reg in regs]
+        return [bytes(value) for value in zip(*columns)]
+
+    #
+    # Every run of equal values is a hold token.
+    #
+
+    def tokenize(self,values):
+        tokens = []
+
+        for value,run in groupby(values):
+            run = sum(1 for frame in run)
+
+            while (run > 0):
+                frames = min(run,self.MAX_HOLD)
+
+                if (frames < 64):
+                    tokens.append(bytes([frames]) + value)
+                else:
+                    tokens.append(bytes([0,frames & 0xff,(frames - 1) // 256 + 1]) + value)
+
+                run -= frames
+
+        return tokens
+
+    #
+    # Greedy replays of earlier hold tokens like PASS3_lz_multi() in
+    # rounds of decreasing minimum match length. A replay cannot refer
+    # to another replay, so the long repeats are taken first and the
+    # tokens they replay are pinned so that the shorter matches of the
+    # later rounds do not cover them. Then single frame holds are merged
+    # into literals. A literal never straddles the start or the end of
+    # a replayed run, so the replays only need their token counts and
+    # offsets recalculated.
+    #
+
+    def pack_stream(self,values):
+        tokens = self.tokenize(values)
+        sizes = [token.__len__() for token in tokens]
+        history_ok = [True] * tokens.__len__()
+        current_ok = [True] * tokens.__len__()
+        replays = {}
+
+        for minimum in self.ROUNDS:
+            finder = PSGMatchFinder(self.depth,self.MAX_REPLAY)
+            encoded_pos = 0
+            head = 0
+
+            while (head < tokens.__len__()):
+                if (head in replays):
+                    encoded_pos += 3
+                    head += replays[head][1]
+                    continue
+
+                if (current_ok[head]):
+                    count,length,history_head,history_pos = \
+                        finder.find(tokens,sizes,head,encoded_pos,65535,history_ok,current_ok)
+
+                    if (length >= minimum):
+                        replays[head] = (history_head,count)
+
+                        for covered in range(head,head+count):
+                            history_ok[covered] = current_ok[covered] = False
+
+                        for pinned in range(history_head,history_head+count):
+                            current_ok[pinned] = False
+
+                        encoded_pos += 3
+                        head += count
+                        continue
+
+                finder.insert(tokens[head],head,encoded_pos)
+                encoded_pos += sizes[head]
+                head += 1
+
+        items = []
+        head = 0
+
+        while (head < tokens.__len__()):
+            if (head in replays):
+                items.append(("replay",) + replays[head])
+                head += replays[head][1]
+            else:
+                items.append(("hold",head,1))
+                head += 1
+
+        cuts = set()
+
+        for kind,head,count in items:
+            if (kind == "replay"):
+                cuts.add(head)
+                cuts.add(head + count)
+
+        merged = []
+
+        for kind,head,count in items:
+            if (kind == "hold" and tokens[head][0] == 1 and head not in cuts and merged and
+                merged[-1][0] == "literal" and merged[-1][2] < self.MAX_LITERAL):
+                merged[-1][2] += 1
+            elif (kind == "hold" and tokens[head][0] == 1):
+                merged.append(["literal",head,1])
+            else:
+                merged.append([kind,head,count])
+
+        stream = bytearray()
+        index = {}
+        starts = []
+
+        for kind,head,count in merged:
+            if (kind == "replay"):
+                first = index[head]
+                last = index[head + count - 1] + 1
+                offset = stream.__len__() + 2 - starts[first]
+                starts.append(stream.__len__())
+                stream += bytes([0x80 | (last - first - 1),offset >> 8,offset & 0xff])
+                self.replays += 1
+                continue
+
+            for covered in range(head,head+count):
+                index[covered] = starts.__len__()
+
+            starts.append(stream.__len__())
+
+            if (count == 1):
+                stream += tokens[head]
+            else:
+                stream.append(0x40 | (count - 1))
+
+                for covered in range(head,head+count):
+                    stream += tokens[covered][1:]
+
+                self.literals += 1
+
+        return bytes(stream)
+
+    def pack(self):
+        if (self.frames > 0xffff):
+            raise ValueError(f"{self.frames} frames do not fit in the column format")
+
+        self.streams = []
+
+        for regs in self.groups:
+            if (any(any(self.states[reg::PSGCompressor.NUMREGS]) for reg in regs)):
+                self.streams.append((regs,self.pack_stream(self.values(regs))))
+
+        if (not self.streams):
+            # The player needs at least one stream
+            self.streams.append((self.groups[0],self.pack_stream(self.values(self.groups[0]))))
+
+        module = bytearray([self.streams.__len__()]) + self.frames.to_bytes(2,byteorder="little")
+        offset = module.__len__() + sum(regs.__len__() + 3 for regs,stream in self.streams)
+
+        for regs,stream in self.streams:
+            module += bytes([regs.__len__()] + regs) + (offset & 0xffff).to_bytes(2,byteorder="little")
+            offset += stream.__len__()
+
+        if (offset > 0xffff):
+            raise ValueError(f"{offset} bytes do not fit in the column format")
+
+        return bytes(module) + b"".join(stream for regs,stream in self.streams)
+
+class PSGColumnDepacker(object):
+    """PSGColumnDepacker(module,cycles=None) -> PSGColumnDepacker object
+
+    Reference depacker for the PSGColumns module. depack() replays the
+    streams the way the _cnext of a column player would and returns the
+    AY register state after each frame like PSGDepacker. If a PSGCycles
+    model is given the _next cost of each frame is collected into
+    self.profile. The last entry of the profile is the frame that
+    restarts the song.
+    """
+
+    def __init__(self,module,cycles=None):
+        self.module = module
+        self.cycles = cycles
+        self.profile = array("I")
+
+    def value(self,mem,pos,stream_regs,regs,c):
+        cost = c.COL_VALUES
+
+        for reg in stream_regs:
+            if (reg == 13):
+                cost += c.COL_R13 if (regs[13] != mem[pos]) else c.COL_R13_SAME
+            else:
+                cost += c.COL_VALUE
+
+            regs[reg] = mem[pos]
+            pos += 1
+
+        return pos,cost
+
+    #
+    # _ctoken for a stream of [registers,count low,count high,literal
+    # values left,position,replay tokens left,resume position].
+    #
+
+    def token(self,mem,stream,regs,c):
+        if (stream[3] > 0):
+            stream[3] -= 1
+            stream[4],cost = self.value(mem,stream[4],stream[0],regs,c)
+            stream[1] = stream[2] = 1
+            return cost + c.COL_LITERAL_NEXT
+
+        pos = stream[4]
+        cost = c.COL_FETCH
+
+        if (stream[5] > 0):
+            stream[5] -= 1
+            cost = c.COL_FETCH_REP
+
+            if (stream[5] == 0):
+                pos = stream[6]
+                cost = c.COL_FETCH_RESUME
+
+        tag = mem[pos]
+        pos += 1
+
+        if (tag >= 0b10000000):
+            # TAG 1 nnnnnnn hhhhhhhh llllllll
+            if (stream[5] > 0):
+                raise ValueError(f"Recursive replay at offset {pos-1}")
+
+            stream[5] = (tag & 0x7f) + 1
+            stream[6] = pos + 2
+            pos = pos + 1 - ((mem[pos] << 8) | mem[pos+1])
+
+            if (pos < 0 or mem[pos] >= 0b10000000):
+                raise ValueError(f"Invalid replay at offset {stream[6]-3}")
+
+            cost += c.COL_REPLAY
+            tag = mem[pos]
+            pos += 1
+
+        if (tag >= 0b01000000):
+            # TAG 01 nnnnnn
+            stream[1] = stream[2] = 1
+            stream[3] = tag & 0x3f
+            cost += c.COL_LITERAL
+        elif (tag == 0):
+            # TAG 00 000000 llllllll hhhhhhhh
+            stream[1] = mem[pos]
+            stream[2] = mem[pos+1]
+            pos += 2
+            cost += c.COL_LONG
+        else:
+            # TAG 00 nnnnnn
+            stream[1] = tag
+            stream[2] = 1
+            cost += c.COL_HOLD
+
+        stream[4],value_cost = self.value(mem,pos,stream[0],regs,c)
+        return cost + value_cost
+
+    def depack(self):
+        mem = self.module
+        regs = bytearray(PSGCompressor.NUMREGS)
+        states = bytearray()
+        streams = []
+        c = self.cycles
+
+        if (c is None):
+            c = PSGCycles()
+
+        try:
+            frames = mem[1] | (mem[2] << 8)
+            pos = 3
+
+            for n in range(mem[0]):
+                stream_regs = mem[pos+1:pos+1+mem[pos]]
+                pos += mem[pos] + 1
+
+                if (max(stream_regs,default=0) >= PSGCompressor.NUMREGS):
+                    raise ValueError(f"Invalid register in stream {n}")
+
+                streams.append([stream_regs,1,1,0,mem[pos] | (mem[pos+1] << 8),0,0])
+                pos += 2
+
+            for frame in range(frames):
+                cost = c.COL_FRAME
+
+                for stream in streams:
+                    stream[1] = (stream[1] - 1) & 0xff
+
+                    if (stream[1] != 0):
+                        cost += c.COL_STREAM
+                        continue
+
+                    stream[2] = (stream[2] - 1) & 0xff
+
+                    if (stream[2] != 0):
+                        cost += c.COL_HIGH
+                        continue
+
+                    cost += c.COL_TOKEN + self.token(mem,stream,regs,c)
+
+                states += regs
+
+                if (self.cycles is not None):
+                    self.profile.append(cost)
+
+        except IndexError:
+            raise ValueError("Premature end of the module")
+
+        if (self.cycles is not None):
+            self.profile.append(c.column_eof + c.COL_INIT * streams.__len__())
+
+        return states
+
+#
+#
+#
+#
+
+#
+# Remove a regular file that has other hard links, e.g. an output file
+# linked to an --output-cache entry by --output-cache-link, so that
+# writing the file does not change the other links.
+#
+
+def unlink_shared(name):
+    try:
+        st = os.stat(name)
+    except OSError:
+        return
+
+    if (stat.S_ISREG(st.st_mode) and st.st_nlink > 1):
+        os.remove(name)
+
+def save_bank(output_temp,bank):
+    if (isinstance(output_temp,str) and output_temp != ""):
+        unlink_shared(output_temp)
+
+    with PSGio(None,output_temp) as io:
+        io.putbuf(bank)
+
+#
+# PSGCompressor keyword options taken from the parsed command line.
+#
+
+def compressor_options(args):
+    options = ("verbose","debug","lz","multi","oneput","cache","bankswitch","optimal","numpy","depth","sample",
+        "max_cycles","token_cache","token_cache_size","bank_capacity","max_banks","seek","loop_frame")
+    return {option:getattr(args,option) for option in options if hasattr(args,option)}
+
+def compress(data,*,lz=False,multi=False,oneput=False,cache=False,bankswitch=False,
+        optimal=False,numpy=False,depth=16,max_cycles=None,verify=False,bank_capacity=16384,max_banks=255,
+        loop_frame=None):
+    """compress(data,...) -> list of bytes
+
+    Packs the PSG file content in data and returns the packed banks.
+    The keyword options match the command line options, loop_frame=-1
+    detects the loop. There is more than one bank only if bankswitch is
+    True. Raises PSGFormatError if data is not a PSG file, PSGBankError
+    if the song needs more than max_banks banks, PSGLoopError if the
+    loop frame is past the end of the song or if the song does not fit
+    in 64K with loop_frame but without bankswitch, PSGCycleError if
+    some frames still take more than max_cycles cycles and ValueError
+    if the verification fails.
+    """
+    with PSGio(data,None) as io:
+        psg = PSGCompressor(io,lz=lz,multi=multi,oneput=oneput,cache=cache,
+            bankswitch=bankswitch,optimal=optimal,numpy=numpy,depth=depth,max_cycles=max_cycles,
+            bank_capacity=bank_capacity,max_banks=max_banks,loop_frame=loop_frame)
+        banks = psg.pack()
+
+    if (banks is None):
+        raise psg.error
+
+    if (verify):
+        frame = verify_banks(data,banks,psg.cached_tags.__len__() > 0,psg_loop(psg))
+
+        if (frame >= 0):
+            raise ValueError(f"verification failed at frame {frame}")
+
+    return banks
+
+#
+# The AY register state after each frame of a PSG file, 14 bytes per
+# frame, the way PASS #1 tokenizes it: register writes that do not
+# change anything are ignored, one leading frame without changes is
+# folded away and trailing writes without a frame end still make up
+# a frame.
+#
+
+def psg_frames(data):
+    buf = memoryview(data)
+    end = buf.__len__()
+    regs = bytearray(PSGCompressor.NUMREGS)
+    state = bytes(regs)
+    states = bytearray()
+    pending = 0
+    changed = False
+    first = True
+    pos = 16
+
+    if (buf[0:4] != b"PSG\x1a"):
+        raise ValueError("not a PSG file")
+
+    while (pos < end):
+        t = buf[pos]
+        pos += 1
+
+        if (t == 0xfd):
+            break
+
+        if (t == 0xff or t == 0xfe):
+            frames = 1
+
+            if (t == 0xfe):
+                frames = 4 * buf[pos]
+                pos += 1
+
+            if (changed):
+                state = bytes(regs)
+                pending = 0
+                changed = False
+
+            pending += frames
+            continue
+
+        if (t >= 16):
+            raise NotImplementedError("Outing to MSX devices")
+
+        if (regs[t] != buf[pos]):
+            if (not changed):
+                states += state * (max(pending-1,0) if (first) else max(pending,1))
+                changed = True
+                first = False
+
+            regs[t] = buf[pos]
+
+        pos += 1
+
+    if (changed):
+        # Trailing writes without a frame end
+        state = bytes(regs)
+        pending = 0
+
+    states += state * (max(pending-1,0) if (first) else max(pending,1))
+    return states
+
+#
+# Depack the banks and compare the frames against psg_frames(data).
+# Returns the first mismatching frame or -1 if all frames match.
+#
+
+def verify_banks(data,banks,cache=False,loop=None):
+    if (loop is None):
+        return verify_states(data,PSGDepacker(banks,cache).depack())
+
+    # The song is played once more from the loop frame
+    expected = loop_frames(data,loop,loop[1] - loop[0])
+    depacker = PSGDepacker(banks,cache)
+    return verify_states(data,depacker.depack(expected.__len__() // PSGCompressor.NUMREGS),expected)
+
+def verify_states(data,states,expected=None):
+    if (expected is None):
+        expected = psg_frames(data)
+
+    if (states == expected):
+        return -1
+
+    for frame in range(0,min(states.__len__(),expected.__len__()),PSGCompressor.NUMREGS):
+        if (states[frame:frame+PSGCompressor.NUMREGS] != expected[frame:frame+PSGCompressor.NUMREGS]):
+            return frame // PSGCompressor.NUMREGS
+
+    return min(states.__len__(),expected.__len__()) // PSGCompressor.NUMREGS
+
+#
+# The frames of a --loop-frame song, whose loop is the tuple of the loop
+# frame and the end of the song, played extra frames past its end.
+#
+
+def loop_frames(data,loop,extra):
+    loop_frame,loop_end = loop
+    states = psg_frames(data)[:loop_end*PSGCompressor.NUMREGS]
+    body = states[loop_frame*PSGCompressor.NUMREGS:]
+
+    while (extra > 0):
+        states += body[:extra*PSGCompressor.NUMREGS]
+        extra -= loop_end - loop_frame
+
+    return states
+
+# The loop tuple of a packed song or None without --loop-frame
+def psg_loop(psg):
+    return (psg.loop_frame,psg.loop_end) if (psg.loop_frame is not None) else None
+
+#
+# Depack from each --seek resync point up to the next one and compare the
+# frames. Returns the first resync point that fails or -1 if all match.
+#
+
+def verify_resync(data,banks,cache,entries,seek,loop=None):
+    expected = psg_frames(data) if (loop is None) else loop_frames(data,loop,seek)
+    size = seek * PSGCompressor.NUMREGS
+
+    for n in range(entries.__len__()):
+        states = PSGDepacker(banks,cache,entry=entries[n]).depack(seek)
+
+        if (states != expected[n*size:(n+1)*size]):
+            return n
+
+    return -1
+
+#
+# The --seek index: the little endian number of frames between the resync
+# points followed by 4 octets per resync point, the bank, the little
+# endian offset from the song start in the bank and the last R13 before
+# the resync point or $ff if there is none. The resync point n is at the
+# frame n times the number of frames.
+#
+
+def seek_index(seek,entries):
+    index = bytearray(seek.to_bytes(2,byteorder="little"))
+
+    for bank,offset,r13 in entries:
+        index += bytes([bank]) + offset.to_bytes(2,byteorder="little") + bytes([r13])
+
+    return bytes(index)
+
+#
+# Save --stats as JSON into a file or to stderr if name is '-'.
+#
+
+def save_stats(name,stats):
+    if (name == "-"):
+        json.dump(stats,sys.stderr,indent=1)
+        sys.stderr.write("\n")
+    else:
+        with open(name,"w") as f:
+            json.dump(stats,f,indent=1)
+
+#
+# Per frame _next cycle profile of the banks.
+#
+
+def cycle_profile(banks,cache=False,oneput=True,callback=124,loop=False):
+    depacker = PSGDepacker(banks,cache,PSGCycles(oneput,callback,loop))
+    depacker.depack()
+    return depacker.profile
+
+#
+# Save the profile, its worst case and a histogram of 50 cycle wide
+# buckets as JSON or as CSV rows of kind,key,value if the file name
+# ends with .csv. Returns the worst case frame.
+#
+
+def save_profile(name,profile,bucket=50):
+    worst = max(range(profile.__len__()),key=profile.__getitem__)
+    histogram = {}
+
+    for cycles in profile:
+        histogram[cycles - cycles % bucket] = histogram.get(cycles - cycles % bucket,0) + 1
+
+    histogram = sorted(histogram.items())
+
+    with open(name,"w",newline="") as f:
+        if (name.lower().endswith(".csv")):
+            w = csv.writer(f)
+            w.writerow(["kind","key","value"])
+            w.writerow(["worst",worst,profile[worst]])
+            w.writerows(["histogram",cycles,frames] for cycles,frames in histogram)
+            w.writerows(["frame",frame,cycles] for frame,cycles in enumerate(profile))
+        else:
+            json.dump({
+                "frames": profile.__len__(),
+                "worst": {"frame": worst, "cycles": profile[worst]},
+                "average": sum(profile) / profile.__len__(),
+                "bucket": bucket,
+                "histogram": [{"cycles": cycles, "frames": frames} for cycles,frames in histogram],
+                "profile": profile.tolist()
+            },f)
+
+    return worst
+
+#
+# --auto packs the song with every valid --lz/--multi/--oneput/--cache
+# combination and keeps the best one for the objective. PASS #1 is run
+# once and the candidates are packed from copies of its tokens on a
+# process pool, or one by one if this already is a --batch worker. The
+# other options are taken from args.
+#
+
+AUTO_FLAGS = {"lz": "-z", "multi": "-m", "oneput": "-o", "cache": "-c"}
+
+def auto_options():
+    return [{"lz": lz, "multi": multi, "oneput": oneput, "cache": cache}
+        for lz,multi,oneput,cache in product((False,True),repeat=4) if (lz or not multi)]
+
+def auto_name(options):
+    name = " ".join(flag for option,flag in AUTO_FLAGS.items() if (options[option]))
+    return name if (name) else "no options"
+
+def auto_key(objective,size,num_banks,worst):
+    if (objective == "banks"):
+        return (num_banks,size,worst)
+    if (objective == "cycles"):
+        return (worst,size,num_banks)
+
+    return (size,num_banks,worst)
+
+def auto_candidate(tokens,options,cycles=False):
+    psg = PSGCompressor(None,**options)
+    banks = psg.pack(tokens.copy())
+    worst = 0
+
+    if (cycles and banks is not None):
+        worst = max(cycle_profile(banks,psg.cached_tags.__len__() > 0,psg.oneput,loop=psg.loop_frame is not None))
+
+    return psg,banks,worst
+
+def pack_auto(io,args):
+    options = compressor_options(args)
+    options.update(verbose=False,debug=False,oneput=False)
+
+    psg = PSGCompressor(io,**options)
+    psg.pass_clock = time.perf_counter()
+
+    if (not psg.PASS1_tokenize()):
+        sys.stderr.write("not a PSG file\n")
+        return None,None
+
+    tokens = {False: psg.tokens, True: psg.PASS1_with_oneput(psg.tokens)}
+    candidates = [dict(options,**combination) for combination in auto_options()]
+    cycles = args.auto == "cycles"
+    inputs = [tokens[candidate["oneput"]] for candidate in candidates]
+
+    if (multiprocessing.parent_process() is None):
+        with ProcessPoolExecutor() as executor:
+            results = list(executor.map(auto_candidate,inputs,candidates,repeat(cycles)))
+    else:
+        results = list(map(auto_candidate,inputs,candidates,repeat(cycles)))
+
+    keys = []
+
+    for candidate,(packed,banks,worst) in zip(candidates,results):
+        if (banks is None):
+            keys.append((float("inf"),))
+            continue
+
+        size = sum(bank.__len__() for bank in banks)
+        keys.append(auto_key(args.auto,size,banks.__len__(),worst))
+
+        if (args.verbose):
+            sys.stderr.write(f"  {auto_name(candidate):12s} {size:7d} bytes in {banks.__len__()} bank(s)" +
+                (f", worst _next {worst} cycles\n" if (cycles) else "\n"))
+
+    best = min(range(keys.__len__()),key=keys.__getitem__)
+    winner,banks,worst = results[best]
+
+    # Every candidate failed, e.g. some on --banks and others on --max-cycles
+    if (banks is None):
+        sys.stderr.write("auto: no candidate could be packed\n")
+
+        for candidate,(packed,banks,worst) in zip(candidates,results):
+            sys.stderr.write(f"  {auto_name(candidate):12s} {packed.error}\n")
+
+        return None,None
+
+    winner.io = io
+    winner.verbose = args.verbose
+    winner.debug = args.debug
+    winner.pass_stats = dict(psg.pass_stats,**winner.pass_stats)
+
+    sys.stderr.write(f"auto: {auto_name(candidates[best])} for {args.auto}, "
+        f"{sum(bank.__len__() for bank in banks)} bytes in {banks.__len__()} bank(s)\n")
+    sys.stderr.write(f"USE_CACHE   equ {int(winner.cached_tags.__len__() > 0)}\n")
+    sys.stderr.write(f"USE_ONEPUT  equ {int(winner.oneput)}\n")
+
+    return winner,banks
+
+#
+# --songs packs several PSG files into one soundtrack. The PASS #1 tokens
+# of the songs are concatenated into one token stream so that the songs
+# share one cache table and the banks, and later songs can use history
+# references into earlier songs within the same bank. With --bankswitch
+# and --multi the register writes that would be output as is in more than
+# one bank are also collected into a dictionary, which is loaded right
+# before the bank window and can be referenced from every bank. The
+# dictionary is only used if it makes the soundtrack smaller.
+#
+# The outputs are the banks, the bank 0 starting with the cache lines as
+# usual, name.dict with the dictionary and name.dir with 3 octets per
+# song: the bank and the little endian offset of the song like in the
+# seek index, so that _seek starts a song.
+#
+
+def pack_soundtrack(songs,dictionary,options):
+    psg = PSGCompressor(None,**options)
+    tokens = PSGTokenStore()
+
+    if (dictionary):
+        for encoding in dictionary:
+            tokens.append(PSGToken.TAG_MULTIPUT,encoding)
+
+        tokens.append(PSGToken.TAG_SKIPPED,b"")
+        psg.dictionary_heads = tokens.__len__()
+        psg.dictionary_size = tokens.output_size
+
+    for song in songs:
+        psg.song_heads.append(tokens.__len__())
+        tokens.extend(song)
+
+    banks = psg.pack(tokens)
+    return psg,banks
+
+#
+# Register writes output as is in more than one bank in the order they
+# first appear, which keeps runs of them together, up to max_size bytes.
+#
+
+def soundtrack_dictionary(psg,max_size):
+    tags = psg.tokens.tags
+    sizes = psg.tokens.sizes
+    token_ids = psg.tokens.token_ids
+    raw = []
+    banks = {}
+    bank = 0
+    splits = psg.bank_splits + [psg.tokens.__len__()]
+
+    for head in range(psg.tokens.__len__()):
+        if (head > splits[bank]):
+            bank += 1
+
+        if (tags[head] == PSGToken.TAG_MULTIPUT and sizes[head] >= 4):
+            banks.setdefault(token_ids[head],set()).add(bank)
+            raw.append(head)
+
+    dictionary = []
+    seen = set()
+    size = 0
+
+    for head in raw:
+        token_id = token_ids[head]
+
+        if (banks[token_id].__len__() > 1 and token_id not in seen and size + sizes[head] <= max_size):
+            dictionary.append(psg.tokens.encodings[token_id])
+            seen.add(token_id)
+            size += sizes[head]
+
+    return dictionary
+
+def soundtrack_size(psg,banks,dictionary):
+    return sum(bank.__len__() for bank in banks) + sum(encoding.__len__() for encoding in dictionary)
+
+def pack_songs(output_file,inputs,args):
+    options = compressor_options(args)
+    options.update(verbose=False,debug=False)
+    songs = []
+    datas = []
+
+    for input_file in inputs:
+        with PSGio(input_file,None,bulk=True) as io:
+            psg = PSGCompressor(io,**options)
+            psg.pass_clock = time.perf_counter()
+
+            if (not psg.PASS1_tokenize()):
+                sys.stderr.write(f"{input_file}: not a PSG file\n")
+                return None
+
+            songs.append(psg.tokens)
+            datas.append(bytes(io.ibuf[:io.read()]))
+
+    psg,banks = pack_soundtrack(songs,None,options)
+    dictionary = []
+
+    if (banks is None):
+        sys.stderr.write(f"{psg.error}\n")
+        return None
+
+    if (args.lz and args.multi and args.bankswitch and not args.optimal and args.dict_size > 0):
+        candidate = soundtrack_dictionary(psg,args.dict_size)
+
+        if (candidate):
+            # The songs are packed again with the dictionary from the stored PASS #1 tokens
+            with_psg,with_banks = pack_soundtrack([song.copy() for song in songs],candidate,options)
+
+            if (with_banks is None):
+                with_psg,with_banks = psg,banks
+
+            if (args.verbose):
+                sys.stderr.write(f"  {soundtrack_size(psg,banks,[])} bytes without and "
+                    f"{soundtrack_size(with_psg,with_banks,candidate)} bytes with a dictionary of "
+                    f"{candidate.__len__()} register writes\n")
+
+            if (soundtrack_size(with_psg,with_banks,candidate) < soundtrack_size(psg,banks,[])):
+                psg,banks,dictionary = with_psg,with_banks,candidate
+
+    cache = psg.cached_tags.__len__() > 0
+    dictionary = b"".join(dictionary)
+
+    if (args.verify):
+        for n in range(songs.__len__()):
+            depacker = PSGDepacker(banks,cache,dictionary=dictionary,entry=psg.song_entries[n])
+            frame = verify_states(datas[n],depacker.depack())
+
+            if (frame >= 0):
+                sys.stderr.write(f"{inputs[n]}: verification failed at frame {frame}\n")
+                return None
+
+        if (args.verbose):
+            sys.stderr.write("  Depacked frames match the PSG files\n")
+
+    if (max(offset for bank,offset in psg.song_entries) > 0xffff):
+        sys.stderr.write("The songs do not fit in 64K, use --bankswitch\n")
+        return None
+
+    output_names = bank_names(output_file,banks.__len__())
+
+    for output_name,bank in zip(output_names,banks):
+        if (banks.__len__() > 1):
+            sys.stderr.write(f"file {output_name}\n")
+
+        save_bank(output_name,bank)
+
+    if (dictionary):
+        save_bank(output_file + ".dict",dictionary)
+
+    directory = bytearray()
+
+    if (args.verbose and banks.__len__() > 1):
+        bank_fill(banks,psg.bank_capacity)
+
+    for n in range(songs.__len__()):
+        bank,offset = psg.song_entries[n]
+        directory += bytes([bank]) + offset.to_bytes(2,byteorder="little")
+
+        if (args.verbose):
+            sys.stderr.write(f"  song {n} {inputs[n]} at bank {bank} offset {offset}\n")
+
+    save_bank(output_file + ".dir",bytes(directory))
+
+    original = sum(data.__len__() for data in datas)
+    packed = sum(bank.__len__() for bank in banks) + dictionary.__len__()
+
+    sys.stderr.write(f"{songs.__len__()} songs {original} -> {packed} bytes, packed to "
+        f"{packed/original*100:.1f}% in {banks.__len__()} bank(s) with a {dictionary.__len__()} byte dictionary\n")
+    sys.stderr.write(f"USE_CACHE   equ {int(cache)}\n")
+
+    return original,packed,banks.__len__(),None
+
+#
+# --columns packs the song into the experimental PSGColumns format and
+# reports its size and estimated _next cost next to the row format
+# packed with the same options. Only the column module is saved.
+#
+
+def pack_columns(input_file,output_file,args):
+    options = compressor_options(args)
+    options.update(verbose=False,debug=False)
+
+    with PSGio(input_file,None,bulk=True) as io:
+        psg = PSGCompressor(io,**options)
+        banks = psg.pack()
+
+        if (banks is None):
+            sys.stderr.write(f"{psg.error}\n")
+            return None
+
+        data = bytes(io.ibuf[:io.read()])
+
+    columns = PSGColumns(psg_frames(data),args.columns,args.depth)
+
+    try:
+        module = columns.pack()
+    except ValueError as e:
+        sys.stderr.write(f"{e}\n")
+        return None
+
+    depacker = PSGColumnDepacker(module,PSGCycles(psg.oneput))
+    frame = verify_states(data,depacker.depack())
+
+    # A module that does not replay the song is never saved
+    if (frame >= 0):
+        sys.stderr.write(f"verification failed at frame {frame}\n")
+        return None
+
+    rows = cycle_profile(banks,psg.cached_tags.__len__() > 0,psg.oneput)
+    packed = psg.get_output_size()
+
+    if (args.verbose):
+        sys.stderr.write(f"  {columns.streams.__len__()} streams, {columns.replays} replays and "
+            f"{columns.literals} literals\n")
+        for regs,stream in columns.streams:
+            sys.stderr.write(f"  registers {','.join(str(reg) for reg in regs):8s} {stream.__len__():7d} bytes\n")
+
+    for name,size,profile in ((f"rows {auto_name(options)}",packed,rows),
+        (f"columns {args.columns}",module.__len__(),depacker.profile)):
+        sys.stderr.write(f"{name:20s} {size:7d} bytes {size/data.__len__()*100:5.1f}%, _next average "
+            f"{sum(profile)/profile.__len__():.0f} worst {max(profile)} cycles\n")
+
+    if (args.profile):
+        save_profile(args.profile,depacker.profile)
+
+    save_bank(output_file,module)
+
+    return data.__len__(),module.__len__(),1,None
+
+#
+# The options that change the packed output, see --output-cache.
+#
+
+def output_options(args):
+    options = ("lz","multi","oneput","cache","bankswitch","optimal","depth","max_cycles","auto","bank_capacity",
+        "max_banks","seek","loop_frame")
+    return {option:getattr(args,option,None) for option in options}
+
+#
+# Per bank fill for --verbose.
+#
+
+def bank_fill(banks,bank_capacity):
+    for n in range(banks.__len__()):
+        sys.stderr.write(f"  bank {n:3d} {banks[n].__len__():6d} bytes, {banks[n].__len__()/bank_capacity*100:5.1f}% full\n")
+
+def bank_names(output_file,num_banks):
+    if (num_banks > 1):
+        return [output_file + chr(files+ord('0')) for files in range(num_banks)]
+
+    return [output_file]
+
+#
+# Save the banks of an --output-cache hit. Returns the same tuple as
+# pack_file() or None if --verify fails.
+#
+
+def pack_cached(io,output_file,args,output_cache,meta,names,display_file=None):
+    if (args.verify):
+        banks = []
+
+        for name in names:
+            with open(name,"rb") as f:
+                banks.append(f.read())
+
+        frame = verify_banks(io.ibuf,banks,meta["cached"])
+
+        if (frame >= 0):
+            sys.stderr.write(f"verification failed at frame {frame}\n")
+            return None
+
+    display_names = bank_names(display_file or output_file,names.__len__())
+
+    for name,output_name,display_name in zip(names,bank_names(output_file,names.__len__()),display_names):
+        if (names.__len__() > 1):
+            sys.stderr.write(f"file {display_name}\n")
+
+        output_cache.place(name,output_name)
+
+    if (args.verbose):
+        sys.stderr.write(f"Output cache hit, final PSG file length is {meta['packed']} bytes, packed to "
+            f"{meta['packed']/meta['original']*100:.1f}%\n")
+
+    return meta["original"],meta["packed"],names.__len__(),True
+
+#
+# Run PASS #1 to PASS #4 for one input. Returns a tuple of input
+# length, packed length, number of banks and True/False for an
+# --output-cache hit/miss (None without --output-cache) or None if
+# the input could not be packed.
+#
+
+def pack_file(input_file,output_file,args,display_file=None):
+    original = 0
+    output_cache = None
+
+    if (args.output_cache):
+        output_cache = PSGOutputCache(args.output_cache,args.output_cache_size << 20,args.output_cache_link)
+
+    with PSGio(input_file,None,bulk=True) as io:
+        if (output_cache is not None):
+            key = output_cache.key(io.ibuf,output_options(args))
+
+            # --stats, --profile, --seek and --loop-frame need a real run
+            cached = None if (args.stats or args.profile or args.seek or args.loop_frame is not None) else \
+                output_cache.load(key)
+
+            if (cached is not None):
+                return pack_cached(io,output_file,args,output_cache,*cached,display_file=display_file)
+
+        psg = PSGCompressor(io,**compressor_options(args))
+
+        # The passes are traced for --stats only while packing
+        tracing = args.stats and not tracemalloc.is_tracing()
+
+        if (tracing):
+            tracemalloc.start()
+
+        try:
+            if (args.auto):
+                psg,banks = pack_auto(io,args)
+            else:
+                banks = psg.pack()
+
+                if (banks is None):
+                    sys.stderr.write(f"{psg.error}\n")
+        finally:
+            if (tracing):
+                tracemalloc.stop()
+
+        if (banks is None):
+            return None
+
+        if (psg.seek and max(offset for bank,offset,r13 in psg.resync_entries) > 0xffff):
+            sys.stderr.write("The song does not fit in 64K, use --bankswitch with --seek\n")
+            return None
+
+        if (args.stats):
+            save_stats(args.stats,psg.get_stats(banks))
+
+        if (args.verify):
+            frame = verify_banks(io.ibuf,banks,psg.cached_tags.__len__() > 0,psg_loop(psg))
+
+            if (frame >= 0):
+                sys.stderr.write(f"verification failed at frame {frame}\n")
+                return None
+
+            if (args.verbose):
+                sys.stderr.write("  Depacked frames match the PSG file\n")
+
+            if (psg.seek):
+                point = verify_resync(io.ibuf,banks,psg.cached_tags.__len__() > 0,psg.resync_entries,psg.seek,
+                    psg_loop(psg))
+
+                if (point >= 0):
+                    sys.stderr.write(f"verification failed at resync point {point}\n")
+                    return None
+
+                if (args.verbose):
+                    sys.stderr.write("  Depacked frames match from every resync point\n")
+
+        if (args.verbose and banks.__len__() > 1):
+            bank_fill(banks,psg.bank_capacity)
+
+        if (args.profile):
+            profile = cycle_profile(banks,psg.cached_tags.__len__() > 0,psg.oneput,loop=psg.loop_frame is not None)
+            worst = save_profile(args.profile,profile)
+
+            if (args.verbose):
+                sys.stderr.write(f"  Worst case _next is {profile[worst]} cycles at frame {worst}\n")
+
+        # All passes for packing OK
+        original = io.read()
+
+    # Did we manage to pack the PSG input file?
+    if (original == 0):
+        if (args.verbose):
+            sys.stderr.write("PASS #1-3 failure - unable to save output\n")
+        return None
+
+    # PASS #4 - saving
+
+    output_names = bank_names(output_file,banks.__len__())
+    display_names = bank_names(display_file or output_file,banks.__len__())
+
+    for files in range(banks.__len__()):
+        if (banks.__len__() > 1):
+            sys.stderr.write(f"file {display_names[files]}\n")
+        if (args.verbose):
+            sys.stderr.write(f"PASS #4 - saving PSGPacker output #{files}\n")
+
+    if (banks.__len__() > 1):
+        # Bank files are independent of each other..
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(save_bank,output_names,banks))
+    else:
+        save_bank(output_names[0],banks[0])
+
+    if (psg.seek):
+        save_bank(output_file + ".idx",seek_index(psg.seek,psg.resync_entries))
 
     # All done
+    packed = psg.get_output_size()
+
+    if (args.verbose):
+        sys.stderr.write(f"Final PSG file length is {packed} bytes, packed to {packed/original*100:.1f}%\n")
+
+    if (output_cache is not None):
+        output_cache.store(key,banks,{"original": original, "packed": packed,
+            "cached": psg.cached_tags.__len__() > 0})
+        return original,packed,banks.__len__(),False
+
+    return original,packed,banks.__len__(),None
+
+#
+# Streaming version of pack_file(). The passes are chained generators
+# and the banks are written while the input is still being read. With
+# --bankswitch the banks are written to numbered files and a single
+# bank is renamed to output_file in the end. A named input file is
+# mapped into memory and stdin is read a byte at a time.
+#
+
+def pack_stream(input_file,output_file,args,display_file=None):
+    with PSGio(input_file,None,bulk=isinstance(input_file,str)) as io:
+        psg = PSGCompressor(io,**compressor_options(args))
+        hdr = psg.parseHeader()
+
+        if (hdr is not None):
+            if (args.debug):
+                sys.stderr.write(f"{hdr.tag}\n")
+        else:
+            sys.stderr.write("not a PSG file\n")
+            return None
+
+        if (args.verbose):
+            sys.stderr.write("PASS #1-4 - streaming\n")
+
+        tokens = psg.PASS1_stream()
+
+        if (psg.cache):
+            tokens = psg.PASS2_stream(tokens,psg.sample)
+
+        encodings = psg.PASS3_stream(tokens,psg.bankswitch,psg.lz,psg.multi,psg.depth)
+
+        # The cache lines must be known before anything is saved
+        first = next(encodings)
+
+        if (args.bankswitch):
+            output_names = [output_file + "0"]
+        else:
+            output_names = [output_file]
+
+        oup = PSGio(None,output_names[0])
+        buf = bytearray()
+        packed = 0
+
+        buf += psg.get_cache_lines()
+        buf += first
+
+        try:
+            for encoding in encodings:
+                if (encoding is not None):
+                    buf += encoding
+
+                    if (buf.__len__() < 65536):
+                        continue
+
+                oup.putbuf(bytes(buf))
+                packed += buf.__len__()
+                buf.clear()
+
+                if (encoding is None):
+                    # End of bank
+                    oup.close()
+                    output_names.append(output_file + chr(output_names.__len__()+ord('0')))
+                    oup = PSGio(None,output_names[-1])
+        except PSGBankError as error:
+            # Remove the banks written so far
+            oup.close()
+
+            for output_name in output_names:
+                os.remove(output_name)
+
+            sys.stderr.write(f"{error}\n")
+            return None
+
+        oup.putbuf(bytes(buf))
+        packed += buf.__len__()
+        oup.close()
+        original = io.read()
+
+    if (args.bankswitch and output_names.__len__() == 1):
+        os.replace(output_names[0],output_file)
+        output_names = [output_file]
+
+    if (output_names.__len__() > 1):
+        for display_name in bank_names(display_file or output_file,output_names.__len__()):
+            sys.stderr.write(f"file {display_name}\n")
+
     if (args.verbose):
-        packed = psg.get_output_size()
         sys.stderr.write(f"Final PSG file length is {packed} bytes, packed to {packed/original*100:.1f}%\n")
 
+    return original,packed,output_names.__len__(),None
+
+#
+# Batch packing. Directories are expanded to the *.psg files they contain
+# and outputs go next to the inputs or into outdir with a .pac suffix.
+# Inputs that would be saved as the same output fail the whole batch.
+# Each job saves its --stats into a temporary directory and the batch
+# saves them as one JSON object keyed by the input file.
+#
+
+def batch_files(inputs,outdir):
+    jobs = []
+
+    for name in inputs:
+        if (os.path.isdir(name)):
+            names = sorted(os.path.join(name,n) for n in os.listdir(name) if n.lower().endswith(".psg"))
+        else:
+            names = [name]
+
+        for input_file in names:
+            output_file = os.path.splitext(input_file)[0] + ".pac"
+
+            if (outdir):
+                output_file = os.path.join(outdir,os.path.basename(output_file))
+
+            jobs.append((input_file,output_file))
+
+    return jobs
+
+# The number of jobs whose output is the output of an earlier job
+def batch_duplicates(jobs):
+    outputs = {}
+    duplicates = 0
+
+    for input_file,output_file in jobs:
+        key = os.path.normcase(os.path.abspath(output_file))
+
+        if (key in outputs):
+            sys.stderr.write(f"{outputs[key]} and {input_file} would both be saved as {output_file}\n")
+            duplicates += 1
+        else:
+            outputs[key] = input_file
+
+    return duplicates
+
+def pack_batch(inputs,outdir,args):
+    jobs = batch_files(inputs,outdir)
+    failures = batch_duplicates(jobs)
+    total_original = total_packed = 0
+    hits = misses = 0
+
+    if (failures > 0):
+        return failures
+
+    if (outdir):
+        os.makedirs(outdir,exist_ok=True)
+
+    stats_dir = tempfile.mkdtemp() if (args.stats) else None
+    stats = {}
+    job_args = [args] * jobs.__len__()
+
+    if (stats_dir is not None):
+        job_args = [argparse.Namespace(**dict(vars(args),stats=os.path.join(stats_dir,f"{n}.json")))
+            for n in range(jobs.__len__())]
+
+    with ProcessPoolExecutor() as executor:
+        packer = pack_stream if args.stream else pack_file
+        futures = [executor.submit(packer,input_file,output_file,job) for (input_file,output_file),job in
+            zip(jobs,job_args)]
+
+        for (input_file,output_file),future,job in zip(jobs,futures,job_args):
+            try:
+                result = future.result()
+                reason = "unable to pack"
+            except Exception as e:
+                result = None
+                reason = e
+
+            if (result is None):
+                failures += 1
+                sys.stderr.write(f"{input_file}: failed ({reason})\n")
+                continue
+
+            original,packed,num_banks,hit = result
+
+            if (stats_dir is not None):
+                with open(job.stats) as f:
+                    stats[input_file] = json.load(f)
+
+            total_original += original
+            total_packed += packed
+            hits += hit is True
+            misses += hit is False
+            sys.stderr.write(f"{input_file}: {original} -> {packed} bytes, packed to "
+                f"{packed/original*100:.1f}% in {num_banks} bank(s) as {output_file}" +
+                (" (cached)\n" if (hit) else "\n"))
+
+    if (total_original > 0):
+        sys.stderr.write(f"Total {jobs.__len__()-failures} files {total_original} -> {total_packed} bytes, "
+            f"packed to {total_packed/total_original*100:.1f}%, {failures} failed\n")
+    else:
+        sys.stderr.write(f"{failures} failed\n")
+
+    if (args.output_cache and not args.stream):
+        sys.stderr.write(f"Output cache {hits} hits, {misses} misses\n")
+
+    if (stats_dir is not None):
+        shutil.rmtree(stats_dir,ignore_errors=True)
+        save_stats(args.stats,stats)
+
+    return failures
+
+#
+# Packing daemon for psgclient.py. Each message is a 4 octet big endian
+# length followed by the payload. A request is:
+#
+#  client: JSON {"argv": [...], "cwd": "..."}
+#  server: JSON {"input": name} or a reply if argv is not a pack request
+#  client: the content of the input file
+#  server: JSON {"exit": n, "stdout": "...", "stderr": "...",
+#                "files": [name or null for stdout, ...]}
+#  server: the content of each file
+#
+# The argv are parsed like the psgpacker.py command line. The packing runs
+# on a pool of worker processes. Relative --stats, --profile and cache
+# paths are resolved against the client working directory, so they work
+# like they would with psgpacker.py. The banks are returned to the client
+# to save.
+#
+
+async def read_message(reader):
+    length = int.from_bytes(await reader.readexactly(4),byteorder="big")
+    return await reader.readexactly(length)
+
+def write_message(writer,payload):
+    writer.write(payload.__len__().to_bytes(4,byteorder="big"))
+    writer.write(payload)
+
+#
+# Parse the argv of a request in the server process. Returns the parsed
+# arguments or a reply for --help, errors and unsupported requests.
+#
+
+def serve_parse(argv):
+    out = StringIO()
+    err = StringIO()
+
+    with redirect_stdout(out),redirect_stderr(err):
+        try:
+            args = build_parser().parse_args(argv)
+
+            if (args.batch is not None or args.songs is not None or args.columns is not None or
+                args.serve is not None or args.seek is not None or args.loop_frame is not None or args.loop):
+                err.write("--batch, --songs, --columns, --seek, --loop-frame, --loop and --serve are not supported "
+                    "by the server\n")
+                code = 2
+            elif (args.input_file is None):
+                err.write("the following arguments are required: input_file\n")
+                code = 2
+            elif (args.bank_capacity < 256 or args.bank_capacity > 65536 or args.max_banks < 1 or
+                args.max_banks > 255):
+                err.write("--bank-size must be from 256 to 65536 and --banks from 1 to 255\n")
+                code = 2
+            elif (args.depth < 1):
+                err.write("--depth must be 1 or more\n")
+                code = 2
+            elif (args.sample < 1):
+                err.write("--sample must be 1 or more\n")
+                code = 2
+            elif (args.max_cycles is not None and args.max_cycles < 0):
+                err.write("--max-cycles must be 0 or more\n")
+                code = 2
+            elif (args.numpy and np is None):
+                err.write("--numpy needs NumPy, which is not installed\n")
+                code = 2
+            elif (args.output_file == "" and args.bankswitch):
+                err.write("--bankswitch work only with output files\n")
+                code = 0
+            else:
+                return args,None
+        except SystemExit as e:
+            code = e.code
+
+    return None,{"exit": code, "stdout": out.getvalue(), "stderr": err.getvalue(), "files": []}
+
+#
+# Pack one request in a worker process. Returns the reply and the
+# content of the files.
+#
+
+def serve_request(argv,cwd,data):
+    out = StringIO()
+    err = StringIO()
+    names = []
+    banks = []
+
+    with redirect_stdout(out),redirect_stderr(err):
+        try:
+            args = build_parser().parse_args(argv)
+
+            if (args.debug):
+                args.verbose = True
+
+            # The worker stays in its own working directory
+            for option in ("stats","profile","token_cache","output_cache"):
+                path = getattr(args,option)
+
+                if (path is not None and path != "-"):
+                    setattr(args,option,os.path.join(cwd,path))
+
+            with tempfile.TemporaryDirectory() as temp:
+                output_file = os.path.join(temp,"out")
+                packer = pack_stream if args.stream else pack_file
+                result = packer(data,output_file,args,display_file=args.output_file)
+                code = 1
+
+                if (result is not None):
+                    code = 0
+
+                    for name in bank_names(output_file,result[2]):
+                        with open(name,"rb") as f:
+                            banks.append(f.read())
+
+                    if (args.output_file == ""):
+                        names = [None]
+                    else:
+                        names = bank_names(args.output_file,result[2])
+        except SystemExit as e:
+            code = e.code
+        except Exception as e:
+            err.write(f"{e}\n")
+            code = 1
+
+    return {"exit": code, "stdout": out.getvalue(), "stderr": err.getvalue(), "files": names},banks
+
+async def serve_client(reader,writer,executor):
+    try:
+        request = json.loads(await read_message(reader))
+        args,reply = serve_parse(request["argv"])
+        banks = []
+
+        if (args is not None):
+            write_message(writer,json.dumps({"input": args.input_file}).encode())
+            await writer.drain()
+            data = await read_message(reader)
+            loop = asyncio.get_running_loop()
+            reply,banks = await loop.run_in_executor(executor,serve_request,request["argv"],request["cwd"],data)
+
+        write_message(writer,json.dumps(reply).encode())
+
+        for bank in banks:
+            write_message(writer,bank)
+
+        await writer.drain()
+    except (asyncio.IncompleteReadError,ConnectionError,ValueError,KeyError) as e:
+        sys.stderr.write(f"Dropped a request: {e}\n")
+    finally:
+        writer.close()
+
+# True if path is a socket that no server accepts connections on
+def stale_socket(path):
+    if (not stat.S_ISSOCK(os.lstat(path).st_mode)):
+        return False
+
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return True
+
+    return False
+
+def serve(path,workers=None):
+    if (os.path.lexists(path)):
+        # A stale socket of a server that did not exit cleanly
+        if (not stale_socket(path)):
+            sys.stderr.write(f"{path} exists and is not a stale socket\n")
+            return 1
+
+        os.remove(path)
+
+    async def run():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        for signum in (signal.SIGINT,signal.SIGTERM):
+            loop.add_signal_handler(signum,stop.set)
+
+        with ProcessPoolExecutor(workers) as executor:
+            server = await asyncio.start_unix_server(lambda r,w: serve_client(r,w,executor),path)
+            sys.stderr.write(f"Serving on {path}\n")
+
+            async with server:
+                await stop.wait()
+
+    try:
+        asyncio.run(run())
+    finally:
+        if (os.path.lexists(path) and stat.S_ISSOCK(os.lstat(path).st_mode)):
+            os.remove(path)
+
+    return 0
+
+#
+# Command line interface
+#
+
+def build_parser():
+    prs = argparse.ArgumentParser()
+    prs.add_argument("input_file",metavar="input_file",type=str,nargs="?",help="PSG file or '' if stdin")
+    prs.add_argument("output_file",metavar="output_file",type=str,nargs="?",help="Output file or stdout "
+                     "if missing", default="")
+    prs.add_argument("--verbose","-v",dest="verbose",action="store_true",default=False,help="Show some process output")
+    prs.add_argument("--debug",dest="debug",action="store_true",default=False,help="Show debug output")
+    prs.add_argument("--lz","-z",dest="lz",action="store_true",default=False,help="Enable history references")
+    prs.add_argument("--multi","-m",dest="multi",action="store_true",default=False,help="Enable multi-frame matches of history references")
+    prs.add_argument("--oneput","-o",dest="oneput",action="store_true",default=False,
+        help="Enable single changed register output")
+    prs.add_argument("--bankswitch","-b",dest="bankswitch",action="store_true",default=False,
+        help="Add bank boundary marks")
+    prs.add_argument("--bank-size",dest="bank_capacity",metavar="n",type=int,default=16384,
+        help="Size of a --bankswitch bank in bytes, default 16384")
+    prs.add_argument("--banks",dest="max_banks",metavar="n",type=int,default=255,
+        help="Number of banks available for --bankswitch, default 255")
+    prs.add_argument("--cache","-c",dest="cache",action="store_true",default=False,
+        help="Cache most used AY register writes")
+    prs.add_argument("--numpy","-n",dest="numpy",action="store_true",default=False,
+        help="Use NumPy to decode all PSG frames at once in PASS #1")
+    prs.add_argument("--optimal","-O",dest="optimal",action="store_true",default=False,
+        help="Use optimal instead of greedy parsing of history references")
+    prs.add_argument("--depth",dest="depth",metavar="n",type=int,default=16,
+        help="Number of earlier positions tried per history match, default 16")
+    prs.add_argument("--batch",dest="batch",metavar="input",type=str,nargs="+",default=None,
+        help="Pack PSG files and directories of PSG files in parallel")
+    prs.add_argument("--outdir",dest="outdir",metavar="dir",type=str,default=None,
+        help="Output directory for --batch, default is next to the input files, two inputs with the same output "
+        "fail the batch")
+    prs.add_argument("--stream",dest="stream",action="store_true",default=False,
+        help="Pack with bounded memory while reading the input, implies greedy parsing")
+    prs.add_argument("--sample",dest="sample",metavar="n",type=int,default=65536,
+        help="Number of tokens the --cache lines are chosen from with --stream, default 65536")
+    prs.add_argument("--verify",dest="verify",action="store_true",default=False,
+        help="Depack the output and compare it against the PSG file before saving")
+    prs.add_argument("--max-cycles",dest="max_cycles",metavar="n",type=int,default=None,
+        help="Avoid encodings that make _next take more than n cycles in any frame, fails if some frame still takes more")
+    prs.add_argument("--stats",dest="stats",metavar="file",type=str,default=None,
+        help="Save per pass times and memory, token, match, cache and bank statistics as JSON or '-' for stderr, "
+        "keyed by the input file with --batch")
+    prs.add_argument("--auto",dest="auto",metavar="objective",type=str,nargs="?",const="bytes",default=None,
+        choices=["bytes","banks","cycles"],
+        help="Pack with every --lz/--multi/--oneput/--cache combination in parallel and keep the smallest bytes "
+        "(default), fewest banks or lowest worst case _next cycles")
+    prs.add_argument("--token-cache",dest="token_cache",metavar="dir",type=str,default=None,
+        help="Keep the PASS #1 tokens of each input and --oneput in dir for later runs")
+    prs.add_argument("--token-cache-size",dest="token_cache_size",metavar="MB",type=int,default=64,
+        help="Evict the least recently used --token-cache files above MB megabytes, default 64")
+    prs.add_argument("--output-cache",dest="output_cache",metavar="dir",type=str,default=None,
+        help="Reuse the packed outputs in dir of inputs packed earlier with the same options")
+    prs.add_argument("--output-cache-size",dest="output_cache_size",metavar="MB",type=int,default=256,
+        help="Evict the least recently used --output-cache entries above MB megabytes, default 256")
+    prs.add_argument("--output-cache-link",dest="output_cache_link",action="store_true",default=False,
+        help="Hard link instead of copy the --output-cache banks to the output files")
+    prs.add_argument("--profile",dest="profile",metavar="file",type=str,default=None,
+        help="Save the per frame _next cycle profile as JSON or CSV if file ends with .csv")
+    prs.add_argument("--columns",dest="columns",metavar="layout",type=str,nargs="?",const="reg",default=None,
+        choices=list(PSGColumns.LAYOUTS),
+        help="Save the experimental column format with a stream per register (reg, default) or per channel "
+        "and compare it against the row format")
+    prs.add_argument("--seek",dest="seek",metavar="n",type=int,default=None,
+        help="Add a resync point every n frames and save the seek index as output_file.idx")
+    prs.add_argument("--loop-frame",dest="loop_frame",metavar="n",type=int,default=None,
+        help="End the song with a loop token back to the frame n")
+    prs.add_argument("--loop",dest="loop",action="store_true",default=False,
+        help="End the song with a loop token back to the detected loop")
+    prs.add_argument("--songs",dest="songs",metavar="file",type=str,nargs="+",default=None,
+        help="Pack the PSG files into one soundtrack with shared banks, cache lines and dictionary, "
+        "the first file is the output")
+    prs.add_argument("--dict-size",dest="dict_size",metavar="n",type=int,default=4096,
+        help="Maximum size of the --songs dictionary, default 4096")
+    prs.add_argument("--serve",dest="serve",metavar="socket",type=str,default=None,
+        help="Serve pack requests of psgclient.py on a Unix domain socket")
+    prs.add_argument("--workers",dest="workers",metavar="n",type=int,default=None,
+        help="Number of --serve worker processes, default is the number of CPUs")
+
+    return prs
+
+def main(argv=None):
+    prs = build_parser()
+    args = prs.parse_args(argv)
+
+    if (args.debug):
+        args.verbose = True
+
+    if (args.bank_capacity < 256 or args.bank_capacity > 65536):
+        prs.error("--bank-size must be from 256 to 65536")
+
+    # The bank $ff is reserved for the init/stop callback and the loop token
+    if (args.max_banks < 1 or args.max_banks > 255):
+        prs.error("--banks must be from 1 to 255")
+
+    if (args.depth < 1):
+        prs.error("--depth must be 1 or more")
+
+    if (args.sample < 1):
+        prs.error("--sample must be 1 or more")
+
+    if (args.max_cycles is not None and args.max_cycles < 0):
+        prs.error("--max-cycles must be 0 or more")
+
+    if (args.dict_size < 0):
+        prs.error("--dict-size must be 0 or more")
+
+    if (args.numpy and np is None):
+        prs.error("--numpy needs NumPy, which is not installed")
+
+    if (args.seek is not None):
+        if (args.seek < 1 or args.seek > 65535):
+            prs.error("--seek must be from 1 to 65535")
+        if (args.stream or args.songs is not None or args.columns is not None):
+            prs.error("--seek is not supported with --stream, --songs or --columns")
+        if (args.output_file == "" and args.batch is None):
+            prs.error("--seek works only with output files")
+
+    if (args.loop_frame is not None and args.loop_frame < 0):
+        prs.error("--loop-frame must be 0 or more")
+
+    # --loop is the loop_frame -1 of PSGCompressor
+    if (args.loop):
+        if (args.loop_frame is not None):
+            prs.error("--loop and --loop-frame cannot be used together")
+        args.loop_frame = -1
+
+    if (args.loop_frame is not None):
+        if (args.stream or args.songs is not None or args.columns is not None):
+            prs.error("--loop-frame and --loop are not supported with --stream, --songs or --columns")
+
+    if (args.serve is not None):
+        sys.exit(serve(args.serve,args.workers))
+
+    if (args.batch is not None):
+        if (pack_batch(args.batch,args.outdir,args) > 0):
+            sys.exit(1)
+        sys.exit(0)
+
+    if (args.songs is not None):
+        if (args.songs.__len__() < 2):
+            prs.error("--songs needs the output file and at least one input file")
+        if (pack_songs(args.songs[0],args.songs[1:],args) is None):
+            sys.exit(1)
+        sys.exit(0)
+
+    if (args.input_file is None):
+        prs.error("the following arguments are required: input_file")
+
+    if (args.input_file == ""):
+        input_file = sys.stdin.buffer
+    else:
+        input_file = args.input_file
+
+    if (args.output_file == ""):
+        if (args.bankswitch):
+            sys.stderr.write("--bankswitch work only with output files\n")
+            exit(0)
+
+        output_file = sys.stdout.buffer
+    else:
+        output_file = args.output_file
+
+    if (args.columns is not None):
+        if (args.bankswitch or args.stream):
+            sys.stderr.write("--columns does not support --bankswitch or --stream\n")
+            sys.exit(1)
+
+        result = pack_columns(input_file,output_file,args)
+    elif (args.stream):
+        if (args.optimal or args.numpy or args.verify or args.max_cycles is not None or args.stats or args.auto or
+            args.token_cache or args.output_cache):
+            sys.stderr.write("--optimal, --numpy, --verify, --max-cycles, --stats, --auto, --token-cache and "
+                "--output-cache are ignored with --stream\n")
+
+        result = pack_stream(input_file,output_file,args)
+    else:
+        result = pack_file(input_file,output_file,args)
+
+    if (result is None):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
+
 
 #
 # The Compressee PSG format used by PSGPacker:
@@ -942,7 +5169,9 @@ if __name__ == "__main__":
 #  00 000000          -> EOF
 #  00 nnnnnn          -> wait sync & repeat previour PSG reg output nnnnnn times
 #  01 00nnnn          -> register nnnn (0-13) followed by 1 time [8]
-#  01 001110          -> reserved tag
+#  01 001110 rrrrrrrr bbbbbbbb hhhhhhhh llllllll -> loop, write R13 rrrrrrrr unless it is $ff, then go to
+#                        hhhhhhhh*256+llllllll bytes back from llllllll if bbbbbbbb is $ff, otherwise to
+#                        the offset from the song start in the bank bbbbbbbb
 #  01 001111 bbbbbbbb -> bank switch mark followed by the next bank number > 0
 #  01 rrrrrr >= 16
 #  01 ffffff          -> Play from cached register bank rrrrrr-16
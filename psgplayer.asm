@@ -22,6 +22,8 @@
 USE_CACHE   equ 1
 ; This must be set to 1 if PSGPacker used --oneput
 USE_ONEPUT  equ 1
+; This must be set to 1 if PSGPacker used --loop-frame
+USE_LOOP    equ 0
 ; Put your bank swithing macro here..
 ; A   must be preserved when exiting the macro
 BANKSWITCH  macro
@@ -95,6 +97,24 @@ loop:
 ;    CALL psgplayer+2
 ;    CALL psgplayer+0
 ;
+; To continue from a PSGPacker --seek resync point:
+;    LD   A,bank from the seek index
+;    LD   DE,offset from the seek index
+;    LD   C,R13 from the seek index
+;    CALL _seek
+;
+; To start a song of a PSGPacker --songs soundtrack after the init:
+;    LD   A,bank from name.dir
+;    LD   DE,offset from name.dir
+;    LD   C,$ff
+;    CALL _seek
+;
+; At the end of a soundtrack song the player continues from the start of
+; the bank 0, i.e. the first song, like after _stop.
+;
+; A --loop-frame song never ends. Its loop token continues from the loop
+; frame, in another bank through the callback, without _stop.
+;
 ; Backswitch function:
 ;  Inputs:
 ;     A = $ff if called for init/stop
@@ -138,6 +158,34 @@ _clr:   dec     l
         push    hl
         ld      hl,(_smc_cb+1)
         jp      (hl)
+
+;
+; Continues from a --seek resync point or starts a --songs song with C =
+; $ff. The next _next outputs the frame of the resync point. _regbuf is cleared like in _stop and the callback
+; switches to the bank of the resync point. The callback returns through
+; _ret, which keeps its A as the wait count, so the wait is cleared too.
+; The resync point does not write R13 unless its frame does, so _play
+; outputs the R13 in C.
+;
+; Input:
+;  A  = bank (not $ff)
+;  DE = offset from the song start in the bank
+;  C  = R13 or $ff
+;
+_seek:
+        push    bc
+        push    de
+        call    _stop2
+        pop     de
+        add     hl,de
+        ld      (_smc_pos+1),hl
+        pop     bc
+        ld      a,c
+        ld      (_regbuf+13),a
+        xor     a
+        ld      (_smc_wait+1),a
+        ld      (_smc_rep+1),a
+        ret
         
 
 ;
@@ -230,8 +278,13 @@ _tag_01rrnnnn:
         jr nc,  _cached_tag
         
         IF USE_ONEPUT           ; Does not harm to leave included even if
-        cp      15              ; the packed PSGPacker did not use --oneput
+        IF USE_LOOP             ; the packed PSGPacker did not use --oneput
+        cp      14
+        jr nc,  _callback
+        ELSE
+        cp      15
         jr z,   _callback
+        ENDIF
         ;
         ; TAG 01 00nnnn + [8]
         ld      e,a
@@ -241,6 +294,10 @@ _tag_01rrnnnn:
         ENDIF
         ;
 _callback:
+        IF USE_LOOP
+        rrca
+        jr nc,  _loop
+        ENDIF
         ; TAG 01 001111 + [8]
         ld      a,(hl)
         ld      hl,_norestore
@@ -251,6 +308,35 @@ _smc_cb:
         ; A > 0
         ;jp      (hl)
         ;
+        IF USE_LOOP
+_loop:
+        ; TAG 01 001110 + [8] + [8] + [16]
+        ; C-flag is clear, D = HIGH(_regbuf)
+        ld      e,13
+        ldi                     ; R13 to write on the loop or $ff
+        ld      a,(hl)
+        inc     hl
+        ld      b,(hl)
+        inc     hl
+        ld      c,(hl)
+        inc     a
+        jr nz,  _loop_bank
+        ; Bank $ff -> offset back from the last octet
+        sbc     hl,bc
+        jp      _norestore
+_loop_bank:
+        ; Offset from the song start in the bank A
+        dec     a
+        push    bc
+        ld      hl,_loop_resume
+        push    hl
+        jp      _smc_cb
+_loop_resume:
+        pop     bc
+        add     hl,bc
+        jp      _norestore
+        ENDIF
+        ;
 _lz:
         ; TAG 01 rrrrrr nnnnnnnn nnnnnnnn
         ;
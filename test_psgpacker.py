@@ -0,0 +1,681 @@
+#
+# Round trip and regression tests of psgpacker.py. Run with
+# 'python3 -m pytest' or 'python3 -m unittest' in this directory.
+#
+
+import os
+import sys
+import csv
+import json
+import time
+import signal
+import tempfile
+import unittest
+import subprocess
+from contextlib import redirect_stderr
+from io import StringIO
+
+import psgbench
+import psgpacker
+import psgclient
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SONGS = [os.path.join(HERE,name) for name in ("bbt2.psg","uranus.psg")]
+
+# The main --lz/--multi/--oneput/--cache/--bankswitch/--optimal mixes
+OPTIONS = [
+    {},
+    {"lz": True},
+    {"lz": True, "multi": True},
+    {"lz": True, "multi": True, "oneput": True, "cache": True},
+    {"lz": True, "multi": True, "cache": True, "bankswitch": True, "bank_capacity": 4096},
+    {"lz": True, "multi": True, "oneput": True, "cache": True, "optimal": True},
+    {"lz": True, "multi": True, "optimal": True, "bankswitch": True, "bank_capacity": 2048},
+    {"lz": True, "multi": True, "cache": True, "max_cycles": 800},
+]
+
+# --numpy needs NumPy installed
+if (psgpacker.np is not None):
+    OPTIONS.append({"lz": True, "multi": True, "numpy": True})
+
+def read(name):
+    with open(name,"rb") as f:
+        return f.read()
+
+def pack(data,**options):
+    with psgpacker.PSGio(data,None) as io:
+        psg = psgpacker.PSGCompressor(io,**options)
+        banks = psg.pack()
+
+    return psg,banks
+
+# main() with the messages to stderr kept in err or quiet, returns the
+# exit status
+def run_main(argv,err=None):
+    with redirect_stderr(StringIO() if (err is None) else err):
+        try:
+            psgpacker.main(argv)
+        except SystemExit as e:
+            return e.code
+
+    return 0
+
+class RoundTripTest(unittest.TestCase):
+    def test_compress(self):
+        for name in SONGS:
+            data = read(name)
+
+            for options in OPTIONS:
+                with self.subTest(song=os.path.basename(name),**options):
+                    banks = psgpacker.compress(data,verify=True,**options)
+                    self.assertEqual(banks.__len__() > 1,options.get("bankswitch",False))
+
+    def test_verify_banks(self):
+        for name in SONGS:
+            data = read(name)
+            psg,banks = pack(data,lz=True,multi=True,oneput=True,cache=True)
+            cache = psg.cached_tags.__len__() > 0
+            self.assertEqual(psgpacker.verify_banks(data,banks,cache),-1)
+
+            # A changed register value of the first regput must be found
+            psg,banks = pack(data,lz=True,multi=True)
+            bank = bytearray(banks[0])
+            head = psg.tokens.tags.index(psgpacker.PSGToken.TAG_MULTIPUT)
+            pos = sum(psg.tokens.sizes[:head])
+
+            self.assertGreaterEqual(bank[pos],0b11000000)
+            bank[pos+2] ^= 0x01
+            self.assertNotEqual(psgpacker.verify_banks(data,[bytes(bank)]),-1)
+
+    def test_seek(self):
+        data = read(SONGS[0])
+        psg,banks = pack(data,lz=True,multi=True,cache=True,bankswitch=True,bank_capacity=8192,seek=500)
+        cache = psg.cached_tags.__len__() > 0
+        self.assertEqual(psgpacker.verify_banks(data,banks,cache),-1)
+        self.assertEqual(psgpacker.verify_resync(data,banks,cache,psg.resync_entries,psg.seek),-1)
+
+        index = psgpacker.seek_index(psg.seek,psg.resync_entries)
+        self.assertEqual(index.__len__(),2 + 4 * psg.resync_entries.__len__())
+
+    def test_loop(self):
+        data = read(SONGS[1])
+
+        for options in ({"loop_frame": -1}, {"loop_frame": 100, "bankswitch": True, "bank_capacity": 2048}):
+            with self.subTest(**options):
+                psg,banks = pack(data,lz=True,multi=True,**options)
+                loop = psgpacker.psg_loop(psg)
+                self.assertEqual(psgpacker.verify_banks(data,banks,False,loop),-1)
+
+    def test_loop_64k(self):
+        # Without --bankswitch the loop offset must fit in 16 bits
+        data = read(SONGS[0])
+
+        with self.assertRaises(psgpacker.PSGLoopError):
+            psgpacker.compress(data,loop_frame=2)
+
+        banks = psgpacker.compress(data,loop_frame=2,bankswitch=True,verify=True)
+        self.assertGreater(banks.__len__(),1)
+
+class ProfileTest(unittest.TestCase):
+    def test_json_csv(self):
+        data = read(SONGS[1])
+        banks = psgpacker.compress(data,lz=True,multi=True,cache=True)
+        profile = list(psgpacker.cycle_profile(banks,True,False))
+
+        # One entry per frame and one for the EOF that restarts the song
+        self.assertEqual(profile.__len__(),psgpacker.psg_frames(data).__len__() // 14 + 1)
+
+        with tempfile.TemporaryDirectory() as temp:
+            name = os.path.join(temp,"profile.json")
+            self.assertEqual(run_main(["-z","-m","-c","--profile",name,SONGS[1],os.devnull]),0)
+
+            with open(name) as f:
+                saved = json.load(f)
+
+            worst = profile.index(max(profile))
+            self.assertEqual(saved["profile"],profile)
+            self.assertEqual(saved["frames"],profile.__len__())
+            self.assertEqual(saved["worst"],{"frame": worst, "cycles": profile[worst]})
+            self.assertAlmostEqual(saved["average"],sum(profile) / profile.__len__())
+            self.assertEqual(sum(bucket["frames"] for bucket in saved["histogram"]),profile.__len__())
+            self.assertTrue(all(bucket["cycles"] % saved["bucket"] == 0 for bucket in saved["histogram"]))
+
+            name = os.path.join(temp,"profile.csv")
+            self.assertEqual(run_main(["-z","-m","-c","--profile",name,SONGS[1],os.devnull]),0)
+
+            with open(name,newline="") as f:
+                rows = list(csv.reader(f))
+
+            self.assertEqual(rows[0],["kind","key","value"])
+            self.assertEqual(rows[1],["worst",str(worst),str(profile[worst])])
+            self.assertEqual([int(value) for kind,key,value in rows if (kind == "frame")],profile)
+            self.assertEqual(sum(int(value) for kind,key,value in rows if (kind == "histogram")),profile.__len__())
+
+class CacheLineTest(unittest.TestCase):
+    # Estimated saving of each register write like PASS2_build_cache()
+    def savings(self,data,lz):
+        with psgpacker.PSGio(data,None) as io:
+            psg = psgpacker.PSGCompressor(io,lz=lz,multi=lz)
+            psg.PASS1_tokenize()
+
+        tokens = psg.tokens
+        coverage = psg.PASS2_lz_coverage(tokens) if (lz) else [0] * tokens.__len__()
+        savings = {}
+        instances = {}
+
+        for head in range(tokens.__len__()):
+            if (tokens.tags[head] == psgpacker.PSGToken.TAG_MULTIPUT):
+                encoding = tokens.encoding(head)
+                size = tokens.sizes[head]
+                savings[encoding] = savings.get(encoding,1 - size) + \
+                    (size - 1 if (coverage[head] == 0) else 1 if (coverage[head] == 1) else 0)
+                instances[encoding] = instances.get(encoding,0) + 1
+
+        return savings,instances
+
+    def test_savings(self):
+        for name in SONGS:
+            data = read(name)
+
+            for lz in (False,True):
+                with self.subTest(song=os.path.basename(name),lz=lz):
+                    savings,instances = self.savings(data,lz)
+                    psg,banks = pack(data,lz=lz,multi=lz,cache=True)
+                    lines = sorted((savings[encoding] for encoding in psg.cached_tags),reverse=True)
+                    self.assertEqual(lines,sorted(savings.values(),reverse=True)[:15])
+
+                    # After LZ the most written lines are not the ones that save the most
+                    if (lz):
+                        most = sorted(instances,key=lambda encoding:instances[encoding] * encoding.__len__())[-15:]
+                        self.assertNotEqual(set(psg.cached_tags),set(most))
+
+    def test_no_saving(self):
+        # No register write repeats, so the cache is skipped
+        header = read(SONGS[1])[0:16]
+        data = header + b"".join(bytes([0xff,0,n,1,n+1]) for n in range(20)) + b"\xfd"
+
+        with redirect_stderr(StringIO()):
+            psg,banks = pack(data,cache=True)
+
+        self.assertEqual(psg.cached_tags,{})
+        self.assertEqual(psgpacker.verify_banks(data,banks,False),-1)
+
+class StatsTest(unittest.TestCase):
+    def test_keys(self):
+        with tempfile.TemporaryDirectory() as temp:
+            name = os.path.join(temp,"stats.json")
+            output = os.path.join(temp,"song.pac")
+            self.assertEqual(run_main(["-z","-m","-c","-b","--bank-size","4096","--stats",name,SONGS[1],output]),0)
+
+            with open(name) as f:
+                stats = json.load(f)
+
+            banks = [read(output + str(n)) for n in range(stats["banks"].__len__())]
+
+        self.assertEqual(set(stats),{"input","output","header","passes","tags","single_lz","multi_lz","cache","banks"})
+        self.assertEqual(stats["input"],read(SONGS[1]).__len__())
+        self.assertEqual(stats["output"],sum(bank.__len__() for bank in banks))
+        self.assertEqual(set(stats["passes"]),{"PASS1","PASS2","PASS3","PASS4"})
+        self.assertTrue(all(set(stat) == {"time","peak"} for stat in stats["passes"].values()))
+
+        # The cache lines and the tokens make up the output
+        tags = stats["tags"]
+        self.assertEqual(stats["header"] + sum(tag["bytes"] for tag in tags.values()),stats["output"])
+        self.assertEqual(tags["bankswitch"]["count"],banks.__len__() - 1)
+        self.assertEqual(sum(stats["single_lz"]["offsets"].values()),tags["singlelz"]["count"])
+        self.assertEqual(sum(stats["multi_lz"]["lengths"].values()),tags["multilz"]["count"])
+        self.assertEqual(sum(line["hits"] for line in stats["cache"]),tags["cached"]["count"])
+        self.assertEqual([bank["bytes"] for bank in stats["banks"]],[bank.__len__() for bank in banks])
+
+class MaxCyclesTest(unittest.TestCase):
+    def test_budget(self):
+        for name in SONGS:
+            with self.subTest(song=os.path.basename(name)):
+                data = read(name)
+                banks = psgpacker.compress(data,lz=True,multi=True,cache=True)
+                self.assertGreater(max(psgpacker.cycle_profile(banks,True,False)),800)
+
+                banks = psgpacker.compress(data,lz=True,multi=True,cache=True,max_cycles=800,verify=True)
+                self.assertLessEqual(max(psgpacker.cycle_profile(banks,True,False)),800)
+
+    def test_over(self):
+        # The EOF frame alone takes more than 700 cycles
+        with self.assertRaises(psgpacker.PSGCycleError):
+            psgpacker.compress(read(SONGS[0]),lz=True,multi=True,max_cycles=700)
+
+class AutoTest(unittest.TestCase):
+    # The --auto sort key of a (options,banks,worst cycles) result
+    def key(self,objective,result):
+        options,banks,worst = result
+        return psgpacker.auto_key(objective,sum(bank.__len__() for bank in banks),banks.__len__(),worst)
+
+    def test_objectives(self):
+        data = read(SONGS[1])
+        results = []
+
+        with redirect_stderr(StringIO()):
+            for options in psgpacker.auto_options():
+                banks = psgpacker.compress(data,bankswitch=True,bank_capacity=4096,**options)
+                worst = max(psgpacker.cycle_profile(banks,options["cache"],options["oneput"]))
+                results.append((options,banks,worst))
+
+        for objective in ("bytes","banks","cycles"):
+            with self.subTest(objective=objective), tempfile.TemporaryDirectory() as temp:
+                options,banks,worst = min(results,key=lambda result:self.key(objective,result))
+
+                output = os.path.join(temp,"song.pac")
+                err = StringIO()
+                self.assertEqual(run_main(["-b","--bank-size","4096",SONGS[1],output,"--auto=" + objective],err),0)
+                self.assertIn(f"auto: {psgpacker.auto_name(options)} for {objective}, "
+                    f"{sum(bank.__len__() for bank in banks)} bytes in {banks.__len__()} bank(s)",err.getvalue())
+                self.assertEqual([read(output + str(n)) for n in range(banks.__len__())],banks)
+
+        # The smallest output is not the fastest one for this song
+        self.assertNotEqual(min(results,key=lambda result:self.key("bytes",result))[0],
+            min(results,key=lambda result:self.key("cycles",result))[0])
+
+    def test_errors(self):
+        # Each failed --auto candidate is reported with its own error
+        err = StringIO()
+        argv = ["--auto","-b","--banks","3","--max-cycles","770",SONGS[0],os.devnull]
+        self.assertEqual(run_main(argv,err),1)
+
+        lines = err.getvalue().splitlines()
+        start = lines.index("auto: no candidate could be packed")
+        errors = lines[start+1:start+1+psgpacker.auto_options().__len__()]
+        self.assertTrue(any("banks of 16384 bytes" in line for line in errors))
+        self.assertTrue(any("exceed 770 cycles" in line for line in errors))
+
+class BanksTest(unittest.TestCase):
+    def test_boundaries(self):
+        # The cost-aware boundaries against the greedy ones of PASS3_lz_greedy()
+        smaller = 0
+
+        for name in SONGS:
+            data = read(name)
+
+            for capacity,options in ((2048,{}),(4096,{"multi": True}),(8192,{"multi": True, "cache": True})):
+                with self.subTest(song=os.path.basename(name),capacity=capacity,**options):
+                    psg,banks = pack(data,lz=True,bankswitch=True,bank_capacity=capacity,**options)
+
+                    with psgpacker.PSGio(data,None) as io:
+                        greedy = psgpacker.PSGCompressor(io,lz=True,bankswitch=True,bank_capacity=capacity,**options)
+                        greedy.PASS3_lz_banks = lambda: greedy.PASS3_lz_greedy(True)
+                        greedy_banks = greedy.pack()
+
+                    layout = (banks.__len__(),sum(bank.__len__() for bank in banks))
+                    greedy_layout = (greedy_banks.__len__(),sum(bank.__len__() for bank in greedy_banks))
+                    self.assertLessEqual(layout,greedy_layout)
+                    smaller += layout < greedy_layout
+
+                    # A boundary only moves back within the last 1/BANK_WINDOW of the bank
+                    window = capacity // psg.BANK_WINDOW + 2 * psg.MAX_TOKEN
+                    self.assertTrue(all(bank.__len__() <= capacity for bank in banks))
+                    self.assertTrue(all(bank.__len__() >= capacity - window for bank in banks[:-1]))
+                    self.assertEqual(psgpacker.verify_banks(data,banks,psg.cached_tags.__len__() > 0),-1)
+
+        self.assertGreater(smaller,0)
+
+    def test_max_banks(self):
+        data = read(SONGS[1])
+        banks = psgpacker.compress(data,lz=True,multi=True,bankswitch=True,bank_capacity=2048)
+        self.assertEqual(psgpacker.compress(data,lz=True,multi=True,bankswitch=True,bank_capacity=2048,
+            max_banks=banks.__len__()),banks)
+
+        with self.assertRaises(psgpacker.PSGBankError):
+            psgpacker.compress(data,lz=True,multi=True,bankswitch=True,bank_capacity=2048,max_banks=banks.__len__()-1)
+
+        # Nothing is saved when the banks run out
+        with tempfile.TemporaryDirectory() as temp:
+            output = os.path.join(temp,"song.pac")
+            argv = ["-z","-m","-b","--bank-size","2048","--banks",str(banks.__len__()-1),SONGS[1],output]
+            self.assertEqual(run_main(argv),1)
+            self.assertEqual(os.listdir(temp),[])
+
+    def test_bank_size_256(self):
+        # --bank-size 256 crashed in PASS #4 with more than 255 banks
+        data = read(SONGS[0])
+
+        with self.assertRaises(psgpacker.PSGBankError):
+            psgpacker.compress(data,lz=True,bankswitch=True,bank_capacity=256)
+
+        with tempfile.TemporaryDirectory() as temp:
+            output = os.path.join(temp,"song.pac")
+            self.assertEqual(run_main(["-z","-b","--bank-size","256",SONGS[0],output]),1)
+
+class ColumnsTest(unittest.TestCase):
+    def test_depack(self):
+        for name in SONGS:
+            data = read(name)
+
+            for layout in psgpacker.PSGColumns.LAYOUTS:
+                with self.subTest(song=os.path.basename(name),layout=layout):
+                    module = psgpacker.PSGColumns(psgpacker.psg_frames(data),layout).pack()
+                    depacker = psgpacker.PSGColumnDepacker(module)
+                    self.assertEqual(depacker.depack(),psgpacker.psg_frames(data))
+
+    def test_verify(self):
+        # A module that does not depack to the song is not saved, --verify or not
+        depack = psgpacker.PSGColumnDepacker.depack
+        psgpacker.PSGColumnDepacker.depack = lambda self: depack(self)[psgpacker.PSGCompressor.NUMREGS:]
+
+        try:
+            with tempfile.TemporaryDirectory() as temp:
+                output = os.path.join(temp,"song.col")
+                self.assertEqual(run_main(["--columns","reg",SONGS[1],output]),1)
+                self.assertFalse(os.path.exists(output))
+        finally:
+            psgpacker.PSGColumnDepacker.depack = depack
+
+        with tempfile.TemporaryDirectory() as temp:
+            output = os.path.join(temp,"song.col")
+            self.assertEqual(run_main(["--columns","channel",SONGS[1],output]),0)
+            self.assertTrue(os.path.exists(output))
+
+class TokenCacheTest(unittest.TestCase):
+    def test_hit(self):
+        data = read(SONGS[1])
+
+        with tempfile.TemporaryDirectory() as temp:
+            banks = pack(data,lz=True,multi=True,oneput=True,token_cache=temp)[1]
+            cache = psgpacker.PSGTokenCache(temp)
+            key = cache.key(data,True)
+            self.assertTrue(os.path.exists(cache.filename(key)))
+
+            # The stored tokens are the PASS #1 tokens
+            tokens,length = cache.load(key)
+            self.assertEqual(length,data.__len__())
+            self.assertEqual([(tokens.tags[head],bytes(tokens.encoding(head))) for head in range(tokens.__len__())],
+                tokenize(data,oneput=True))
+
+            # A hit packs the same banks
+            self.assertEqual(pack(data,lz=True,multi=True,oneput=True,token_cache=temp)[1],banks)
+
+    def test_broken(self):
+        data = read(SONGS[1])
+
+        with tempfile.TemporaryDirectory() as temp:
+            pack(data,lz=True,token_cache=temp)
+            cache = psgpacker.PSGTokenCache(temp)
+            name = cache.filename(cache.key(data,False))
+
+            with open(name,"r+b") as f:
+                f.truncate(os.path.getsize(name) // 2)
+
+            # A truncated file is a miss and is replaced on the next store
+            self.assertIsNone(cache.load(cache.key(data,False)))
+            self.assertEqual(pack(data,lz=True,token_cache=temp)[1],psgpacker.compress(data,lz=True))
+            self.assertIsNotNone(cache.load(cache.key(data,False)))
+
+class OutputCacheTest(unittest.TestCase):
+    # Returns the output and if it was an --output-cache hit
+    def run_cached(self,temp,name,argv=()):
+        output = os.path.join(temp,"song.pac")
+        err = StringIO()
+        argv = ["-z","-m","-c","-v","--output-cache",os.path.join(temp,"cache")] + list(argv) + [name,output]
+        self.assertEqual(run_main(argv,err),0)
+        return read(output),"Output cache hit" in err.getvalue()
+
+    def test_hit(self):
+        with tempfile.TemporaryDirectory() as temp:
+            banks,hit = self.run_cached(temp,SONGS[1])
+            self.assertFalse(hit)
+            self.assertEqual(self.run_cached(temp,SONGS[1]),(banks,True))
+
+            # Other options are another entry
+            self.assertFalse(self.run_cached(temp,SONGS[1],["-o"])[1])
+
+    def test_version(self):
+        # A changed packer source or VERSION misses the entries of the old one
+        source_digest = psgpacker.source_digest
+        version = psgpacker.VERSION
+
+        with tempfile.TemporaryDirectory() as temp:
+            banks,hit = self.run_cached(temp,SONGS[1])
+
+            try:
+                psgpacker.source_digest = lambda: "0" * 64
+                self.assertEqual(self.run_cached(temp,SONGS[1]),(banks,False))
+            finally:
+                psgpacker.source_digest = source_digest
+
+            try:
+                psgpacker.VERSION = version + "-test"
+                self.assertEqual(self.run_cached(temp,SONGS[1]),(banks,False))
+            finally:
+                psgpacker.VERSION = version
+
+            self.assertEqual(self.run_cached(temp,SONGS[1]),(banks,True))
+
+    def test_link(self):
+        with tempfile.TemporaryDirectory() as temp:
+            output = os.path.join(temp,"song.pac")
+            banks,hit = self.run_cached(temp,SONGS[1],["--output-cache-link"])
+            self.assertEqual(self.run_cached(temp,SONGS[1],["--output-cache-link"]),(banks,True))
+            self.assertEqual(os.stat(output).st_nlink,2)
+
+            # Packing another song to the linked output leaves the entry intact
+            self.assertEqual(run_main(["-z",SONGS[0],output]),0)
+            self.assertEqual(self.run_cached(temp,SONGS[1],["--output-cache-link"]),(banks,True))
+
+            # An entry edited through the link is packed again
+            with open(output,"ab") as f:
+                f.write(b"\x00")
+
+            self.assertEqual(self.run_cached(temp,SONGS[1],["--output-cache-link"]),(banks,False))
+
+class StreamTest(unittest.TestCase):
+    def test_round_trip(self):
+        for argv in (["-z"],["-z","-m","-c"],["-z","-m","-o","-c","-b","--bank-size","4096"]):
+            with self.subTest(argv=argv), tempfile.TemporaryDirectory() as temp:
+                output = os.path.join(temp,"song.pac")
+                self.assertEqual(run_main(["--stream"] + argv + [SONGS[1],output]),0)
+
+                names = sorted(os.listdir(temp))
+                banks = [read(os.path.join(temp,name)) for name in names]
+                self.assertEqual(names.__len__() > 1,"-b" in argv)
+                self.assertEqual(psgpacker.verify_banks(read(SONGS[1]),banks,"-c" in argv),-1)
+
+    def test_stdin(self):
+        # A named file is mapped and stdin is read a byte at a time
+        with tempfile.TemporaryDirectory() as temp:
+            output = os.path.join(temp,"song.pac")
+            self.assertEqual(run_main(["--stream","-z","-m","-c",SONGS[1],output]),0)
+
+            with open(SONGS[1],"rb") as f:
+                subprocess.run([sys.executable,os.path.join(HERE,"psgpacker.py"),"--stream","-z","-m","-c",
+                    "",output + ".stdin"],stdin=f,check=True)
+
+            self.assertEqual(read(output + ".stdin"),read(output))
+
+class BatchTest(unittest.TestCase):
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as temp:
+            outdir = os.path.join(temp,"out")
+            self.assertEqual(run_main(["-z","-m","--batch"] + SONGS + ["--outdir",outdir]),0)
+
+            for name in SONGS:
+                output = os.path.join(outdir,os.path.splitext(os.path.basename(name))[0] + ".pac")
+                self.assertEqual(read(output),psgpacker.compress(read(name),lz=True,multi=True)[0])
+
+    def test_duplicates(self):
+        # Two inputs with the same output name fail before anything is packed
+        with tempfile.TemporaryDirectory() as temp:
+            for n in range(SONGS.__len__()):
+                os.mkdir(os.path.join(temp,str(n)))
+
+                with open(os.path.join(temp,str(n),"song.psg"),"wb") as f:
+                    f.write(read(SONGS[n]))
+
+            outdir = os.path.join(temp,"out")
+            self.assertEqual(run_main(["-z","--batch",os.path.join(temp,"0"),os.path.join(temp,"1"),
+                "--outdir",outdir]),1)
+            self.assertFalse(os.path.exists(outdir))
+
+class SongsTest(unittest.TestCase):
+    def test_saved(self):
+        # Each song depacks from the saved files like _init and _seek play it
+        for argv in (["-z","-m","-c"],["-z","-m","-c","-b","--bank-size","8192"]):
+            with self.subTest(argv=argv), tempfile.TemporaryDirectory() as temp:
+                output = os.path.join(temp,"songs.pac")
+                self.assertEqual(run_main(["--songs",output] + SONGS + argv),0)
+                self.assertFalse(os.path.exists(output + ".cache"))
+
+                names = psgpacker.bank_names(output,10 if ("-b" in argv) else 1)
+                banks = [read(name) for name in names if (os.path.exists(name))]
+                dictionary = read(output + ".dict") if (os.path.exists(output + ".dict")) else b""
+                directory = read(output + ".dir")
+                self.assertEqual(directory.__len__(),3 * SONGS.__len__())
+
+                for n in range(SONGS.__len__()):
+                    entry = (directory[3*n],int.from_bytes(directory[3*n+1:3*n+3],byteorder="little"))
+                    depacker = psgpacker.PSGDepacker(banks,True,dictionary=dictionary,entry=entry)
+                    self.assertEqual(psgpacker.verify_states(read(SONGS[n]),depacker.depack()),-1)
+
+    def test_optimal(self):
+        # --songs with --multi and --optimal crashed on unmapped song heads
+        with tempfile.TemporaryDirectory() as temp:
+            output = os.path.join(temp,"songs.pac")
+            self.assertEqual(run_main(["--songs",output] + SONGS + ["-z","-m","-O","--verify"]),0)
+            self.assertTrue(os.path.exists(output + ".dir"))
+
+def tokenize(data,**options):
+    with psgpacker.PSGio(data,None) as io:
+        psg = psgpacker.PSGCompressor(io,**options)
+        psg.pass_clock = psgpacker.time.perf_counter()
+        psg.PASS1_tokenize()
+
+    tokens = psg.tokens
+    return [(tokens.tags[head],bytes(tokens.encoding(head))) for head in range(tokens.__len__())]
+
+class NumpyTest(unittest.TestCase):
+    @unittest.skipIf(psgpacker.np is None,"NumPy is not installed")
+    def test_tokens(self):
+        # The NumPy PASS #1 gives the same tokens as the pure Python one
+        for name in SONGS:
+            for oneput in (False,True):
+                with self.subTest(song=os.path.basename(name),oneput=oneput):
+                    data = read(name)
+                    self.assertEqual(tokenize(data,numpy=True,oneput=oneput),tokenize(data,oneput=oneput))
+
+    def test_missing(self):
+        np = psgpacker.np
+        psgpacker.np = None
+
+        try:
+            self.assertEqual(run_main(["--numpy",SONGS[1],os.devnull]),2)
+            self.assertEqual(psgpacker.serve_parse(["--numpy",SONGS[1]])[1]["exit"],2)
+        finally:
+            psgpacker.np = np
+
+class ServeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp = tempfile.TemporaryDirectory()
+        cls.socket = os.path.join(cls.temp.name,"psgpacker.sock")
+        cls.server = subprocess.Popen([sys.executable,os.path.join(HERE,"psgpacker.py"),"--serve",cls.socket,
+            "--workers","1"],stderr=subprocess.DEVNULL)
+
+        for n in range(100):
+            if (os.path.exists(cls.socket)):
+                break
+
+            time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.send_signal(signal.SIGINT)
+        cls.server.wait(10)
+        cls.temp.cleanup()
+
+    # psgclient.py in the directory temp, returns the exit status and stderr
+    def request(self,temp,argv):
+        cwd = os.getcwd()
+        err = StringIO()
+
+        try:
+            os.chdir(temp)
+
+            with redirect_stderr(err):
+                code = psgclient.request(self.socket,argv)
+        finally:
+            os.chdir(cwd)
+
+        return code,err.getvalue()
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as temp:
+            code,err = self.request(temp,["-z","-m","-c","-b","--bank-size","8192","--stats","stats.json",
+                SONGS[0],"song.pac"])
+            self.assertEqual(code,0)
+            self.assertTrue(os.path.exists(os.path.join(temp,"stats.json")))
+
+            # The messages name the client files
+            self.assertIn("file song.pac0\n",err)
+
+            self.assertEqual(run_main(["-z","-m","-c","-b","--bank-size","8192",SONGS[0],
+                os.path.join(temp,"local.pac")]),0)
+
+            for n in range(psgpacker.compress(read(SONGS[0]),lz=True,multi=True,cache=True,bankswitch=True,
+                    bank_capacity=8192).__len__()):
+                self.assertEqual(read(os.path.join(temp,f"song.pac{n}")),read(os.path.join(temp,f"local.pac{n}")))
+
+    def test_errors(self):
+        with tempfile.TemporaryDirectory() as temp:
+            self.assertEqual(self.request(temp,["--songs","x.pac",SONGS[0]])[0],2)
+
+            with open(os.path.join(temp,"bad.psg"),"wb") as f:
+                f.write(b"not a PSG file")
+
+            self.assertEqual(self.request(temp,["-z","bad.psg","x.pac"])[0],1)
+            self.assertFalse(os.path.exists(os.path.join(temp,"x.pac")))
+
+    def test_hard_link(self):
+        # A file linked to another name is replaced, not written through
+        with tempfile.TemporaryDirectory() as temp:
+            output = os.path.join(temp,"song.pac")
+            other = os.path.join(temp,"other.pac")
+
+            with open(other,"wb") as f:
+                f.write(b"keep")
+
+            os.link(other,output)
+            self.assertEqual(self.request(temp,["-z",SONGS[1],output])[0],0)
+            self.assertEqual(read(other),b"keep")
+            self.assertEqual(read(output),psgpacker.compress(read(SONGS[1]),lz=True)[0])
+
+class BenchTest(unittest.TestCase):
+    def test_compare(self):
+        base = {"song:zm": {"bytes": 1000, "time": 1.0, "passes": {"PASS1": {"time": 0.5}, "PASS3": {"time": 0.5}}}}
+
+        def result(size,pass1,pass3):
+            return {"song:zm": {"bytes": size, "time": pass1 + pass3,
+                "passes": {"PASS1": {"time": pass1}, "PASS3": {"time": pass3}}}}
+
+        # A slower pass alone is not a regression
+        self.assertEqual(psgbench.compare(result(1000,0.3,0.7),base,0.10,0.02),
+            ([],["song:zm: PASS3 time 0.500 -> 0.700 s"]))
+
+        # Within the tolerance or the slack
+        self.assertEqual(psgbench.compare(result(1000,0.5,0.55),base,0.10,0.02),([],[]))
+        self.assertEqual(psgbench.compare(result(1000,0.5,0.515),base,0.01,0.02),([],[]))
+
+        regressions,passes = psgbench.compare(result(1001,0.5,0.8),base,0.10,0.02)
+        self.assertEqual(regressions,["song:zm: output 1000 -> 1001 bytes","song:zm: time 1.000 -> 1.300 s"])
+
+        # Inputs and combinations missing from the baseline are skipped
+        self.assertEqual(psgbench.compare({"other:zm": result(2000,1.0,1.0)["song:zm"]},base,0.10,0.02),([],[]))
+
+class RegressionTest(unittest.TestCase):
+    def test_options(self):
+        for argv in (["--depth","0"],["--banks","256"],["--bank-size","255"],["--loop-frame","-1"],
+                ["--loop","--loop-frame","3"],["--stream","--sample","0"],
+                ["--max-cycles","-5"],["--dict-size","-1"]):
+            with self.subTest(argv=argv):
+                self.assertEqual(run_main(argv + [SONGS[0],os.devnull]),2)
+
+        self.assertEqual(psgpacker.serve_parse(["--sample","0",SONGS[0]])[1]["exit"],2)
+        self.assertEqual(psgpacker.serve_parse(["--max-cycles","-5",SONGS[0]])[1]["exit"],2)
+
+if __name__ == "__main__":
+    unittest.main()